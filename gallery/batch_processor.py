@@ -1,220 +1,375 @@
 """
 Batch processing for ZIP file uploads
-Extracts and processes multiple images at once
+Extracts the images of a batch and converts them one by one; the Celery
+tasks in tasks.py fan the conversions out over the workers
 """
 
 import os
+import queue
+import threading
+import time
 import zipfile
-import tempfile
+from io import BytesIO
 from django.core.files.base import ContentFile
+from django.db.models import F
 from django.utils import timezone
+from .events import publish_batch
 from .models import BatchUpload, GhibliArtwork
-from .huggingface_processor import processor
-import time
+from .huggingface_processor import get_processor
+from .image_io import converted_content, open_for_size
+from .search import index_batch
+from .zip_manifest import batch_manifest, valid_entries
 from PIL import Image
 
-def process_batch_upload(batch_id):
+# Decoded images waiting for the consumer - bounds the memory in use
+BATCH_PREFETCH = 4
+
+# Artworks inserted per bulk_create while streaming a batch
+BATCH_CREATE_CHUNK = 8
+
+# Progress counts are written every this many images or seconds, whichever comes first
+BATCH_PROGRESS_FLUSH_ITEMS = 10
+BATCH_PROGRESS_FLUSH_SECONDS = 2.0
+
+def start_batch(batch):
     """
-    Process a batch upload - extract ZIP and convert all images
+    Reset a batch for (re)processing and count its images
+    
+    The count comes from the batch's ZIP manifest, nothing is decoded or
+    rescanned. Returns the count; a batch without images is marked failed.
     """
+    print(f"🗂️ Starting batch processing: {batch.name}")
+    
     try:
-        batch = BatchUpload.objects.get(id=batch_id)
-        
-        print(f"🗂️ Starting batch processing: {batch.name}")
-        
-        # Update status
-        batch.status = 'extracting'
-        batch.processing_started = timezone.now()
-        batch.save()
-        
-        # Extract ZIP file
-        extracted_files = extract_zip_images(batch)
+        manifest = batch_manifest(batch)
+    except (OSError, zipfile.BadZipFile) as e:
+        print(f"❌ ZIP extraction error: {e}")
+        manifest = []
+    
+    batch.status = 'extracting'
+    batch.processing_started = timezone.now()
+    batch.total_images = len(valid_entries(manifest))
+    batch.processed_images = 0
+    batch.successful_images = 0
+    batch.failed_images = 0
+    # A lane whose task was killed never gave its slot back; lanes of an
+    # earlier attempt that are still running give theirs back without
+    # going below zero
+    batch.active_lanes = 0
+    
+    if not batch.total_images:
+        batch.status = 'failed'
+        batch.error_message = 'No valid images found in ZIP file'
+    batch.save(update_fields=[
+        'manifest', 'status', 'processing_started', 'total_images', 'processed_images',
+        'successful_images', 'failed_images', 'error_message', 'active_lanes'
+    ])
+    # Images an earlier attempt inserted but never queued are extracted
+    # again, so no lane of this attempt may claim them
+    batch.artworks.filter(status='processing', task_id__isnull=True).update(
+        status='failed', error_message='Batch was restarted'
+    )
+    publish_batch(batch.pk)
+    return batch.total_images
+
+def stream_batch_artworks(batch, progress):
+    """
+    Create one artwork per image as the images come out of the ZIP
+    
+    Artworks are inserted BATCH_CREATE_CHUNK at a time with bulk_create,
+    and each inserted chunk is yielded as a list straight away; images
+    that cannot be read or stored are counted as failed in progress and
+    skipped. Copies of an image share its stored original and go into
+    the same chunk, so one lane claims them together.
+    """
+    pending = []
+    for filename, encoded, copies in prefetch(iter_zip_images(batch), BATCH_PREFETCH):
+        if encoded is None:
+            for _ in range(1 + len(copies)):
+                progress.record(False)
+            continue
+        try:
+            artwork = build_batch_artwork(batch, filename, encoded)
+        except Exception as e:
+            print(f"❌ Error preparing {filename}: {e}")
+            for _ in range(1 + len(copies)):
+                progress.record(False)
+            continue
+        pending.append(artwork)
+        pending.extend(share_batch_original(artwork, copy) for copy in copies)
         
-        if not extracted_files:
-            batch.status = 'failed'
-            batch.error_message = 'No valid images found in ZIP file'
-            batch.save()
-            return f"❌ No valid images found in {batch.name}"
+        if len(pending) >= BATCH_CREATE_CHUNK:
+            yield insert_batch_artworks(pending)
+            pending = []
+    if pending:
+        yield insert_batch_artworks(pending)
+
+def insert_batch_artworks(artworks):
+    return GhibliArtwork.objects.bulk_create(artworks)
+
+class BatchProgress:
+    """
+    Progress counts of one batch, coalesced into periodic F() updates
+    
+    The counts are added to the row, never written over it, so any
+    number of workers can report into the same batch.
+    """
+    
+    def __init__(self, batch_id, flush_items=BATCH_PROGRESS_FLUSH_ITEMS, flush_seconds=BATCH_PROGRESS_FLUSH_SECONDS):
+        self.batch_id = batch_id
+        self.flush_items = flush_items
+        self.flush_seconds = flush_seconds
+        self.successful = 0
+        self.failed = 0
+        self.last_flush = time.monotonic()
+    
+    def record(self, succeeded):
+        if succeeded:
+            self.successful += 1
+        else:
+            self.failed += 1
         
-        # Update total count
-        batch.total_images = len(extracted_files)
-        batch.status = 'processing'
-        batch.save()
+        if (self.successful + self.failed >= self.flush_items
+                or time.monotonic() - self.last_flush >= self.flush_seconds):
+            self.flush()
+    
+    def flush(self):
+        """Write the counts gathered since the last flush - one UPDATE"""
+        processed = self.successful + self.failed
+        if processed:
+            BatchUpload.objects.filter(pk=self.batch_id).update(
+                processed_images=F('processed_images') + processed,
+                successful_images=F('successful_images') + self.successful,
+                failed_images=F('failed_images') + self.failed,
+            )
+            publish_batch(self.batch_id)
+        self.successful = self.failed = 0
+        self.last_flush = time.monotonic()
+
+def record_batch_progress(batch_id, succeeded):
+    """Count one processed image straight away"""
+    BatchProgress(batch_id, flush_items=1).record(succeeded)
+
+def complete_batch(batch_id):
+    """
+    Mark a batch completed if every image has been counted
+    
+    Safe to call any number of times from any worker: only the call that
+    flips the status finishes the batch, the others return None.
+    """
+    completed = BatchUpload.objects.filter(
+        pk=batch_id, status__in=['extracting', 'processing'], processed_images__gte=F('total_images')
+    ).update(status='completed', processing_completed=timezone.now())
+    if not completed:
+        return None
+    index_batch(batch_id)
+    publish_batch(batch_id)
+    batch = BatchUpload.objects.get(pk=batch_id)
+    
+    result_message = f"🎉 Batch '{batch.name}' complete! {batch.successful_images} successful, {batch.failed_images} failed"
+    print(result_message)
+    return result_message
+
+def fail_batch(batch_id, error):
+    try:
+        BatchUpload.objects.filter(pk=batch_id).update(status='failed', error_message=str(error))
+        publish_batch(batch_id)
+        # The images inserted before the failure stay searchable
+        index_batch(batch_id)
+    except Exception:
+        pass
+
+def convert_batch_artworks(artworks, style):
+    """
+    Convert images of a batch together and store the results; returns whether each succeeded
+    
+    Artworks sharing an original (copies of one image in the ZIP) are
+    converted once.
+    """
+    paths = list(dict.fromkeys(artwork.original_image.path for artwork in artworks))
+    results = dict(zip(paths, get_processor().convert_many(paths, style)))
+    return [
+        save_batch_result(artwork, artwork.name, *results[artwork.original_image.path])
+        for artwork in artworks
+    ]
+
+def build_batch_artwork(batch, filename, encoded):
+    """The unsaved artwork for an extracted image, with its encoded original put into storage"""
+    artwork = GhibliArtwork(
+        name=f"{batch.name} - {filename}",
+        conversion_method=batch.conversion_method,
+        batch_upload=batch,
+        # Waiting for a lane: processing_started is set when one claims it
+        status='processing'
+    )
+    
+    image_content = ContentFile(encoded)
+    clean_filename = filename.replace(' ', '_').replace('(', '').replace(')', '')
+    # save=False only stores the file - the row is inserted later in bulk
+    artwork.original_image.save(f"{artwork.id}_{clean_filename}", image_content, save=False)
+    
+    # bulk_create skips GhibliArtwork.save, which would fill this in
+    artwork.original_file_size = image_content.size
+    return artwork
+
+def share_batch_original(artwork, filename):
+    """The unsaved artwork for another copy of an extracted image - its stored file is shared, not copied"""
+    return GhibliArtwork(
+        name=f"{artwork.batch_upload.name} - {filename}",
+        conversion_method=artwork.conversion_method,
+        batch_upload=artwork.batch_upload,
+        status='processing',
+        original_image=artwork.original_image.name,
+        original_file_size=artwork.original_file_size,
+    )
+
+def save_batch_result(artwork, filename, result_image, error, update_fields=()):
+    """
+    Store one conversion result on its artwork; returns whether it succeeded
+    
+    Only the result columns are written, plus any update_fields the caller
+    changed on the artwork itself.
+    """
+    update_fields = list(update_fields)
+    try:
+        if error is not None:
+            raise error
         
-        print(f"📊 Processing {len(extracted_files)} images...")
+        if not result_image:
+            artwork.status = 'failed'
+            artwork.error_message = 'Conversion failed - no result returned'
+            artwork.save(update_fields=['status', 'error_message', *update_fields])
+            print(f"❌ Failed to process {filename}")
+            return False
         
-        # Process each image
-        successful_count = 0
-        failed_count = 0
+        image_content = converted_content(result_image)
         
-        for i, (filename, image_path) in enumerate(extracted_files):
-            try:
-                print(f"🎨 Processing {i+1}/{len(extracted_files)}: {filename}")
-                
-                # Create artwork record
-                artwork_name = f"{batch.name} - {filename}"
-                artwork = GhibliArtwork.objects.create(
-                    name=artwork_name,
-                    conversion_method=batch.conversion_method,
-                    batch_upload=batch,
-                    status='processing'
-                )
-                
-                # Copy the extracted image to artwork
-                with open(image_path, 'rb') as f:
-                    image_content = ContentFile(f.read())
-                    clean_filename = filename.replace(' ', '_').replace('(', '').replace(')', '')
-                    artwork.original_image.save(f"{artwork.id}_{clean_filename}", image_content, save=True)
-                
-                # Process the image
-                artwork.processing_started = timezone.now()
-                artwork.save()
-                
-                start_time = time.time()
-                
-                # Convert using our processor
-                result_image = processor.convert_to_ghibli(
-                    image_path=artwork.original_image.path,
-                    prompt=f"Convert {filename} to {batch.conversion_method} style",
-                    model_name=batch.conversion_method
-                )
-                
-                if result_image:
-                    # Save converted image
-                    from io import BytesIO
-                    output_buffer = BytesIO()
-                    result_image.save(output_buffer, format='JPEG', quality=95)
-                    image_content = ContentFile(output_buffer.getvalue())
-                    
-                    converted_filename = f"{artwork.id}_converted.jpg"
-                    artwork.converted_image.save(converted_filename, image_content, save=False)
-                    
-                    # Update artwork status
-                    artwork.status = 'completed'
-                    artwork.processing_completed = timezone.now()
-                    artwork.processing_time = time.time() - start_time
-                    artwork.save()
-                    
-                    successful_count += 1
-                    print(f"✅ Successfully processed {filename} in {artwork.processing_time:.1f}s")
-                    
-                else:
-                    artwork.status = 'failed'
-                    artwork.error_message = 'Conversion failed - no result returned'
-                    artwork.save()
-                    failed_count += 1
-                    print(f"❌ Failed to process {filename}")
-                
-                # Update batch progress
-                batch.processed_images = i + 1
-                batch.successful_images = successful_count
-                batch.failed_images = failed_count
-                batch.save()
-                
-                # Clean up temp file
-                try:
-                    os.unlink(image_path)
-                except:
-                    pass
-                
-            except Exception as e:
-                print(f"❌ Error processing {filename}: {e}")
-                failed_count += 1
-                
-                # Mark artwork as failed if it was created
-                try:
-                    if 'artwork' in locals():
-                        artwork.status = 'failed'
-                        artwork.error_message = str(e)
-                        artwork.save()
-                except:
-                    pass
-                
-                # Update batch progress
-                batch.processed_images = i + 1
-                batch.failed_images = failed_count
-                batch.save()
+        # A result that replaces another (a retry, or FLUX arriving after
+        # its deadline) leaves no stray file behind
+        previous = artwork.converted_image.name
+        converted_filename = f"{artwork.id}_converted.jpg"
+        artwork.converted_image.save(converted_filename, image_content, save=False)
         
-        # Complete batch processing
-        batch.status = 'completed'
-        batch.processing_completed = timezone.now()
-        batch.successful_images = successful_count
-        batch.failed_images = failed_count
-        batch.save()
+        artwork.status = 'completed'
+        artwork.processing_completed = timezone.now()
+        if artwork.processing_started:
+            artwork.processing_time = (artwork.processing_completed - artwork.processing_started).total_seconds()
+        artwork.save(update_fields=[
+            'converted_image', 'status', 'processing_completed', 'processing_time', *update_fields
+        ])
+        if previous and previous != artwork.converted_image.name:
+            artwork.converted_image.storage.delete(previous)
         
-        result_message = f"🎉 Batch '{batch.name}' complete! {successful_count} successful, {failed_count} failed"
-        print(result_message)
-        return result_message
+        print(f"✅ Successfully processed {filename}")
+        return True
         
     except Exception as e:
-        error_message = f"❌ Batch processing error: {e}"
-        print(error_message)
+        print(f"❌ Error processing {filename}: {e}")
         try:
-            batch = BatchUpload.objects.get(id=batch_id)
-            batch.status = 'failed'
-            batch.error_message = str(e)
-            batch.save()
+            artwork.status = 'failed'
+            artwork.error_message = str(e)
+            artwork.save(update_fields=['status', 'error_message', *update_fields])
         except:
             pass
-        return error_message
+        return False
 
-def extract_zip_images(batch):
-    """Extract images from ZIP file to temporary directory"""
-    extracted_files = []
+def iter_zip_images(batch):
+    """
+    Read the images of a batch straight from the ZIP stream, one at a time
     
-    try:
-        print(f"📦 Extracting ZIP file: {batch.zip_file.name}")
-        
-        with zipfile.ZipFile(batch.zip_file.path, 'r') as zip_ref:
-            file_list = zip_ref.namelist()
-            
-            valid_extensions = ['.jpg', '.jpeg', '.png', '.webp']
-            
-            for filename in file_list:
-                # Skip directories and hidden files
-                if filename.endswith('/') or filename.startswith('.') or filename.startswith('__MACOSX'):
-                    continue
-                
-                # Check if it's an image file
-                file_ext = '.' + filename.lower().split('.')[-1]
-                if file_ext in valid_extensions:
+    Walks the manifest's valid entries - members are looked up by name,
+    never rescanned or re-filtered. JPEGs the manifest says are at most
+    1024px are stored as they are; anything else is decoded, scaled down
+    and re-encoded as JPEG. Members with the same CRC and size as an
+    earlier one are copies of it and never read. Yields (filename,
+    encoded, copies) with the JPEG to store as the original and the
+    filenames of its copies; encoded is None for an image that cannot
+    be read.
+    """
+    print(f"📦 Extracting ZIP file: {batch.zip_file.name}")
+    
+    copies = {}
+    unique = []
+    for entry in valid_entries(batch_manifest(batch)):
+        names = copies.setdefault((entry['crc'], entry['size']), [])
+        if not names:
+            unique.append(entry)
+        names.append(os.path.basename(entry['name']))
+    
+    max_size = 1024
+    with zipfile.ZipFile(batch.zip_file.path, 'r') as zip_ref:
+        for entry in unique:
+            filename, *duplicates = copies[(entry['crc'], entry['size'])]
+            try:
+                if entry['type'] == 'JPEG' and max(entry['width'], entry['height']) <= max_size:
+                    # The conversion decodes it anyway, so extracting does not
+                    encoded = zip_ref.read(entry['name'])
+                else:
+                    # Resize large images to save processing time - a JPEG
+                    # is only decoded as large as the resize needs
+                    with zip_ref.open(entry['name']) as source:
+                        img = open_for_size(source, max_side=max_size)
                     
-                    try:
-                        # Extract to temporary file
-                        temp_dir = tempfile.mkdtemp()
-                        clean_filename = os.path.basename(filename).replace(' ', '_')
-                        temp_path = os.path.join(temp_dir, clean_filename)
-                        
-                        with zip_ref.open(filename) as source, open(temp_path, 'wb') as target:
-                            target.write(source.read())
-                        
-                        # Validate it's a valid image
-                        with Image.open(temp_path) as img:
-                            # Convert to RGB if needed and resize
-                            if img.mode != 'RGB':
-                                img = img.convert('RGB')
-                            
-                            # Resize large images to save processing time
-                            max_size = 1024
-                            if img.width > max_size or img.height > max_size:
-                                img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-                            
-                            img.save(temp_path, 'JPEG', quality=95)
-                        
-                        extracted_files.append((os.path.basename(filename), temp_path))
-                        print(f"✅ Extracted: {filename}")
-                        
-                    except Exception as e:
-                        print(f"❌ Invalid image {filename}: {e}")
-                        try:
-                            if os.path.exists(temp_path):
-                                os.unlink(temp_path)
-                        except:
-                            pass
-        
-        print(f"📊 Successfully extracted {len(extracted_files)} valid images")
-        return extracted_files
-        
-    except Exception as e:
-        print(f"❌ ZIP extraction error: {e}")
-        return []
\ No newline at end of file
+                    if img.width > max_size or img.height > max_size:
+                        img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+                    
+                    buffer = BytesIO()
+                    img.save(buffer, 'JPEG', quality=95)
+                    encoded = buffer.getvalue()
+            except Exception as e:
+                print(f"❌ Invalid image {entry['name']}: {e}")
+                yield filename, None, duplicates
+                continue
+            
+            print(f"✅ Extracted: {entry['name']}")
+            yield filename, encoded, duplicates
+
+def prefetch(iterable, size):
+    """
+    Iterate over iterable in a background thread, keeping up to size items ready
+    
+    Decoding the next images overlaps with whatever the caller does with
+    the current one, while the bounded queue caps how far ahead it gets.
+    Closing the generator early stops the thread.
+    """
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    done = object()
+    
+    def put(entry):
+        # Give up once the consumer has gone, instead of blocking forever
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+        finally:
+            # Release the ZIP from the thread that opened it
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+    
+    thread = threading.Thread(target=produce, name='batch-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,89 @@
+"""
+Circuit breaker for remote backends
+State lives in the Django cache, so every web and Celery worker sharing
+the cache sees the same breaker
+"""
+
+import time
+
+from django.core.cache import cache
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    Closed: calls go through and failures are counted.
+    Open: calls are refused until reset_timeout has passed.
+    Half-open: a single trial call decides whether to close or re-open.
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state_key = f"circuit:{name}:state"
+        self.failures_key = f"circuit:{name}:failures"
+        self.trial_key = f"circuit:{name}:trial"
+
+    def _load(self):
+        return cache.get(self.state_key) or {'state': CLOSED, 'opened_at': None}
+
+    @property
+    def state(self):
+        return self._load()['state']
+
+    def allow_request(self):
+        """Whether a call may go to the backend right now"""
+        current = self._load()
+        if current['state'] == CLOSED:
+            return True
+
+        if current['state'] == OPEN:
+            if time.time() - current['opened_at'] < self.reset_timeout:
+                return False
+            cache.set(self.state_key, {'state': HALF_OPEN, 'opened_at': current['opened_at']}, None)
+
+        # Half-open: cache.add is atomic, so only one worker gets the trial call.
+        # The trial lock expires in case that worker dies before reporting back.
+        return cache.add(self.trial_key, True, self.reset_timeout)
+
+    def record_success(self):
+        if self._load()['state'] != CLOSED:
+            print(f"✅ {self.name} circuit closed - backend healthy again")
+        cache.set(self.state_key, {'state': CLOSED, 'opened_at': None}, None)
+        cache.delete_many([self.failures_key, self.trial_key])
+
+    def record_failure(self):
+        current = self._load()
+        if current['state'] != CLOSED:
+            # The half-open trial failed
+            self.trip()
+            return
+
+        cache.add(self.failures_key, 0, None)
+        try:
+            failures = cache.incr(self.failures_key)
+        except ValueError:
+            # Evicted between add and incr
+            cache.set(self.failures_key, 1, None)
+            failures = 1
+        if failures >= self.failure_threshold:
+            self.trip()
+
+    def trip(self):
+        """Open the circuit: callers go straight to their fallback"""
+        print(f"⚡ {self.name} circuit open - using the fallback for {self.reset_timeout}s")
+        cache.set(self.state_key, {'state': OPEN, 'opened_at': time.time()}, None)
+        cache.delete_many([self.failures_key, self.trial_key])
+
+    def record_probe(self, healthy):
+        """Fold a health probe result in: a healthy probe lets an open circuit retry early"""
+        current = self._load()
+        if not healthy:
+            if current['state'] != OPEN:
+                self.trip()
+        elif current['state'] == OPEN:
+            cache.set(self.state_key, {'state': HALF_OPEN, 'opened_at': current['opened_at']}, None)
@@ -0,0 +1,100 @@
+"""
+Input decode benchmark
+Compares decoding originals at full resolution, as ingestion used to,
+with open_for_size's reduced-resolution JPEG decode, for each target size
+the gallery scales inputs down to
+
+Run it with: python -m gallery.decode_benchmark [photo.jpg ...]
+Without photos it generates a corpus of 12 MP phone-sized JPEGs.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+from .image_io import open_for_size
+
+# 4:3 sensor of a typical 12 MP phone camera
+PHONE_PHOTO_SIZE = (4032, 3024)
+
+# (label, open_for_size arguments, final size step) for each ingestion path
+TARGETS = (
+    ('zip extraction (1024 max side)', {'max_side': 1024}, 'thumbnail'),
+    ('filters (512x512)', {'size': (512, 512)}, 'resize'),
+    ('flux upload (1024 max side, 512x512 fallback)', {'size': (512, 512), 'max_side': 1024}, 'thumbnail'),
+)
+
+
+def make_corpus(directory, count=5, size=PHONE_PHOTO_SIZE):
+    """Photo-like JPEGs - smooth gradients plus noise, encoded like a phone camera would"""
+    base = Image.linear_gradient('L').resize(size)
+    paths = []
+    for i in range(count):
+        noise = Image.effect_noise(size, 24 + i)
+        img = Image.merge('RGB', (base, base.transpose(Image.Transpose.ROTATE_180), noise))
+        path = os.path.join(directory, f'photo_{i}.jpg')
+        img.save(path, 'JPEG', quality=92)
+        paths.append(path)
+    return paths
+
+
+def full_decode(path, size=None, max_side=None):
+    """The old ingestion path: decode every pixel, then scale down"""
+    with Image.open(path) as img:
+        img.load()
+        return img.convert('RGB') if img.mode != 'RGB' else img.copy()
+
+
+def scale_down(img, size=None, max_side=None, step='thumbnail'):
+    if step == 'resize':
+        return img.resize(size, Image.Resampling.LANCZOS)
+    img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return img
+
+
+def time_decode(paths, decode, arguments, step, rounds=3):
+    """Best-of-rounds milliseconds per photo, and the megapixels decoded per photo"""
+    best = None
+    for _ in range(rounds):
+        decoded_pixels = 0
+        start = time.perf_counter()
+        for path in paths:
+            img = decode(path, **arguments)
+            decoded_pixels += img.width * img.height
+            scale_down(img, step=step, **arguments)
+        elapsed = (time.perf_counter() - start) * 1000 / len(paths)
+        best = elapsed if best is None else min(best, elapsed)
+    return best, decoded_pixels / len(paths) / 1e6
+
+
+def run_benchmark(paths, rounds=3):
+    """(label, full ms, full MP, reduced ms, reduced MP) for each target"""
+    results = []
+    for label, arguments, step in TARGETS:
+        full_ms, full_mp = time_decode(paths, full_decode, arguments, step, rounds)
+        reduced_ms, reduced_mp = time_decode(paths, open_for_size, arguments, step, rounds)
+        results.append((label, full_ms, full_mp, reduced_ms, reduced_mp))
+    return results
+
+
+if __name__ == '__main__':
+    corpus_dir = None
+    paths = sys.argv[1:]
+    if not paths:
+        corpus_dir = tempfile.mkdtemp(prefix='decode-benchmark-')
+        print(f"📸 Generating {PHONE_PHOTO_SIZE[0]}x{PHONE_PHOTO_SIZE[1]} corpus in {corpus_dir}")
+        paths = make_corpus(corpus_dir)
+
+    try:
+        for label, full_ms, full_mp, reduced_ms, reduced_mp in run_benchmark(paths):
+            print(f"⏱️ {label}")
+            print(f"   full decode:    {full_ms:7.1f} ms/photo, {full_mp:5.2f} MP decoded")
+            print(f"   reduced decode: {reduced_ms:7.1f} ms/photo, {reduced_mp:5.2f} MP decoded"
+                  f"  ({full_ms / reduced_ms:.1f}x faster)")
+    finally:
+        if corpus_dir is not None:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
@@ -0,0 +1,53 @@
+"""
+Pooled HTTP downloads for provider outputs
+One keep-alive session per process, retrying transient failures with backoff
+"""
+
+import tempfile
+import threading
+
+CHUNK_SIZE = 64 * 1024
+
+# Downloads bigger than this spill from memory to a temporary file
+SPOOL_SIZE = 4 * 1024 * 1024
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """The shared session - connections to the provider's CDN are reused"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            # requests is only loaded by the processes that download outputs
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET']),
+            )
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+    return _session
+
+
+def download(url, timeout=60):
+    """Stream url into a spooled temporary file, rewound and ready to read"""
+    with get_session().get(url, stream=True, timeout=timeout) as response:
+        if response.status_code != 200:
+            raise Exception(f"Download failed: {response.status_code}")
+
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        for chunk in response.iter_content(CHUNK_SIZE):
+            spool.write(chunk)
+
+    spool.seek(0)
+    return spool
@@ -0,0 +1,245 @@
+"""
+Server-push events
+Whatever changes an artwork or a batch publishes a notice on its channel
+once the change commits; the event stream views relay the fresh state to
+the browser over Server-Sent Events, so pages no longer poll. Only ASGI
+keeps the streams open; under WSGI each request answers with the current
+state and the browser reconnects a few seconds later. Channels live in
+process memory, or in Redis pub/sub when EVENTS_REDIS_URL is set so that
+Celery workers reach every web process; without it, open streams poll
+"""
+
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from contextlib import asynccontextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+# Any artwork entering or leaving the queue - what the processing page follows
+QUEUE_CHANNEL = 'queue'
+
+# A save writing any of these changes what an artwork's page shows
+ARTWORK_EVENT_FIELDS = frozenset(('status', 'converted_image', 'preview_image', 'deadline_fallback', 'error_message'))
+
+# Redis channel names are prefixed, so a shared Redis stays tidy
+REDIS_PREFIX = 'gallery-events:'
+
+
+def artwork_channel(artwork_id):
+    return f'artwork:{artwork_id}'
+
+
+def batch_channel(batch_id):
+    return f'batch:{batch_id}'
+
+
+class MemorySubscription:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+
+    def put(self, message):
+        # Called from the publishing thread
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+        except RuntimeError:
+            # The subscriber's loop is gone
+            pass
+
+    async def next(self, timeout):
+        """The next message, or None after timeout seconds without one"""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def drain(self):
+        """Drop the messages already waiting - one state read answers them all"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class MemoryBroker:
+    """
+    Subscribers of this process only
+
+    Enough when the tasks run in the web process (eager Celery, tests,
+    development); workers in other processes need RedisBroker.
+    """
+
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        subscription = MemorySubscription()
+        with self.lock:
+            self.subscriptions[channel].add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self.lock:
+                self.subscriptions[channel].discard(subscription)
+                if not self.subscriptions[channel]:
+                    del self.subscriptions[channel]
+
+
+class RedisSubscription:
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    async def next(self, timeout):
+        message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        return None if message is None else json.loads(message['data'])
+
+    async def drain(self):
+        while await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=0):
+            pass
+
+
+class RedisBroker:
+    """Redis pub/sub, shared by every web and Celery process using the same server"""
+
+    def __init__(self, url):
+        self.url = url
+        self.client = None
+
+    def publish(self, channel, message):
+        import redis
+
+        if self.client is None:
+            self.client = redis.Redis.from_url(self.url)
+        self.client.publish(REDIS_PREFIX + channel, json.dumps(message))
+
+    @asynccontextmanager
+    async def subscribe(self, channel):
+        import redis.asyncio
+
+        client = redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(REDIS_PREFIX + channel)
+        try:
+            yield RedisSubscription(pubsub)
+        finally:
+            await pubsub.unsubscribe()
+            await pubsub.aclose()
+            await client.aclose()
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        url = getattr(settings, 'EVENTS_REDIS_URL', '')
+        _broker = RedisBroker(url) if url else MemoryBroker()
+    return _broker
+
+
+def publish(*channels, **message):
+    """
+    Notify the subscribers of channels once the current transaction commits
+
+    Best effort: a broker that is down never fails the change itself,
+    pages then only miss a live update.
+    """
+    def send():
+        for channel in channels:
+            try:
+                get_broker().publish(channel, message)
+            except Exception as e:
+                print(f"⚠️ Could not publish {channel} event: {e}")
+
+    transaction.on_commit(send)
+
+
+def publish_artworks(artwork_ids, status_changed=True):
+    """One notice per artwork, and one for the queue when their status moved"""
+    channels = [artwork_channel(artwork_id) for artwork_id in artwork_ids]
+    if status_changed:
+        channels.append(QUEUE_CHANNEL)
+    if channels:
+        publish(*channels)
+
+
+def publish_batch(batch_id):
+    publish(batch_channel(batch_id), batch=str(batch_id))
+
+
+def format_event(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def notices_reach_streams():
+    """
+    Whether the tasks' notices get to this process's streams
+
+    Not with in-process channels while the tasks run in Celery workers -
+    streams then re-read the state every EVENTS_POLL_INTERVAL instead.
+    """
+    return not isinstance(get_broker(), MemoryBroker) or getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False)
+
+
+async def stream_events(channel, snapshot, keepalive=None, max_age=None):
+    """
+    Body of a Server-Sent Events response following one channel
+
+    snapshot() runs in a thread (it reads the database) and returns the
+    state to send and whether it is final. It is sent on connect and after
+    every burst of notices, until it is final or max_age seconds have
+    passed - the browser's EventSource then reconnects by itself. A comment
+    line every keepalive seconds keeps proxies from closing an idle stream.
+    Where no notices arrive (notices_reach_streams), the state is re-read
+    every EVENTS_POLL_INTERVAL and sent when it changed.
+    """
+    keepalive = keepalive or getattr(settings, 'EVENTS_KEEPALIVE', 15)
+    max_age = max_age or getattr(settings, 'EVENTS_MAX_AGE', 300)
+    poll = None if notices_reach_streams() else getattr(settings, 'EVENTS_POLL_INTERVAL', 5)
+    read = sync_to_async(snapshot)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + max_age
+
+    # Subscribed before the first read, so no change can slip in between
+    async with get_broker().subscribe(channel) as subscription:
+        data, finished = await read()
+        yield format_event(data)
+        while not finished:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            message = await subscription.next(min(poll or keepalive, keepalive, remaining))
+            if message is None and poll is None:
+                yield ": keepalive\n\n"
+                continue
+            await subscription.drain()
+            previous = data
+            data, finished = await read()
+            if message is None and data == previous:
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(data)
+
+
+def snapshot_event(snapshot, retry=None):
+    """
+    Whole body of a Server-Sent Events response for a WSGI worker
+
+    A WSGI worker thread is not held open waiting for notices: the state
+    is sent once with a retry field, and the browser's EventSource polls
+    by reconnecting after retry seconds.
+    """
+    retry = retry or getattr(settings, 'EVENTS_POLL_INTERVAL', 5)
+    data = snapshot()[0]
+    return f"retry: {int(retry * 1000)}\n" + format_event(data)
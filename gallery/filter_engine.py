@@ -0,0 +1,417 @@
+"""
+Compiled filter engine for the style filters
+Fuses the point operations of each style into lookup tables and runs the
+spatial operations once, in fixed point, on NumPy arrays
+"""
+
+import numpy as np
+from PIL import Image
+
+# Bump whenever filter output changes - it is part of the result cache key
+ENGINE_VERSION = 1
+
+# Luma weights PIL uses for convert('L')
+LUMA_WEIGHTS = np.array([19595, 38470, 7471], dtype=np.float64) / 65536
+
+# The style pipelines, operation for operation the same as the
+# _<style>_filter methods of HuggingFaceProcessor
+STYLE_OPERATIONS = {
+    'ghibli': [
+        ('color', 1.3),
+        ('contrast', 1.1),
+        ('blur', 0.5),
+        ('posterize', 6),
+        ('brightness', 1.05),
+    ],
+    'anime': [
+        ('color', 1.6),
+        ('contrast', 1.3),
+        ('posterize', 4),
+        ('sharpen',),
+    ],
+    'cartoon': [
+        ('posterize', 3),
+        ('color', 1.8),
+        ('contrast', 1.4),
+        ('edge_enhance_more',),
+    ],
+    'sketch': [
+        ('grayscale',),
+        ('find_edges',),
+        ('invert',),
+        ('contrast', 2.5),
+    ],
+    'vibrant': [
+        ('color', 2.2),
+        ('contrast', 1.6),
+        ('brightness', 1.2),
+        ('sharpen',),
+    ],
+}
+
+# 3x3 kernels of the form "centre weight, same weight on all 8 neighbours"
+# as (centre, neighbour, divisor) - matches ImageFilter's builtin kernels
+RING_KERNELS = {
+    'sharpen': (32, -2, 16),
+    'edge_enhance_more': (9, -1, 1),
+    'find_edges': (8, -1, 1),
+}
+
+POINT_OPERATIONS = ('contrast', 'brightness', 'posterize', 'invert')
+
+
+def _blend(degenerate, values, factor):
+    """Image.blend arithmetic: float32, clipped, truncated to uint8"""
+    factor = np.float32(factor)
+    degenerate = np.float32(degenerate)
+    blended = degenerate + factor * (values - degenerate)
+    return np.clip(blended, 0, 255).astype(np.uint8)
+
+
+class ColourBlend:
+    """
+    ImageEnhance.Color without the intermediate image objects
+
+    Kept as a blend against the per-pixel luma rather than folded into a
+    matrix: PIL clips and truncates between colour and contrast, and the
+    contrast mean is taken after that, so a fused matrix drifts visibly on
+    saturated photos.
+    """
+
+    halo = 0
+
+    def __init__(self, factor):
+        self.factor = factor
+
+    def apply(self, img):
+        return Image.blend(img.convert('L').convert(img.mode), img, self.factor)
+
+
+class PointTable:
+    """A run of per-channel point operations collapsed into one 256-entry LUT"""
+
+    halo = 0
+
+    def __init__(self, operations):
+        self.operations = operations
+        self.needs_histogram = any(op[0] == 'contrast' for op in operations)
+
+    def build(self, histogram=None):
+        """
+        Compose the operations into one table
+
+        histogram: per-band counts (bands x 256) of the pixels entering the
+        table; only needed when the run contains a contrast step, whose mean
+        luminance PIL takes from the image at that point
+        """
+        values = np.arange(256, dtype=np.float32)
+        table = np.arange(256, dtype=np.uint8)
+
+        for op in self.operations:
+            name = op[0]
+            if name == 'contrast':
+                mean = self._mean_luminance(histogram, table)
+                table = _blend(mean, values[table], op[1])
+            elif name == 'brightness':
+                table = _blend(0, values[table], op[1])
+            elif name == 'posterize':
+                table = table & np.uint8(~(2 ** (8 - op[1]) - 1) & 0xFF)
+            elif name == 'invert':
+                table = 255 - table
+
+        return table
+
+    @staticmethod
+    def _mean_luminance(histogram, table):
+        # Mean of each band after the table built so far, then luma-weighted
+        band_means = (histogram * table.astype(np.float64)).sum(axis=1) / histogram.sum(axis=1)
+        mean = band_means[0] if len(band_means) == 1 else band_means @ LUMA_WEIGHTS
+        return int(mean + 0.5)
+
+    @staticmethod
+    def histogram(img):
+        bands = len(img.getbands())
+        return np.array(img.histogram(), dtype=np.int64).reshape(bands, 256)
+
+    def apply(self, img, histogram=None):
+        if self.needs_histogram and histogram is None:
+            histogram = self.histogram(img)
+        table = self.build(histogram).tolist()
+        return img.point(table * len(img.getbands()))
+
+
+class Grayscale:
+    """convert('L')"""
+
+    halo = 0
+
+    def apply(self, img):
+        return img.convert('L')
+
+
+class SpatialFilter:
+    """Base for the stages that run on a NumPy view of the pixels"""
+
+    def apply(self, img):
+        return Image.fromarray(self.filter(np.asarray(img)))
+
+    def filter(self, pixels):
+        raise NotImplementedError
+
+
+class GaussianBlur(SpatialFilter):
+    """
+    ImageFilter.GaussianBlur as one separable kernel per axis
+
+    PIL runs three extended-box passes per axis, rounding after each one;
+    here the three boxes are convolved into a single kernel up front and
+    applied in 8-bit fixed point, rounding once per axis.
+    """
+
+    # Fixed-point scale: 255 * 256 still fits in uint16
+    SCALE_BITS = 8
+
+    def __init__(self, radius, passes=3):
+        box = self._box_kernel(radius, passes)
+        kernel = np.ones(1, dtype=np.float64)
+        for _ in range(passes):
+            kernel = np.convolve(kernel, box)
+
+        # Symmetric, so keep the centre weight and one weight per distance.
+        # Taps that round to zero in fixed point are dropped and the centre
+        # takes up the slack, so the weights always sum to exactly 1.
+        scale = 1 << self.SCALE_BITS
+        centre = len(kernel) // 2
+        weights = [int(round(weight * scale)) for weight in kernel[centre + 1:]]
+        while weights and weights[-1] == 0:
+            weights.pop()
+        self.weights = [scale - 2 * sum(weights)] + weights
+        self.halo = len(weights)
+
+    @staticmethod
+    def _box_kernel(radius, passes):
+        # Same extended-box approximation PIL uses (libImaging/BoxBlur.c)
+        sigma2 = radius * radius / passes
+        length = np.sqrt(12.0 * sigma2 + 1.0)
+        whole = np.floor((length - 1.0) / 2.0)
+        fraction = (2 * whole + 1) * (whole * (whole + 1) - 3 * sigma2)
+        fraction /= 6 * (sigma2 - (whole + 1) * (whole + 1))
+        box_radius = whole + fraction
+
+        inner = 1.0 / (2 * box_radius + 1)
+        outer = (1.0 - (2 * whole + 1) * inner) / 2
+        return np.array([outer] + [inner] * int(2 * whole + 1) + [outer])
+
+    def _convolve_axis(self, values, axis):
+        """Blur a uint16 array of 8-bit values along one axis"""
+        size = values.shape[axis]
+
+        def part(start, stop=None):
+            index = [slice(None)] * values.ndim
+            index[axis] = slice(start, stop)
+            return tuple(index)
+
+        result = values * np.uint16(self.weights[0])
+
+        for distance, weight in enumerate(self.weights[1:], start=1):
+            weight = np.uint16(weight)
+            if size > 2 * distance:
+                pair = values[part(None, -2 * distance)] + values[part(2 * distance)]
+                pair *= weight
+                result[part(distance, -distance)] += pair
+
+            # Near the ends, samples past the edge repeat the edge pixel
+            # like PIL's box blur does
+            ends = set(range(min(distance, size))) | set(range(max(size - distance, 0), size))
+            for index in ends:
+                before = max(index - distance, 0)
+                after = min(index + distance, size - 1)
+                pair = values[part(before, before + 1)] + values[part(after, after + 1)]
+                result[part(index, index + 1)] += weight * pair
+
+        result += np.uint16(1 << (self.SCALE_BITS - 1))
+        result >>= self.SCALE_BITS
+        return result
+
+    def filter(self, pixels):
+        if self.halo == 0:
+            return pixels.copy()
+
+        values = self._convolve_axis(pixels.astype(np.uint16), axis=1)
+        values = self._convolve_axis(values, axis=0)
+        return values.astype(np.uint8)
+
+
+class RingKernel(SpatialFilter):
+    """A 3x3 ImageFilter kernel with one weight for all eight neighbours"""
+
+    halo = 1
+
+    def __init__(self, centre, neighbour, divisor):
+        # centre * x + neighbour * (box - x), in integers that fit int16
+        self.centre = centre - neighbour
+        self.neighbour = neighbour
+        self.divisor = divisor
+
+    def filter(self, pixels):
+        if pixels.shape[0] < 3 or pixels.shape[1] < 3:
+            return pixels.copy()
+
+        values = pixels.astype(np.int16)
+        # 3x3 box sum, separably
+        rows = values[:, :-2] + values[:, 1:-1]
+        rows += values[:, 2:]
+        box = rows[:-2] + rows[1:-1]
+        box += rows[2:]
+
+        box *= self.neighbour
+        box += self.centre * values[1:-1, 1:-1]
+        if self.divisor > 1:
+            box += self.divisor // 2
+            box //= self.divisor
+        np.clip(box, 0, 255, out=box)
+
+        # PIL leaves the outermost ring of pixels untouched
+        result = pixels.copy()
+        result[1:-1, 1:-1] = box
+        return result
+
+
+class CompiledFilter:
+    """A style pipeline compiled into a short list of fused stages"""
+
+    def __init__(self, style, stages):
+        self.style = style
+        self.stages = stages
+        self.halo = sum(stage.halo for stage in stages)
+
+    def __call__(self, img):
+        """Apply the style to a PIL image and return a new RGB image"""
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return self._run(img, self.stages)
+
+    def _run(self, img, stages, histograms=None):
+        """Run stages on img; histograms maps stage index to precomputed stats"""
+        histograms = histograms or {}
+        for index, stage in enumerate(stages):
+            if index in histograms:
+                img = stage.apply(img, histograms[index])
+            else:
+                img = stage.apply(img)
+
+        if stages is self.stages and img.mode != 'RGB':
+            img = img.convert('RGB')
+        return img
+
+    def apply_tiled(self, img, tile_rows=256):
+        """
+        Apply the style to a full-resolution RGB image, in place
+
+        The image is processed in horizontal strips, each read with a halo
+        of extra rows covering the reach of the spatial stages, so the
+        working set is a few strips rather than several full-size
+        intermediates. Global statistics (the contrast means) are gathered
+        in a first pass over the same strips. The result is bit-identical
+        to calling the filter on the whole image.
+        """
+        if img.mode != 'RGB':
+            raise ValueError("apply_tiled works in place on RGB images")
+
+        # Each strip's top halo is read before the previous strip is written back
+        tile_rows = max(tile_rows, self.halo, 1)
+        histograms = self._collect_histograms(img, tile_rows)
+
+        pending = None
+        for top, bottom, above, below in self._strips(img.height, tile_rows, self.halo):
+            source = img.crop((0, above, img.width, below))
+            if pending:
+                img.paste(*pending)
+
+            result = self._run(source, self.stages, histograms)
+            core = result.crop((0, top - above, img.width, bottom - above))
+            pending = (core, (0, top))
+
+        if pending:
+            img.paste(*pending)
+        return img
+
+    def _collect_histograms(self, img, tile_rows):
+        """Full-image histograms for every table stage that needs one, strip by strip"""
+        histograms = {}
+        for index, stage in enumerate(self.stages):
+            if not getattr(stage, 'needs_histogram', False):
+                continue
+
+            prefix = self.stages[:index]
+            halo = sum(prior.halo for prior in prefix)
+            total = None
+            for top, bottom, above, below in self._strips(img.height, tile_rows, halo):
+                source = img.crop((0, above, img.width, below))
+                result = self._run(source, prefix, histograms)
+                core = result.crop((0, top - above, img.width, bottom - above))
+                counts = PointTable.histogram(core)
+                total = counts if total is None else total + counts
+            histograms[index] = total
+        return histograms
+
+    @staticmethod
+    def _strips(height, tile_rows, halo):
+        """(top, bottom, above, below) for each strip: core rows and halo-extended rows"""
+        for top in range(0, height, tile_rows):
+            bottom = min(top + tile_rows, height)
+            yield top, bottom, max(top - halo, 0), min(bottom + halo, height)
+
+
+def compile_operations(style, operations):
+    """Turn a list of filter operations into fused stages"""
+    stages = []
+    point_run = []
+
+    def flush_point_run():
+        if point_run:
+            stages.append(PointTable(list(point_run)))
+            point_run.clear()
+
+    for op in operations:
+        name = op[0]
+        if name in POINT_OPERATIONS:
+            point_run.append(op)
+            continue
+
+        flush_point_run()
+        if name == 'color':
+            stages.append(ColourBlend(op[1]))
+        elif name == 'grayscale':
+            stages.append(Grayscale())
+        elif name == 'blur':
+            stages.append(GaussianBlur(op[1]))
+        elif name in RING_KERNELS:
+            stages.append(RingKernel(*RING_KERNELS[name]))
+        else:
+            raise ValueError(f"Unknown filter operation: {name}")
+
+    flush_point_run()
+    return CompiledFilter(style, stages)
+
+
+_compiled_styles = {}
+
+
+def get_compiled_filter(style):
+    """Compiled pipeline for a style, falling back to ghibli like the processor does"""
+    if style not in STYLE_OPERATIONS:
+        style = 'ghibli'
+    if style not in _compiled_styles:
+        _compiled_styles[style] = compile_operations(style, STYLE_OPERATIONS[style])
+    return _compiled_styles[style]
+
+
+def apply_style(img, style):
+    """Apply a style filter to a PIL image and return a new RGB image"""
+    return get_compiled_filter(style)(img)
+
+
+def apply_style_tiled(img, style, tile_rows=256):
+    """Apply a style filter to a full-resolution RGB image in place, strip by strip"""
+    return get_compiled_filter(style).apply_tiled(img, tile_rows)
@@ -0,0 +1,120 @@
+"""
+Concurrent Replicate FLUX client
+Runs predictions on a background asyncio loop, keeping a bounded number in
+flight per process instead of blocking a worker for each one
+"""
+
+import asyncio
+import threading
+
+import replicate
+from replicate.exceptions import ModelError
+
+from .downloads import download
+from .image_io import open_encoded
+
+
+class AsyncFluxClient:
+    """
+    Keeps up to max_in_flight FLUX predictions running at once
+
+    Coroutines run on one event loop in a daemon thread, so synchronous
+    callers (views, the batch executor, Celery tasks) get ordinary
+    concurrent.futures.Future objects back from submit().
+    """
+
+    # Text-to-image model used when the image-to-image model rejects an input
+    FALLBACK_MODEL = "black-forest-labs/flux-schnell"
+
+    def __init__(self, api_token, model, max_in_flight=16, timeout=120):
+        self.client = replicate.Client(api_token=api_token)
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.loop = None
+        self.semaphore = None
+        self.lock = threading.Lock()
+
+    def _ensure_loop(self):
+        with self.lock:
+            if self.loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name='flux-client', daemon=True)
+                thread.start()
+                self.semaphore = asyncio.Semaphore(self.max_in_flight)
+                self.loop = loop
+        return self.loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the client loop; returns a concurrent Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def create_prediction(self, input_image, prompt, webhook_url):
+        """Start a prediction that reports back to webhook_url instead of being waited on"""
+        return self.client.predictions.create(
+            model=self.model,
+            input={
+                "prompt": prompt,
+                "input_image": input_image,
+                "output_format": "jpg"
+            },
+            webhook=webhook_url,
+            webhook_events_filter=["completed"]
+        )
+
+    async def convert(self, input_image, prompt):
+        """
+        One image-to-image prediction, bounded by the in-flight window and the timeout
+
+        input_image is an open file or buffer holding the encoded upload
+        """
+        async with self.semaphore:
+            return await asyncio.wait_for(self._predict(input_image, prompt), self.timeout)
+
+    async def _predict(self, input_image, prompt):
+        try:
+            output = await self.client.async_run(
+                self.model,
+                input={
+                    "prompt": prompt,
+                    "input_image": input_image,
+                    "output_format": "jpg"
+                }
+            )
+        except ModelError as e:
+            # The model rejected this input - outages and timeouts are not
+            # retried here, they would only double the failure latency
+            print(f"⚠️ Image-to-image failed, trying alternative method: {e}")
+            output = await self.client.async_run(
+                self.FALLBACK_MODEL,
+                input={
+                    "prompt": f"{prompt}, based on the style of the uploaded image",
+                    "width": 512,
+                    "height": 512,
+                    "num_outputs": 1,
+                    "output_format": "jpg"
+                }
+            )
+
+        return open_encoded(await self._read_output(output))
+
+    async def _read_output(self, output):
+        """
+        FLUX returns a file-like object, a URL, or a list of either
+
+        Outputs with a URL are streamed to a spooled file by the pooled,
+        retrying downloader, in a thread so the loop keeps serving the
+        other predictions; returns that file or the bytes read.
+        """
+        if isinstance(output, list) and len(output) > 0:
+            output = output[0]
+
+        url = getattr(output, 'url', output)
+        if isinstance(url, str) and url.startswith('http'):
+            return await asyncio.to_thread(download, url, self.timeout)
+        if hasattr(output, 'aread'):
+            # Inline data: URLs
+            return await output.aread()
+
+        print(f"❌ Unexpected output format: {output}")
+        raise Exception("Unexpected output format from FLUX")
@@ -4,9 +4,18 @@ Handles image upload and artwork creation
 """
 
 from django import forms
-from .models import GhibliArtwork
+from .models import CONVERSION_METHODS, GhibliArtwork
 
 class ArtworkUploadForm(forms.ModelForm):
+    # Converted from the same decoded original as conversion_method
+    extra_styles = forms.MultipleChoiceField(
+        choices=CONVERSION_METHODS,
+        required=False,
+        widget=forms.CheckboxSelectMultiple(attrs={'class': 'form-check-input'}),
+        label='Also Convert To',
+        help_text='Compare styles side by side - the image is uploaded and decoded only once'
+    )
+    
     class Meta:
         model = GhibliArtwork
         fields = ['name', 'original_image', 'conversion_method']
@@ -59,35 +68,26 @@ class ArtworkUploadForm(forms.ModelForm):
             # Check minimum dimensions
             try:
                 from PIL import Image
-                import tempfile
                 
-                # Save temporarily to check dimensions
-                with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                    for chunk in image.chunks():
-                        temp_file.write(chunk)
-                    temp_file.flush()
-                    
-                    # Open with PIL to check dimensions
-                    with Image.open(temp_file.name) as pil_image:
-                        width, height = pil_image.size
-                        
-                        # Minimum size check
-                        if width < 256 or height < 256:
-                            raise forms.ValidationError(
-                                f"Image too small ({width}x{height}). "
-                                f"Minimum size is 256x256 pixels."
-                            )
-                        
-                        # Maximum size check
-                        if width > 4096 or height > 4096:
-                            raise forms.ValidationError(
-                                f"Image too large ({width}x{height}). "
-                                f"Maximum size is 4096x4096 pixels."
-                            )
+                # Only the header is read, straight from the upload
+                image.seek(0)
+                with Image.open(image) as pil_image:
+                    width, height = pil_image.size
+                image.seek(0)
+                
+                # Minimum size check
+                if width < 256 or height < 256:
+                    raise forms.ValidationError(
+                        f"Image too small ({width}x{height}). "
+                        f"Minimum size is 256x256 pixels."
+                    )
                 
-                # Clean up temp file
-                import os
-                os.unlink(temp_file.name)
+                # Maximum size check
+                if width > 4096 or height > 4096:
+                    raise forms.ValidationError(
+                        f"Image too large ({width}x{height}). "
+                        f"Maximum size is 4096x4096 pixels."
+                    )
                 
             except Exception as e:
                 # If we can't process the image, let it through
@@ -161,13 +161,15 @@ class QuickUploadForm(forms.Form):
 
 # Add this to the END of your existing gallery/forms.py
 
+from django.conf import settings
 from .models import BatchUpload
+from .zip_manifest import build_manifest, valid_entries
 import zipfile
 
 class BatchUploadForm(forms.ModelForm):
     class Meta:
         model = BatchUpload
-        fields = ['name', 'zip_file', 'conversion_method']
+        fields = ['name', 'zip_file', 'conversion_method', 'max_concurrency']
         widgets = {
             'name': forms.TextInput(attrs={
                 'class': 'form-control',
@@ -181,17 +183,23 @@ class BatchUploadForm(forms.ModelForm):
             }),
             'conversion_method': forms.Select(attrs={
                 'class': 'form-control'
+            }),
+            'max_concurrency': forms.NumberInput(attrs={
+                'class': 'form-control',
+                'min': 1
             })
         }
         labels = {
             'name': 'Batch Name',
             'zip_file': 'ZIP File',
-            'conversion_method': 'Style for All Images'
+            'conversion_method': 'Style for All Images',
+            'max_concurrency': 'Images at Once'
         }
         help_texts = {
             'name': 'Give your batch a descriptive name',
             'zip_file': 'ZIP file containing JPEG, PNG, or WebP images. Maximum 100MB.',
-            'conversion_method': 'All images in the batch will use this style'
+            'conversion_method': 'All images in the batch will use this style',
+            'max_concurrency': 'How many images of this batch are converted at the same time (optional)'
         }
     
     def clean_zip_file(self):
@@ -207,46 +215,47 @@ class BatchUploadForm(forms.ModelForm):
                     f"Maximum allowed size is 100MB."
                 )
             
-            # Check if it's a valid ZIP file
+            # One pass over the archive - the manifest is kept on the batch
+            # so processing never has to scan it again
             try:
-                with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-                    file_list = zip_ref.namelist()
-                    
-                    # Check for valid image files
-                    valid_extensions = ['.jpg', '.jpeg', '.png', '.webp']
-                    image_files = []
-                    
-                    for filename in file_list:
-                        # Skip directories and hidden files
-                        if filename.endswith('/') or filename.startswith('.'):
-                            continue
-                        
-                        # Check file extension
-                        file_ext = '.' + filename.lower().split('.')[-1]
-                        if file_ext in valid_extensions:
-                            image_files.append(filename)
-                    
-                    if len(image_files) == 0:
-                        raise forms.ValidationError(
-                            "No valid image files found in ZIP. "
-                            "Please include JPEG, PNG, or WebP files."
-                        )
-                    
-                    if len(image_files) > 10:  # Limit batch size for testing
-                        raise forms.ValidationError(
-                            f"Too many images ({len(image_files)}). "
-                            f"Maximum 10 images per batch for now."
-                        )
-                    
-                    print(f"✅ Valid ZIP with {len(image_files)} images")
-                    
+                manifest = build_manifest(zip_file)
             except zipfile.BadZipFile:
                 raise forms.ValidationError("Invalid ZIP file. Please upload a valid ZIP archive.")
             except Exception as e:
                 raise forms.ValidationError(f"Error reading ZIP file: {str(e)}")
+            
+            image_count = len(valid_entries(manifest))
+            if image_count == 0:
+                raise forms.ValidationError(
+                    "No valid image files found in ZIP. "
+                    "Please include JPEG, PNG, or WebP files."
+                )
+            
+            if image_count > settings.BATCH_MAX_IMAGES:
+                raise forms.ValidationError(
+                    f"Too many images ({image_count}). "
+                    f"Maximum {settings.BATCH_MAX_IMAGES} images per batch."
+                )
+            
+            print(f"✅ Valid ZIP with {image_count} images")
+            self.instance.manifest = manifest
         
         return zip_file
     
+    def clean_max_concurrency(self):
+        """One batch may not take more than the configured share of the workers"""
+        max_concurrency = self.cleaned_data.get('max_concurrency')
+        
+        if max_concurrency is not None:
+            if max_concurrency < 1:
+                raise forms.ValidationError("Convert at least 1 image at a time.")
+            if max_concurrency > settings.BATCH_MAX_CONCURRENCY:
+                raise forms.ValidationError(
+                    f"At most {settings.BATCH_MAX_CONCURRENCY} images of a batch can be converted at once."
+                )
+        
+        return max_concurrency
+    
     def clean_name(self):
         """Validate batch name"""
         name = self.cleaned_data.get('name')
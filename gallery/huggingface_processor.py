@@ -3,154 +3,480 @@ Working Replicate Processor using FLUX models
 Based on the working example from Replicate documentation
 """
 
-import replicate
-import requests
-from PIL import Image
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from io import BytesIO
+from PIL import Image
 from django.conf import settings
-import time
-import os
+from django.core.cache import cache as django_cache
+from .circuit_breaker import CircuitBreaker
+from .image_io import encode_result, open_encoded, open_for_size, passthrough_jpeg, prepare_upload
+from .result_cache import ResultCache, image_digest, result_key
+
+# filter_engine (numpy) and flux_client (replicate, httpx) are imported on
+# first use - web workers that never convert anything never load them
 
 class HuggingFaceProcessor:
+    # Image-to-image model behind the AI path - part of the result cache key
+    FLUX_MODEL = "black-forest-labs/flux-kontext-pro"
+
+    # What the filters run on unless FILTER_FULL_RESOLUTION is set
+    FILTER_SIZE = (512, 512)
+
+    STYLE_PROMPTS = {
+        'ghibli': "Make this a Studio Ghibli anime style artwork, magical atmosphere, hand-drawn animation style, detailed, beautiful",
+        'anime': "Make this an anime style artwork, vibrant colors, detailed anime art",
+        'cartoon': "Make this a 90s cartoon style artwork, bold colors, cartoon illustration",
+        'sketch': "Make this a pencil sketch artwork, black and white drawing, artistic sketch",
+        'vibrant': "Make this artwork with vibrant enhanced colors, colorful, bright, saturated"
+    }
+
     def __init__(self):
         self.api_token = getattr(settings, 'REPLICATE_API_TOKEN', '')
+        self._flux_client = None
+        self.flux_breaker = CircuitBreaker(
+            'flux',
+            failure_threshold=getattr(settings, 'FLUX_BREAKER_FAILURES', 5),
+            reset_timeout=getattr(settings, 'FLUX_BREAKER_RESET_TIMEOUT', 60),
+        )
+        self.cache = ResultCache(
+            getattr(settings, 'RESULT_CACHE_DIR', settings.BASE_DIR / 'result_cache'),
+            getattr(settings, 'RESULT_CACHE_MAX_BYTES', 512 * 1024 * 1024),
+            getattr(settings, 'RESULT_CACHE_HOT_ENTRIES', 32),
+            getattr(settings, 'RESULT_CACHE_LOW_WATER', 0.9),
+            # The web process reads the workers' counters from here
+            shared=django_cache,
+        )
         
         if self.api_token:
-            os.environ["REPLICATE_API_TOKEN"] = self.api_token
             print(f"🤖 Replicate AI ready - using FLUX models!")
             self.use_ai = True
         else:
             print("⚠️ No Replicate API token - using filters")
             self.use_ai = False
     
-    def convert_to_ghibli(self, image_path, prompt, model_name='ghibli'):
-        """Convert using Replicate FLUX models"""
+    def convert_to_ghibli(self, image_path, prompt, model_name='ghibli', hedge=False, on_late_result=None):
+        """
+        Convert using Replicate FLUX models
+
+        image_path can also be anything decode_input takes - encoded bytes,
+        a memoryview or an image that is already decoded.
+
+        With hedge, FLUX only gets the style's deadline (flux_deadline): a
+        filter result made while FLUX works is returned instead, with
+        deadline_fallback set on it. The late FLUX result is still cached,
+        and passed to on_late_result when it arrives.
+        """
         
-        if self.use_ai:
-            return self._convert_with_flux(image_path, model_name, prompt)
+        img = self.decode_input(image_path)
+        key = self.result_key(img, model_name)
+        cached = self.get_cached_result(key)
+        if cached is not None:
+            return cached
+
+        return self.convert_uncached(image_path, prompt, model_name, img, key, hedge, on_late_result)
+
+    def convert_image(self, source, style='ghibli', prompt=None):
+        """
+        In-memory conversion: decoded image or encoded buffer in, JPEG bytes out
+
+        Nothing is written to disk on the way; a JPEG from FLUX or the
+        cache is handed back without being re-encoded.
+        """
+        if prompt is None:
+            prompt = self.style_prompt(style)
+        return encode_result(self.convert_to_ghibli(source, prompt, style))
+
+    def convert_uncached(self, source, prompt, style, img, key, hedge=False, on_late_result=None):
+        """Convert a decoded input after a cache miss and store the result under key"""
+        if not self.use_ai:
+            result = self._convert_with_filters(source, style, img)
+            self.cache_result(key, result)
+            return result
+
+        if not self.flux_breaker.allow_request():
+            print("⚡ FLUX circuit open - going straight to enhanced filters")
+            return self.convert_with_filters(source, style, img)
+
+        deadline = self.flux_deadline(style) if hedge else None
+        try:
+            result = self._convert_with_flux(source, style, prompt, img, deadline, key, on_late_result)
+        except Exception as e:
+            self.flux_breaker.record_failure()
+            print(f"❌ FLUX error: {e}")
+            print("🔄 Falling back to enhanced filters...")
+            return self.convert_with_filters(source, style, img)
+
+        if getattr(result, 'deadline_fallback', False):
+            # FLUX is slow, not failing - the breaker hears about it when it finishes
+            return result
+        self.flux_breaker.record_success()
+        self.cache_result(key, result)
+        return result
+
+    def convert_with_filters(self, source, style, img=None):
+        """Filter conversion through the result cache - the fallback when FLUX fails"""
+        if img is None:
+            img = self.decode_input(source)
+        # Cached under the filter key, never as a FLUX result
+        key = self.result_key(img, style, use_ai=False)
+        cached = self.get_cached_result(key)
+        if cached is not None:
+            return cached
+
+        result = self._convert_with_filters(source, style, img)
+        self.cache_result(key, result)
+        return result
+
+    def style_prompt(self, style):
+        """The prompt FLUX actually receives for a style"""
+        return self.STYLE_PROMPTS.get(style, self.STYLE_PROMPTS['ghibli'])
+
+    def result_key(self, img, style, use_ai=None):
+        """Result cache key for converting a decoded input with the given backend"""
+        if use_ai is None:
+            use_ai = self.use_ai
+        if use_ai:
+            # The upload size changes what FLUX sees, so it is part of the backend
+            backend = f"{self.FLUX_MODEL}@{self.flux_input_max_side}"
+            return result_key(image_digest(img), style, self.style_prompt(style), backend)
+
+        from . import filter_engine
+
+        # The filters ignore the prompt; full-resolution and 512x512 output differ
+        size = 'full' if self.filter_tile_rows is not None else '512'
+        backend = f"filters-v{filter_engine.ENGINE_VERSION}-{size}"
+        return result_key(image_digest(img), style, None, backend)
+
+    def get_cached_result(self, key):
+        data = self.cache.get(key)
+        if data is None:
+            return None
+        print("⚡ Using cached conversion result")
+        return open_encoded(data)
+
+    def cache_result(self, key, img):
+        source = passthrough_jpeg(img)
+        if source is not None and not isinstance(source, BytesIO):
+            # A downloaded result is copied from its spool, never read into memory
+            self.cache.put_file(key, source)
+            source.seek(0)
         else:
-            return self._convert_with_filters(image_path, model_name)
+            self.cache.put(key, encode_result(img))
     
-    def _convert_with_flux(self, image_path, style, prompt):
-        """Real AI conversion using FLUX models"""
+    @property
+    def flux_client(self):
+        """Concurrent FLUX client, created on first use"""
+        if self._flux_client is None:
+            from .flux_client import AsyncFluxClient
+
+            self._flux_client = AsyncFluxClient(
+                self.api_token,
+                self.FLUX_MODEL,
+                max_in_flight=getattr(settings, 'FLUX_MAX_IN_FLIGHT', 16),
+                timeout=getattr(settings, 'FLUX_TIMEOUT', 120),
+            )
+        return self._flux_client
+
+    def prepare_flux_input(self, img):
+        """Decoded input downscaled to FLUX's working size and encoded for upload"""
+        return prepare_upload(
+            img,
+            max_side=self.flux_input_max_side,
+            quality=getattr(settings, 'FLUX_INPUT_QUALITY', 90),
+            max_bytes=getattr(settings, 'FLUX_INPUT_MAX_BYTES', 1024 * 1024),
+        )
+
+    @property
+    def flux_input_max_side(self):
+        return getattr(settings, 'FLUX_INPUT_MAX_SIDE', 1024)
+
+    def flux_deadline(self, style):
+        """Seconds FLUX gets for a hedged conversion of style, or None for no deadline"""
+        deadlines = getattr(settings, 'FLUX_STYLE_DEADLINES', {})
+        return deadlines.get(style, getattr(settings, 'FLUX_DEADLINE', 0)) or None
+
+    def _convert_with_flux(self, source, style, prompt, img=None, deadline=None, key=None, on_late_result=None):
+        """
+        Real AI conversion using FLUX models - raises if the conversion fails
+
+        With a deadline, the filter result is made while the prediction runs
+        and returned, marked deadline_fallback, if FLUX has not finished in
+        time; the prediction is left to finish in the background.
+        """
         print(f"🤖 Using FLUX AI for {style} style...")
         print(f"🎯 Converting: {prompt}")
         
+        final_prompt = self.style_prompt(style)
+        print(f"📝 Using prompt: {final_prompt}")
+        
+        if img is None:
+            img = self.decode_input(source)
+        input_image = self.prepare_flux_input(img)
+        print(f"📦 Uploading {input_image.getbuffer().nbytes // 1024} KB input")
+        
+        print("📡 Calling FLUX model...")
+        started = time.monotonic()
+        future = self.flux_client.submit(self.flux_client.convert(input_image, final_prompt))
+        if deadline is None:
+            image = future.result()
+        else:
+            # Speculative: costs milliseconds of CPU, and FLUX runs meanwhile.
+            # Full-resolution filtering works in place, so the hedge gets its
+            # own frame and a failing FLUX still falls back from clean pixels
+            hedge_input = img.copy() if self.filter_tile_rows is not None else img
+            hedge = self.convert_with_filters(source, style, hedge_input)
+            try:
+                image = future.result(timeout=max(0, deadline - (time.monotonic() - started)))
+            except TimeoutError:
+                if future.done():
+                    # The prediction's own timeout, not the deadline
+                    raise
+                print(f"⏱️ FLUX missed its {deadline}s deadline - serving the filter result")
+                future.add_done_callback(lambda f: threading.Thread(
+                    target=self._finish_late_flux, args=(f, key, on_late_result), daemon=True
+                ).start())
+                hedge.deadline_fallback = True
+                return hedge
+        
+        print("✅ FLUX AI conversion successful!")
+        return image
+
+    def _finish_late_flux(self, future, key, on_late_result):
+        """A prediction that missed its deadline has finished: cache it and hand it on"""
         try:
-            # First, upload the image to get a URL (Replicate needs URLs)
-            with open(image_path, 'rb') as f:
-                image_data = f.read()
-            
-            # Create style-specific prompts
-            style_prompts = {
-                'ghibli': f"Make this a Studio Ghibli anime style artwork, magical atmosphere, hand-drawn animation style, detailed, beautiful",
-                'anime': f"Make this an anime style artwork, vibrant colors, detailed anime art",
-                'cartoon': f"Make this a 90s cartoon style artwork, bold colors, cartoon illustration",
-                'sketch': f"Make this a pencil sketch artwork, black and white drawing, artistic sketch",
-                'vibrant': f"Make this artwork with vibrant enhanced colors, colorful, bright, saturated"
-            }
-            
-            final_prompt = style_prompts.get(style, style_prompts['ghibli'])
-            print(f"📝 Using prompt: {final_prompt}")
-            
-            # Use the working FLUX model
-            input_data = {
-                "prompt": final_prompt,
-                "output_format": "jpg"
-            }
-            
-            # For image-to-image, we need to provide the image
-            # Since we have a local file, let's convert it to base64 or use a file upload
-            
-            print("📡 Calling FLUX model...")
-            
-            # Method 1: Try with file upload
+            image = future.result()
+        except Exception as e:
+            self.flux_breaker.record_failure()
+            print(f"❌ Late FLUX result failed: {e}")
+            return
+
+        self.flux_breaker.record_success()
+        print("✅ Late FLUX result arrived")
+        self.cache_result(key, image)
+        if on_late_result is not None:
             try:
-                output = replicate.run(
-                    "black-forest-labs/flux-kontext-pro",
-                    input={
-                        "prompt": final_prompt,
-                        "input_image": open(image_path, "rb"),
-                        "output_format": "jpg"
-                    }
-                )
-            except Exception as e1:
-                print(f"⚠️ File upload failed, trying alternative method: {e1}")
-                
-                # Method 2: Try text-to-image if image upload fails
-                output = replicate.run(
-                    "black-forest-labs/flux-schnell",
-                    input={
-                        "prompt": f"{final_prompt}, based on the style of the uploaded image",
-                        "width": 512,
-                        "height": 512,
-                        "num_outputs": 1,
-                        "output_format": "jpg"
-                    }
-                )
-            
-            print(f"📊 FLUX output type: {type(output)}")
-            print(f"📄 Output: {output}")
-            
-            # Handle the output - FLUX returns a file-like object or URL
-            if hasattr(output, 'read'):
-                # It's a file-like object
-                print("📥 Reading file object...")
-                image_data = output.read()
-                image = Image.open(BytesIO(image_data))
-            elif isinstance(output, str) and output.startswith('http'):
-                # It's a URL
-                print(f"📥 Downloading from URL: {output}")
-                response = requests.get(output, timeout=60)
-                if response.status_code == 200:
-                    image = Image.open(BytesIO(response.content))
-                else:
-                    raise Exception(f"Download failed: {response.status_code}")
-            elif isinstance(output, list) and len(output) > 0:
-                # It's a list of URLs
-                image_url = output[0]
-                print(f"📥 Downloading from list URL: {image_url}")
-                response = requests.get(image_url, timeout=60)
-                if response.status_code == 200:
-                    image = Image.open(BytesIO(response.content))
-                else:
-                    raise Exception(f"Download failed: {response.status_code}")
-            else:
-                print(f"❌ Unexpected output format: {output}")
-                raise Exception("Unexpected output format from FLUX")
-            
-            print("✅ FLUX AI conversion successful!")
-            return image
-            
+                on_late_result(image)
+            except Exception as e:
+                print(f"❌ Could not use the late FLUX result: {e}")
+
+    async def _convert_uncached_async(self, source, prompt, style, img, key):
+        """convert_uncached for the FLUX client loop - the request itself never blocks a thread"""
+        if not self.flux_breaker.allow_request():
+            print("⚡ FLUX circuit open - going straight to enhanced filters")
+            return await asyncio.to_thread(self.convert_with_filters, source, style, img)
+
+        try:
+            print(f"🤖 Using FLUX AI for {style} style...")
+            input_image = await asyncio.to_thread(self.prepare_flux_input, img)
+            result = await self.flux_client.convert(input_image, self.style_prompt(style))
         except Exception as e:
+            self.flux_breaker.record_failure()
             print(f"❌ FLUX error: {e}")
             print("🔄 Falling back to enhanced filters...")
-            return self._convert_with_filters(image_path, style)
+            return await asyncio.to_thread(self.convert_with_filters, source, style, img)
+
+        self.flux_breaker.record_success()
+        await asyncio.to_thread(self.cache_result, key, result)
+        return result
+
+    def submit_conversion(self, source, prompt, style, img, key):
+        """
+        Start converting a decoded input after a cache miss
+
+        Returns a concurrent Future; with FLUX the prediction runs on the
+        client loop alongside any others in flight.
+        """
+        if self.use_ai:
+            return self.flux_client.submit(self._convert_uncached_async(source, prompt, style, img, key))
+
+        future = Future()
+        try:
+            future.set_result(self.convert_uncached(source, prompt, style, img, key))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def convert_many(self, sources, style, prompt=None):
+        """
+        Convert several inputs to one style, with all FLUX requests in flight together
+
+        Filter conversions run in parallel threads instead - PIL and NumPy
+        release the GIL. Returns (image, error) pairs in input order; a
+        failing item only fails itself.
+        """
+        if not sources:
+            return []
+        if prompt is None:
+            prompt = self.style_prompt(style)
+        if not self.use_ai:
+            with ThreadPoolExecutor(max_workers=min(len(sources), self.filter_threads)) as pool:
+                return _gather([pool.submit(self.convert_to_ghibli, source, prompt, style) for source in sources])
+
+        futures = []
+        for source in sources:
+            future = Future()
+            try:
+                img = self.decode_input(source)
+                key = self.result_key(img, style)
+                cached = self.get_cached_result(key)
+                if cached is not None:
+                    future.set_result(cached)
+                else:
+                    future = self.submit_conversion(source, prompt, style, img, key)
+            except Exception as e:
+                future.set_exception(e)
+            futures.append(future)
+        return _gather(futures)
+
+    def convert_styles(self, source, styles, prompt=None, hedge=False, on_late_result=None):
+        """
+        Convert one input to several styles, decoding and resizing it once
+
+        Every style starts from the same decoded image: filter styles run
+        in parallel threads off one resized copy, FLUX styles are in flight
+        together. With hedge, each FLUX style only gets its own deadline, as
+        in convert_to_ghibli; on_late_result is then called with the style
+        and its late FLUX result. Returns (image, error) pairs in style order.
+        """
+        img = self.decode_input(source)
+        if hedge and self.use_ai:
+            # One thread per style waits out that style's deadline
+            with ThreadPoolExecutor(max_workers=len(styles)) as pool:
+                futures = [
+                    pool.submit(
+                        self.convert_to_ghibli, img, prompt or self.style_prompt(style), style, True,
+                        partial(on_late_result, style) if on_late_result else None
+                    )
+                    for style in styles
+                ]
+            return _gather(futures)
+
+        # Full-resolution filtering works in place, so each style gets its own frame
+        separate_frames = self.filter_tile_rows is not None
+        filter_input = None
+        pool = None
+        futures = []
+        try:
+            for style in styles:
+                future = Future()
+                try:
+                    key = self.result_key(img, style)
+                    cached = self.get_cached_result(key)
+                    if cached is not None:
+                        future.set_result(cached)
+                    elif self.use_ai:
+                        future = self.submit_conversion(
+                            source, prompt or self.style_prompt(style), style,
+                            img.copy() if separate_frames else img, key
+                        )
+                    else:
+                        if pool is None:
+                            filter_input = self.fit_filter_input(img)
+                            pool = ThreadPoolExecutor(max_workers=min(len(styles), self.filter_threads))
+                        base = filter_input.copy() if separate_frames else filter_input
+                        future = pool.submit(self._filter_style, base, style, key)
+                except Exception as e:
+                    future.set_exception(e)
+                futures.append(future)
+            return _gather(futures)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def render_previews(self, source, styles, max_side=256):
+        """
+        Filter renderings of at most max_side pixels, one per style
+
+        Cheap enough to make while the upload request waits: the input is
+        decoded at reduced size once and never cached. Returns JPEG bytes
+        in style order.
+        """
+        from . import filter_engine
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        img = open_for_size(source, max_side=max_side)
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        return [encode_result(filter_engine.apply_style(img, style)) for style in styles]
+
+    def _filter_style(self, filter_input, style, key):
+        """One style of convert_styles, from the shared filter input"""
+        print(f"🎨 Using enhanced {style} filters...")
+        result = self.apply_filters(filter_input, style)
+        self.cache_result(key, result)
+        return result
     
-    def _convert_with_filters(self, image_path, style):
+    def _convert_with_filters(self, source, style, img=None):
         """Enhanced filter fallback"""
         print(f"🎨 Using enhanced {style} filters...")
         
-        time.sleep(2)
-        
-        with Image.open(image_path) as img:
-            if img.mode != 'RGB':
-                img = img.convert('RGB')
-            img = img.resize((512, 512), Image.Resampling.LANCZOS)
-            
-            if style == 'ghibli':
-                return self._ghibli_filter(img)
-            elif style == 'anime':
-                return self._anime_filter(img)
-            elif style == 'cartoon':
-                return self._cartoon_filter(img)
-            elif style == 'sketch':
-                return self._sketch_filter(img)
-            elif style == 'vibrant':
-                return self._vibrant_filter(img)
-            else:
-                return self._ghibli_filter(img)
-    
+        if img is None:
+            img = self.decode_input(source)
+        return self.apply_filters(self.fit_filter_input(img), style)
+
+    @property
+    def filter_tile_rows(self):
+        """Strip height for full-resolution filtering, None for the 512x512 copy"""
+        if getattr(settings, 'FILTER_FULL_RESOLUTION', False):
+            return getattr(settings, 'FILTER_TILE_ROWS', 256)
+        return None
+
+    @property
+    def filter_threads(self):
+        """Filter conversions run at once by convert_many and convert_styles"""
+        return getattr(settings, 'FILTER_THREADS', 0) or os.cpu_count() or 1
+
+    def decode_input(self, source):
+        """
+        Decode an input image once, as RGB and no larger than the conversion needs
+
+        source is a path, an open file, encoded bytes (bytes, bytearray or
+        memoryview) or a decoded image, which is used as it is - or copied,
+        when full-resolution filtering would work on it in place.
+        """
+        if isinstance(source, Image.Image):
+            source.load()
+            if source.mode != 'RGB':
+                return source.convert('RGB')
+            # The caller's image is theirs: never filter it in place
+            return source.copy() if self.filter_tile_rows is not None else source
+
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = BytesIO(source)
+        if self.filter_tile_rows is not None:
+            # Full-resolution filtering needs every pixel
+            return open_for_size(source)
+        # Large enough for the filters' 512x512 copy and, with FLUX, the upload
+        max_side = self.flux_input_max_side if self.use_ai else None
+        return open_for_size(source, size=self.FILTER_SIZE, max_side=max_side)
+
+    def fit_filter_input(self, img):
+        """Bring a decoded input to the size the filters run at"""
+        if self.filter_tile_rows is None:
+            return img.resize(self.FILTER_SIZE, Image.Resampling.LANCZOS)
+        print(f"🧩 Full-resolution filter input: {img.width}x{img.height}")
+        return img
+
+    def apply_filters(self, img, style):
+        """Run the compiled version of the _<style>_filter methods below"""
+        from . import filter_engine
+
+        tile_rows = self.filter_tile_rows
+        if tile_rows is None:
+            return filter_engine.apply_style(img, style)
+
+        # The strips are filtered back into the decoded frame, so the JPEG
+        # encoder reads the result straight from it
+        return filter_engine.apply_style_tiled(img, style, tile_rows)
+
+    # Reference filters - the compiled engine in filter_engine.py must
+    # stay pixel-equivalent to these
+
     def _ghibli_filter(self, img):
         """Enhanced Ghibli filter"""
         from PIL import ImageFilter, ImageEnhance, ImageOps
@@ -231,19 +557,49 @@ class HuggingFaceProcessor:
         return img
     
     def test_connection(self):
-        """Test Replicate FLUX connection"""
+        """Cheap health probe for Replicate FLUX - one account lookup, fed to the circuit breaker"""
         if self.use_ai:
             try:
-                # Simple test - try to list models
-                models = list(replicate.models.list())
+                self.flux_client.client.accounts.current()
                 print(f"✅ Replicate FLUX API working! Connected successfully")
+                self.flux_breaker.record_probe(True)
                 return True
             except Exception as e:
                 print(f"❌ Replicate API error: {e}")
+                self.flux_breaker.record_probe(False)
                 return False
         else:
             print("✅ Filter mode ready")
             return True
 
-# Create global processor instance
-processor = HuggingFaceProcessor()
\ No newline at end of file
+def _gather(futures):
+    """(result, error) pairs for futures, in order - a failure only fails its own item"""
+    results = []
+    for future in futures:
+        try:
+            results.append((future.result(), None))
+        except Exception as e:
+            results.append((None, e))
+    return results
+
+
+_processor = None
+_processor_lock = threading.Lock()
+
+
+def get_processor():
+    """The shared processor, built on first use rather than at import time"""
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = HuggingFaceProcessor()
+    return _processor
+
+
+def __getattr__(name):
+    # Old-style `from .huggingface_processor import processor` still works,
+    # it just builds the processor at that point
+    if name == 'processor':
+        return get_processor()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
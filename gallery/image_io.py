@@ -0,0 +1,127 @@
+"""
+Decoding and encoding helpers for conversion inputs and results
+Inputs are decoded no larger than they will be used; JPEG results from
+the provider or the cache are saved as they are, without a
+decode/re-encode round trip
+"""
+
+from io import BytesIO
+from math import ceil
+
+from PIL import ExifTags, Image, ImageOps
+from django.core.files import File
+from django.core.files.base import ContentFile
+
+# Encoder settings for results that do have to be encoded
+JPEG_QUALITY = 95
+
+
+def open_for_size(source, size=None, max_side=None):
+    """
+    Decode an image for use at a reduced size, as RGB
+
+    JPEGs are decoded straight at 1/2, 1/4 or 1/8 scale (draft mode) while
+    that still leaves at least size (width, height) pixels and, with
+    max_side, enough to be scaled down to fit max_side x max_side. Other
+    formats, and calls without either, are decoded at full size.
+    """
+    img = Image.open(source)
+    width, height = size or (1, 1)
+    if max_side is not None:
+        scale = min(1, max_side / max(img.width, img.height))
+        width = max(width, ceil(img.width * scale))
+        height = max(height, ceil(img.height * scale))
+    if size is not None or max_side is not None:
+        img.draft(None, (width, height))
+    # Not opened in a with-block: the image outlives source, and load()
+    # already lets go of it
+    img.load()
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return img
+
+
+def is_passthrough_jpeg(image):
+    """A JPEG the gallery can store unchanged: already the target format and mode"""
+    return image.format == 'JPEG' and image.mode == 'RGB'
+
+
+def open_encoded(source):
+    """
+    Open an encoded result - bytes, or a file such as a download spool
+
+    A JPEG keeps its encoding so saving can pass it through; Image.open
+    only reads the header, the pixels are decoded if and when needed.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = BytesIO(source)
+    image = Image.open(source)
+    if is_passthrough_jpeg(image):
+        image.encoded_jpeg = source
+    return image
+
+
+def passthrough_jpeg(image):
+    """
+    The rewound encoding an image was opened from, when it can be saved as is
+
+    Any change made in place decodes the image first, so only an image
+    that was never decoded is sure to still match its encoding.
+    """
+    source = getattr(image, 'encoded_jpeg', None)
+    if source is None or not getattr(image, 'tile', None):
+        return None
+    source.seek(0)
+    return source
+
+
+def encode_result(image):
+    """JPEG bytes for a result image, encoding only images that changed or were not JPEG already"""
+    source = passthrough_jpeg(image)
+    if source is not None:
+        return source.read()
+    output_buffer = BytesIO()
+    image.save(output_buffer, format='JPEG', quality=JPEG_QUALITY)
+    return output_buffer.getvalue()
+
+
+def converted_content(result):
+    """Storage content for a result - a downloaded file or an encoded buffer is stored unchanged"""
+    if hasattr(result, 'read'):
+        return File(result)
+    if isinstance(result, (bytes, bytearray, memoryview)):
+        return ContentFile(bytes(result))
+    source = passthrough_jpeg(result)
+    if source is not None:
+        return File(source)
+    return ContentFile(encode_result(result))
+
+
+def prepare_upload(img, max_side, quality, max_bytes, min_quality=60):
+    """
+    Downscale a decoded input and encode it in memory for upload
+
+    Steps the JPEG quality down until the encoding fits max_bytes or
+    min_quality is reached. Returns a named buffer ready to upload.
+    """
+    scale = max_side / max(img.width, img.height)
+    if scale < 1:
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        upload = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    else:
+        upload = img
+
+    # Re-encoding drops the EXIF orientation, so apply it to the pixels
+    if upload.getexif().get(ExifTags.Base.Orientation, 1) != 1:
+        upload = ImageOps.exif_transpose(upload)
+
+    while True:
+        buffer = BytesIO()
+        upload.save(buffer, format='JPEG', quality=quality, optimize=True)
+        if buffer.tell() <= max_bytes or quality <= min_quality:
+            break
+        quality = max(min_quality, quality - 10)
+
+    buffer.name = 'input.jpg'
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghibliartwork',
+            name='prediction_id',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='ghibliartwork',
+            name='prediction_status',
+            field=models.CharField(blank=True, max_length=20, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0002_artwork_prediction'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghibliartwork',
+            name='task_id',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0003_artwork_task_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batchupload',
+            name='max_concurrency',
+            field=models.PositiveIntegerField(blank=True, help_text='Images converted at once (empty = BATCH_MAX_CONCURRENCY)', null=True),
+        ),
+    ]
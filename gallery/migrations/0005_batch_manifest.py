@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0004_batch_max_concurrency'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batchupload',
+            name='manifest',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
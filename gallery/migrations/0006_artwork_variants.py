@@ -0,0 +1,19 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:56
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0005_batch_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghibliartwork',
+            name='variant_of',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='gallery.ghibliartwork'),
+        ),
+    ]
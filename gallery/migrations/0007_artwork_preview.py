@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0006_artwork_variants'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghibliartwork',
+            name='preview_image',
+            field=models.ImageField(blank=True, null=True, upload_to='previews/'),
+        ),
+    ]
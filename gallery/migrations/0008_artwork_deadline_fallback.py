@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0007_artwork_preview'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghibliartwork',
+            name='deadline_fallback',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0008_artwork_deadline_fallback'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ghibliartwork',
+            index=models.Index(fields=['status', 'created_at', 'id'], name='artwork_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ghibliartwork',
+            index=models.Index(fields=['status', 'conversion_method', 'created_at', 'id'], name='artwork_status_method_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ghibliartwork',
+            index=models.Index(fields=['status', 'name', 'id'], name='artwork_status_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ghibliartwork',
+            index=models.Index(fields=['batch_upload', 'created_at', 'id'], name='artwork_batch_created_idx'),
+        ),
+    ]
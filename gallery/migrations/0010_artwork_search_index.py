@@ -0,0 +1,59 @@
+from django.db import migrations
+
+SEARCH_TABLE = 'gallery_artwork_search'
+TRIGRAM_TABLE = 'gallery_artwork_search_trigram'
+
+
+def create_search_index(apps, schema_editor):
+    # Other databases search with gallery.search.DatabaseSearchBackend
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    GhibliArtwork = apps.get_model('gallery', 'GhibliArtwork')
+    labels = dict(GhibliArtwork._meta.get_field('conversion_method').choices)
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+            "name, batch_name, style, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {TRIGRAM_TABLE} USING fts5(name, batch_name, tokenize='trigram')"
+        )
+
+        source = (
+            "FROM gallery_ghibliartwork a "
+            "LEFT JOIN gallery_batchupload b ON b.id = a.batch_upload_id"
+        )
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} (rowid, name, batch_name, style) "
+            f"SELECT a.rowid, a.name, COALESCE(b.name, ''), a.conversion_method {source}"
+        )
+        cursor.execute(
+            f"INSERT INTO {TRIGRAM_TABLE} (rowid, name, batch_name) "
+            f"SELECT a.rowid, a.name, COALESCE(b.name, '') {source}"
+        )
+        for style, label in labels.items():
+            cursor.execute(
+                f"UPDATE {SEARCH_TABLE} SET style = %s WHERE style = %s",
+                [f"{style} {label}", style]
+            )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+        cursor.execute(f"DROP TABLE IF EXISTS {TRIGRAM_TABLE}")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0009_artwork_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0010_artwork_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ghibliartwork',
+            name='webhook_token',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
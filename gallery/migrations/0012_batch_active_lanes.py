@@ -0,0 +1,18 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0011_artwork_webhook_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='batchupload',
+            name='active_lanes',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
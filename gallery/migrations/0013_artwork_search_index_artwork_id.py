@@ -0,0 +1,65 @@
+from django.db import migrations
+
+SEARCH_TABLE = 'gallery_artwork_search'
+TRIGRAM_TABLE = 'gallery_artwork_search_trigram'
+
+
+def build_search_index(apps, schema_editor, keyed_on_id):
+    """Recreate both FTS5 tables from the artwork rows, keyed on the artwork id or on its rowid"""
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+
+    GhibliArtwork = apps.get_model('gallery', 'GhibliArtwork')
+    labels = dict(GhibliArtwork._meta.get_field('conversion_method').choices)
+    key_column, key_value = ('artwork_id', 'a.id') if keyed_on_id else ('rowid', 'a.rowid')
+    extra_column = ', artwork_id UNINDEXED' if keyed_on_id else ''
+
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+        cursor.execute(f"DROP TABLE IF EXISTS {TRIGRAM_TABLE}")
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5("
+            f"name, batch_name, style{extra_column}, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE {TRIGRAM_TABLE} USING fts5(name, batch_name{extra_column}, tokenize='trigram')"
+        )
+
+        source = (
+            "FROM gallery_ghibliartwork a "
+            "LEFT JOIN gallery_batchupload b ON b.id = a.batch_upload_id"
+        )
+        cursor.execute(
+            f"INSERT INTO {SEARCH_TABLE} ({key_column}, name, batch_name, style) "
+            f"SELECT {key_value}, a.name, COALESCE(b.name, ''), a.conversion_method {source}"
+        )
+        cursor.execute(
+            f"INSERT INTO {TRIGRAM_TABLE} ({key_column}, name, batch_name) "
+            f"SELECT {key_value}, a.name, COALESCE(b.name, '') {source}"
+        )
+        for style, label in labels.items():
+            cursor.execute(
+                f"UPDATE {SEARCH_TABLE} SET style = %s WHERE style = %s",
+                [f"{style} {label}", style]
+            )
+
+
+def key_on_artwork_id(apps, schema_editor):
+    # The implicit rowid of a table with a UUID primary key can change
+    # (VACUUM renumbers it), so index rows carry the artwork id instead
+    build_search_index(apps, schema_editor, keyed_on_id=True)
+
+
+def key_on_rowid(apps, schema_editor):
+    build_search_index(apps, schema_editor, keyed_on_id=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0012_batch_active_lanes'),
+    ]
+
+    operations = [
+        migrations.RunPython(key_on_artwork_id, key_on_rowid),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.2 on 2026-10-18 14:59
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_artworks(apps, schema_editor):
+    """One counter per (status, method) pair, starting from the table as it is"""
+    GhibliArtwork = apps.get_model('gallery', 'GhibliArtwork')
+    ArtworkCount = apps.get_model('gallery', 'ArtworkCount')
+
+    counts = {
+        (status, method): 0
+        for status, _ in GhibliArtwork._meta.get_field('status').choices
+        for method, _ in GhibliArtwork._meta.get_field('conversion_method').choices
+    }
+    rows = GhibliArtwork.objects.order_by().values_list('status', 'conversion_method').annotate(count=Count('pk'))
+    counts.update({(status, method): count for status, method, count in rows})
+    ArtworkCount.objects.bulk_create([
+        ArtworkCount(status=status, conversion_method=method, count=count)
+        for (status, method), count in counts.items()
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0013_artwork_search_index_artwork_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArtworkCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(max_length=20)),
+                ('conversion_method', models.CharField(max_length=20)),
+                ('count', models.IntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('status', 'conversion_method'), name='artwork_count_key')],
+            },
+        ),
+        migrations.RunPython(count_artworks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.2 on 2026-10-18 15:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gallery', '0014_artwork_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ghibliartwork',
+            index=models.Index(fields=['status', 'conversion_method', 'name', 'id'], name='artwork_status_method_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ghibliartwork',
+            index=models.Index(fields=['status', 'processing_time', 'id'], name='artwork_status_time_idx'),
+        ),
+    ]
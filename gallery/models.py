@@ -1,8 +1,15 @@
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.urls import reverse
 import uuid
 
+from .events import ARTWORK_EVENT_FIELDS, QUEUE_CHANNEL, publish, publish_artworks
+from .search import index_artworks
+from .stats import TRACKED_FIELDS, record_transitions
+
 # Define choices at module level so both models can use them
 CONVERSION_METHODS = [
     ('ghibli', 'Studio Ghibli Style (AI)'),
@@ -63,6 +70,20 @@ class BatchUpload(models.Model):
     # Error handling
     error_message = models.TextField(blank=True, null=True)
     
+    # One entry per image member of the ZIP (see zip_manifest.build_manifest),
+    # built on upload and reused by extraction, progress totals and retries
+    manifest = models.JSONField(null=True, blank=True, editable=False)
+    
+    # Images of this batch converted at the same time across all workers
+    max_concurrency = models.PositiveIntegerField(
+        null=True, blank=True,
+        help_text="Images converted at once (empty = BATCH_MAX_CONCURRENCY)"
+    )
+    
+    # Conversion tasks of this batch queued or running right now, at most
+    # concurrency_limit; only ever changed with F() increments
+    active_lanes = models.PositiveIntegerField(default=0, editable=False)
+    
     class Meta:
         ordering = ['-created_at']
         verbose_name = "Batch Upload"
@@ -87,6 +108,37 @@ class BatchUpload(models.Model):
     @property
     def is_processing(self):
         return self.status in ['extracting', 'processing']
+    
+    @property
+    def concurrency_limit(self):
+        return self.max_concurrency or settings.BATCH_MAX_CONCURRENCY
+
+
+class ArtworkQuerySet(models.QuerySet):
+    """Keeps the artwork statistics and live progress in step with bulk writes, which skip save()"""
+
+    def update(self, **kwargs):
+        if not (TRACKED_FIELDS | ARTWORK_EVENT_FIELDS) & kwargs.keys():
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            rows = list(self.order_by().values_list('pk', 'status', 'conversion_method'))
+            updated = super().update(**kwargs)
+            record_transitions(
+                ((status, method), (kwargs.get('status', status), kwargs.get('conversion_method', method)), 1)
+                for pk, status, method in rows
+            )
+        if ARTWORK_EVENT_FIELDS & kwargs.keys():
+            publish_artworks([pk for pk, status, method in rows], status_changed='status' in kwargs)
+        return updated
+
+    def bulk_create(self, objs, *args, **kwargs):
+        with transaction.atomic(using=self.db, savepoint=False):
+            objs = super().bulk_create(objs, *args, **kwargs)
+            record_transitions((None, obj.stats_key, 1) for obj in objs)
+        for obj in objs:
+            obj._stats_key = obj.stats_key
+        publish(QUEUE_CHANNEL)
+        return objs
 
 
 class GhibliArtwork(models.Model):
@@ -101,11 +153,23 @@ class GhibliArtwork(models.Model):
     name = models.CharField(max_length=200, help_text="Name or description of the artwork")
     original_image = models.ImageField(upload_to='originals/', help_text="Original image to convert")
     converted_image = models.ImageField(upload_to='converted/', blank=True, null=True)
+    # Small filter rendering made on submit, shown until converted_image is ready
+    preview_image = models.ImageField(upload_to='previews/', blank=True, null=True)
     
     # Processing details
     conversion_method = models.CharField(max_length=20, choices=CONVERSION_METHODS, default='ghibli')
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
 
+    # Other styles of the same upload point at the artwork holding the
+    # original, and share its stored file
+    variant_of = models.ForeignKey(
+        'self',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='variants'
+    )
+
     # Batch upload relationship
     batch_upload = models.ForeignKey(
         BatchUpload, 
@@ -124,14 +188,40 @@ class GhibliArtwork(models.Model):
     error_message = models.TextField(blank=True, null=True)
     retry_count = models.IntegerField(default=0)
     
+    # Remote FLUX prediction, finished by the Replicate webhook
+    prediction_id = models.CharField(max_length=100, blank=True, null=True, db_index=True)
+    prediction_status = models.CharField(max_length=20, blank=True, null=True)
+    # Secret part of the current prediction's webhook URL
+    webhook_token = models.CharField(max_length=64, blank=True, null=True)
+    
+    # The filter result was served because FLUX missed its deadline; cleared
+    # when the late FLUX result replaces it
+    deadline_fallback = models.BooleanField(default=False)
+    
+    # Celery task converting the artwork - the job handle returned on upload
+    task_id = models.CharField(max_length=50, blank=True, null=True)
+    
     # Metadata
     original_file_size = models.IntegerField(null=True, blank=True)  # in bytes
     processing_time = models.FloatField(null=True, blank=True)  # in seconds
     
+    objects = ArtworkQuerySet.as_manager()
+    
     class Meta:
         ordering = ['-created_at']
         verbose_name = "Ghibli Artwork"
         verbose_name_plural = "Ghibli Artworks"
+        # Match the keyset-paginated listings: filter on status (and style or
+        # batch), then seek along (created_at, id), (name, id) or
+        # (processing_time, id)
+        indexes = [
+            models.Index(fields=['status', 'created_at', 'id'], name='artwork_status_created_idx'),
+            models.Index(fields=['status', 'conversion_method', 'created_at', 'id'], name='artwork_status_method_idx'),
+            models.Index(fields=['status', 'name', 'id'], name='artwork_status_name_idx'),
+            models.Index(fields=['status', 'conversion_method', 'name', 'id'], name='artwork_status_method_name_idx'),
+            models.Index(fields=['status', 'processing_time', 'id'], name='artwork_status_time_idx'),
+            models.Index(fields=['batch_upload', 'created_at', 'id'], name='artwork_batch_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.name} ({self.get_status_display()})"
@@ -151,8 +241,78 @@ class GhibliArtwork(models.Model):
     def is_processing(self):
         return self.status == 'processing'
     
+    def create_variants(self, styles):
+        """Artworks for more styles of this one's original - the stored file is shared, not copied"""
+        labels = dict(CONVERSION_METHODS)
+        variants = GhibliArtwork.objects.bulk_create([
+            GhibliArtwork(
+                name=f"{self.name} ({labels.get(style, style)})",
+                original_image=self.original_image.name,
+                original_file_size=self.original_file_size,
+                conversion_method=style,
+                variant_of=self,
+            )
+            for style in dict.fromkeys(styles)
+            if style != self.conversion_method
+        ])
+        index_artworks(variants)
+        return variants
+    
+    @property
+    def stats_key(self):
+        """The statistics counter this artwork is counted under"""
+        return (self.status, self.conversion_method)
+    
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Deferred fields leave the stored key unknown; such an artwork's
+        # transitions are left to the next reconciliation
+        if TRACKED_FIELDS <= instance.__dict__.keys():
+            instance._stats_key = instance.stats_key
+        return instance
+    
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._stats_key = self.stats_key
+    
     def save(self, *args, **kwargs):
         # Auto-calculate file size
         if self.original_image and not self.original_file_size:
             self.original_file_size = self.original_image.size
-        super().save(*args, **kwargs)
\ No newline at end of file
+        adding = self._state.adding
+        update_fields = kwargs.get('update_fields')
+        written = None if update_fields is None else set(update_fields)
+        if written is not None and not TRACKED_FIELDS & written:
+            super().save(*args, **kwargs)
+        else:
+            previous = None if adding else getattr(self, '_stats_key', None)
+            # The counters move in the same transaction as the artwork
+            with transaction.atomic(using=kwargs.get('using') or router.db_for_write(GhibliArtwork), savepoint=False):
+                super().save(*args, **kwargs)
+                if adding or previous is not None:
+                    record_transitions([(previous, self.stats_key, 1)])
+            self._stats_key = self.stats_key
+        
+        if written is None or ARTWORK_EVENT_FIELDS & written:
+            publish_artworks([self.pk], status_changed=written is None or 'status' in written)
+
+
+class ArtworkCount(models.Model):
+    """Number of artworks with one status and conversion method - kept by stats.py"""
+    status = models.CharField(max_length=20)
+    conversion_method = models.CharField(max_length=20)
+    count = models.IntegerField(default=0)
+    
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['status', 'conversion_method'], name='artwork_count_key'),
+        ]
+    
+    def __str__(self):
+        return f"{self.status} / {self.conversion_method}: {self.count}"
+
+
+@receiver(post_delete, sender=GhibliArtwork)
+def count_deleted_artwork(sender, instance, **kwargs):
+    record_transitions([(instance.stats_key, None, 1)])
\ No newline at end of file
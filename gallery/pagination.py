@@ -0,0 +1,181 @@
+"""
+Keyset pagination
+Pages are found by seeking past the last row shown, on (sort field, id),
+instead of by OFFSET - page 1000 costs the same index range scan as page 1,
+and rows arriving meanwhile never shift a page. No COUNT(*) is run; views
+pass an approximate count from the statistics counters or a capped count.
+Search results in relevance order page through their bounded list of ids
+"""
+
+import base64
+import json
+
+from django.db.models import F, Q
+
+# Counts above this are shown as "COUNT_CAP+" rather than counted
+COUNT_CAP = 1000
+
+
+def capped_count(queryset, cap=COUNT_CAP):
+    """The number of rows, counting no further than cap + 1"""
+    return queryset.order_by()[:cap + 1].count()
+
+
+def encode_cursor(value, pk):
+    # Field.to_python turns the stored string back into a datetime, float...
+    if hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    raw = json.dumps([value, str(pk)]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(value, pk) from a cursor; raises ValueError for anything malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, pk = json.loads(raw)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    return value, pk
+
+
+class CursorPage:
+    """One page of rows plus the cursors of its neighbours"""
+
+    def __init__(self, object_list, paginator, next_cursor=None, previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __bool__(self):
+        return bool(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    """
+    Paginate a queryset on (order_by, pk)
+
+    order_by is a field name, with a leading '-' for descending; nullable
+    fields sort their NULLs last. count is the approximate total shown to
+    the user - it is never computed here.
+    """
+
+    def __init__(self, queryset, per_page, order_by='-created_at', count=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.descending = order_by.startswith('-')
+        self.field_name = order_by.lstrip('-')
+        self.field = queryset.model._meta.get_field(self.field_name)
+        self.count = count
+
+    def _ordering(self, reverse=False):
+        descending = self.descending != reverse
+        field, pk = F(self.field_name), F('pk')
+        # Only spelled out for nullable fields, so the others match their index
+        nulls = {}
+        if self.field.null:
+            nulls = {'nulls_first': True} if reverse else {'nulls_last': True}
+        if descending:
+            return field.desc(**nulls), pk.desc()
+        return field.asc(**nulls), pk.asc()
+
+    def _seek(self, value, pk, reverse=False):
+        """Rows after (value, pk) in page order, or before it when reverse"""
+        name = self.field_name
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        if value is None:
+            # NULLs come last: past a NULL only NULLs remain, before it every value
+            tail = Q(**{f'{name}__isnull': True, f'pk__{lookup}': pk})
+            return tail | Q(**{f'{name}__isnull': False}) if reverse else tail
+        condition = Q(**{f'{name}__{lookup}': value}) | Q(**{name: value, f'pk__{lookup}': pk})
+        if self.field.null and not reverse:
+            condition |= Q(**{f'{name}__isnull': True})
+        return condition
+
+    def get_page(self, after=None, before=None):
+        """
+        The page following the cursor after, or preceding the cursor before;
+        the first page without either (or for a cursor that does not decode)
+        """
+        reverse = before is not None and after is None
+        cursor = before if reverse else after
+        queryset = self.queryset.order_by(*self._ordering(reverse))
+        if cursor:
+            try:
+                value, pk = decode_cursor(cursor)
+                value = None if value is None else self.field.to_python(value)
+                queryset = queryset.filter(self._seek(value, pk, reverse))
+            except Exception:
+                cursor = None
+                reverse = False
+                queryset = self.queryset.order_by(*self._ordering())
+
+        rows = list(queryset[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+
+        if not rows:
+            return CursorPage(rows, self)
+        first, last = self._cursor(rows[0]), self._cursor(rows[-1])
+        if reverse:
+            return CursorPage(rows, self, next_cursor=last, previous_cursor=first if more else None)
+        return CursorPage(rows, self, next_cursor=last if more else None, previous_cursor=first if cursor else None)
+
+    def _cursor(self, row):
+        return encode_cursor(getattr(row, self.field_name), row.pk)
+
+
+class RankedPaginator:
+    """
+    Paginate search results in relevance order
+
+    ranked_ids holds at most COUNT_CAP primary keys, best first (see
+    search.SearchBackend.ranked_ids), so each page is a slice of it; the
+    cursors carry the position in the list.
+    """
+
+    def __init__(self, queryset, ranked_ids, per_page):
+        self.queryset = queryset
+        self.ranked_ids = list(ranked_ids)
+        self.per_page = per_page
+        self.count = len(self.ranked_ids)
+
+    def get_page(self, after=None, before=None):
+        start = 0
+        try:
+            if after:
+                start = int(decode_cursor(after)[0]) + 1
+            elif before:
+                start = max(int(decode_cursor(before)[0]) - self.per_page, 0)
+        except (TypeError, ValueError):
+            start = 0
+        start = min(max(start, 0), self.count)
+
+        page_ids = self.ranked_ids[start:start + self.per_page]
+        rows = self.queryset.in_bulk(page_ids)
+        rows = [rows[pk] for pk in page_ids if pk in rows]
+        if not rows:
+            return CursorPage(rows, self)
+
+        end = start + len(page_ids)
+        next_cursor = encode_cursor(end - 1, rows[-1].pk) if end < self.count else None
+        previous_cursor = encode_cursor(start, rows[0].pk) if start > 0 else None
+        return CursorPage(rows, self, next_cursor, previous_cursor)
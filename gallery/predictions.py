@@ -0,0 +1,204 @@
+"""
+Non-blocking FLUX predictions
+Predictions are created without waiting; the Replicate webhook finishes
+the artwork when the prediction completes
+"""
+
+import base64
+import hashlib
+import hmac
+import secrets
+import time
+
+from django.conf import settings
+from django.urls import reverse
+
+from .batch_processor import save_batch_result
+from .downloads import download
+from .huggingface_processor import get_processor
+from .image_io import open_encoded
+from .models import GhibliArtwork
+
+# Reject signed webhooks older than this many seconds (replay protection)
+WEBHOOK_TOLERANCE = 300
+
+# Written along with the result when a webhook finishes an artwork
+PREDICTION_FIELDS = ('prediction_id', 'prediction_status')
+
+
+def webhooks_enabled():
+    """
+    Predictions only go asynchronous when Replicate has somewhere to call
+    back and the callback can be verified - an unsigned webhook is never trusted
+    """
+    return (
+        get_processor().use_ai
+        and bool(getattr(settings, 'REPLICATE_WEBHOOK_HOST', ''))
+        and bool(getattr(settings, 'REPLICATE_WEBHOOK_SECRET', ''))
+    )
+
+
+def webhook_url(artwork):
+    """The callback of the artwork's current prediction - its path carries the prediction's token"""
+    host = settings.REPLICATE_WEBHOOK_HOST.rstrip('/')
+    return host + reverse('replicate_webhook', kwargs={'pk': artwork.pk, 'token': artwork.webhook_token})
+
+
+def start_prediction(artwork, img=None):
+    """
+    Start the FLUX conversion of an artwork and return without waiting
+
+    img is the artwork's original already decoded, when several styles of
+    one upload share it. Returns False when the artwork was completed
+    straight away - from the cache, or with the filters while FLUX is
+    unavailable.
+    """
+    processor = get_processor()
+    style = artwork.conversion_method
+
+    if img is None:
+        img = processor.decode_input(artwork.original_image.path)
+    cached = processor.get_cached_result(processor.result_key(img, style))
+    if cached is not None:
+        save_batch_result(artwork, artwork.name, cached, None)
+        return False
+
+    if not processor.flux_breaker.allow_request():
+        print("⚡ FLUX circuit open - going straight to enhanced filters")
+        _finish_with_filters(artwork)
+        return False
+
+    # A fresh token per prediction, saved before Replicate can call back:
+    # only this prediction's webhook can finish the artwork, even before
+    # its id is known here
+    artwork.webhook_token = secrets.token_urlsafe(24)
+    artwork.prediction_id = None
+    artwork.prediction_status = None
+    artwork.save(update_fields=['webhook_token', *PREDICTION_FIELDS])
+
+    try:
+        prediction = processor.flux_client.create_prediction(
+            processor.prepare_flux_input(img), processor.style_prompt(style), webhook_url(artwork)
+        )
+    except Exception as e:
+        processor.flux_breaker.record_failure()
+        print(f"❌ FLUX error: {e}")
+        _finish_with_filters(artwork)
+        return False
+    print(f"📡 FLUX prediction {prediction.id} started for {artwork.name}")
+
+    # A fast prediction can call back before this returns - only touch the
+    # prediction fields so a finished artwork is never clobbered
+    artwork.prediction_id = prediction.id
+    artwork.prediction_status = prediction.status
+    GhibliArtwork.objects.filter(pk=artwork.pk, webhook_token=artwork.webhook_token, prediction_id__isnull=True).update(
+        prediction_id=prediction.id, prediction_status=prediction.status
+    )
+    return True
+
+
+def verify_webhook(headers, body):
+    """Check Replicate's webhook signature; without REPLICATE_WEBHOOK_SECRET nothing passes"""
+    secret = getattr(settings, 'REPLICATE_WEBHOOK_SECRET', '')
+    if not secret:
+        return False
+
+    webhook_id = headers.get('webhook-id')
+    timestamp = headers.get('webhook-timestamp')
+    signatures = headers.get('webhook-signature')
+    if not (webhook_id and timestamp and signatures):
+        return False
+
+    try:
+        if abs(time.time() - int(timestamp)) > WEBHOOK_TOLERANCE:
+            return False
+    except ValueError:
+        return False
+
+    # The secret is "whsec_<base64 key>"; each signature is "v1,<base64 digest>"
+    key = base64.b64decode(secret.split('_', 1)[-1])
+    signed_content = f"{webhook_id}.{timestamp}.".encode() + body
+    expected = base64.b64encode(hmac.new(key, signed_content, hashlib.sha256).digest()).decode()
+    return any(
+        hmac.compare_digest(expected, signature.split(',', 1)[-1])
+        for signature in signatures.split()
+    )
+
+
+def finish_prediction(artwork, prediction):
+    """Complete an artwork from the prediction payload the webhook delivered"""
+    status = prediction.get('status')
+    artwork.prediction_id = prediction.get('id')
+    artwork.prediction_status = status
+
+    # Replicate may deliver the same webhook more than once; a prediction
+    # that missed its deadline only replaces the filter result served instead
+    late = artwork.status == 'completed'
+    replace_late = artwork.deadline_fallback and getattr(settings, 'FLUX_REPLACE_LATE_RESULTS', True)
+    if late and not (replace_late and status == 'succeeded'):
+        artwork.save(update_fields=PREDICTION_FIELDS)
+        return
+
+    processor = get_processor()
+    image_path = artwork.original_image.path
+    style = artwork.conversion_method
+
+    if status == 'succeeded':
+        processor.flux_breaker.record_success()
+        try:
+            result = _download_output(prediction.get('output'))
+        except Exception as e:
+            print(f"❌ FLUX output download failed: {e}")
+        else:
+            img = processor.decode_input(image_path)
+            processor.cache_result(processor.result_key(img, style), result)
+            artwork.deadline_fallback = False
+            save_batch_result(artwork, artwork.name, result, None, (*PREDICTION_FIELDS, 'deadline_fallback'))
+            return
+    else:
+        processor.flux_breaker.record_failure()
+        print(f"❌ FLUX prediction {artwork.prediction_id} {status}: {prediction.get('error')}")
+
+    if late:
+        # The filter result already served stays
+        artwork.save(update_fields=PREDICTION_FIELDS)
+        return
+    _finish_with_filters(artwork, PREDICTION_FIELDS)
+
+
+def hedge_prediction(artwork):
+    """
+    Serve the filter result for an artwork whose prediction missed its deadline
+
+    The webhook still swaps in the FLUX result if it arrives later.
+    Returns False when the prediction made it in time after all.
+    """
+    if artwork.status == 'completed':
+        return False
+
+    print(f"⏱️ FLUX prediction {artwork.prediction_id} missed its deadline - serving the filter result")
+    artwork.deadline_fallback = True
+    _finish_with_filters(artwork, ('deadline_fallback',))
+    return True
+
+
+def _finish_with_filters(artwork, update_fields=()):
+    print("🔄 Falling back to enhanced filters...")
+    try:
+        result_image = get_processor().convert_with_filters(artwork.original_image.path, artwork.conversion_method)
+        save_batch_result(artwork, artwork.name, result_image, None, update_fields)
+    except Exception as e:
+        save_batch_result(artwork, artwork.name, None, e, update_fields)
+
+
+def _download_output(output):
+    """
+    Stream the FLUX output to a temporary file and open it
+
+    A JPEG is stored from that file without being decoded.
+    """
+    if isinstance(output, list) and len(output) > 0:
+        output = output[0]
+    if not (isinstance(output, str) and output.startswith('http')):
+        raise Exception(f"Unexpected output format from FLUX: {output}")
+    return open_encoded(download(output))
@@ -0,0 +1,194 @@
+"""
+Content-addressed cache for conversion results
+Small in-process hot tier in front of a size-bounded on-disk LRU store
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+# Lookup and store counters, per process and - given a shared store - across them
+COUNTERS = ('memory_hits', 'disk_hits', 'misses', 'stores', 'evictions')
+
+
+def image_digest(img):
+    """SHA-256 of the decoded pixels, so re-encoded copies of a photo still match"""
+    digest = hashlib.sha256(f"{img.mode}:{img.width}x{img.height}:".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def result_key(input_digest, style, prompt, backend):
+    """Cache key for one conversion of one input"""
+    parts = (input_digest, style, prompt or '', backend)
+    return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+
+def shared_counter_key(name):
+    return f"result-cache:{name}"
+
+
+def shared_stats(shared):
+    """The counters of every process adding to shared (a Django cache), with their hit rate"""
+    values = shared.get_many([shared_counter_key(name) for name in COUNTERS])
+    stats = {name: values.get(shared_counter_key(name), 0) for name in COUNTERS}
+    return with_hit_rate(stats)
+
+
+def with_hit_rate(stats):
+    lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+    stats['hit_rate'] = (stats['memory_hits'] + stats['disk_hits']) / lookups if lookups else 0.0
+    return stats
+
+
+class ResultCache:
+    """
+    Encoded conversion results by key
+
+    The disk tier is shared by every process using the same directory;
+    files are written atomically and their mtime is the LRU clock. Once
+    the store outgrows max_bytes, eviction takes it down to low_water of
+    it, so the store is walked once per many writes, not on every one.
+    Counters are also added to shared (a Django cache), if given, for
+    processes that never convert to report.
+    """
+
+    def __init__(self, directory, max_bytes, hot_entries=32, low_water=0.9, shared=None):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.hot_entries = hot_entries
+        self.low_water = low_water
+        self.shared = shared
+        self.hot = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_bytes = None
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        with self.lock:
+            data = self.hot.get(key)
+            if data is not None:
+                self.hot.move_to_end(key)
+        if data is not None:
+            self._count('memory_hits')
+            return data
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            self._count('misses')
+            return None
+
+        with self.lock:
+            self._remember(key, data)
+        self._count('disk_hits')
+        return data
+
+    def put(self, key, data):
+        self._write(key, lambda f: f.write(data))
+        with self.lock:
+            self._remember(key, data)
+
+    def put_file(self, key, fileobj):
+        """Store a result from an open file without reading it into memory"""
+        self._write(key, lambda f: shutil.copyfileobj(fileobj, f))
+
+    def _write(self, key, write):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write then rename, so readers never see a partial file
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(temp_path, path)
+        except OSError:
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            raise
+
+        size = os.path.getsize(path)
+        evicted = 0
+        with self.lock:
+            if self.disk_bytes is None:
+                self.disk_bytes = self._scan_size()
+            else:
+                self.disk_bytes += size
+            if self.disk_bytes > self.max_bytes:
+                evicted = self._evict()
+        self._count('stores')
+        if evicted:
+            self._count('evictions', evicted)
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+        if self.shared is None:
+            return
+        key = shared_counter_key(name)
+        try:
+            self.shared.incr(key, amount)
+        except ValueError:
+            # No counter yet, or an evicted one: start it
+            if not self.shared.add(key, amount, timeout=None):
+                self.shared.incr(key, amount)
+
+    def _remember(self, key, data):
+        self.hot[key] = data
+        self.hot.move_to_end(key)
+        while len(self.hot) > self.hot_entries:
+            self.hot.popitem(last=False)
+
+    def _entries(self):
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield stat.st_mtime, stat.st_size, path
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        """Drop least recently used files down to the low-water mark; returns how many"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * self.low_water
+        evicted = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+            self.hot.pop(os.path.basename(path), None)
+        self.disk_bytes = total
+        return evicted
+
+    def stats(self):
+        """This process's counters"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['hot_entries'] = len(self.hot)
+            stats['disk_bytes'] = self.disk_bytes
+        return with_hit_rate(stats)
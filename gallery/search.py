@@ -0,0 +1,279 @@
+"""
+Artwork search
+Artwork names, batch names and styles live in a search index instead of
+being scanned with LIKE '%x%'. On SQLite the index is an FTS5 table searched
+by word prefix and ranked with bm25, next to a trigram table that answers
+the substring matches a prefix misses - terms too short for trigrams fall
+back to icontains. The model signals keep both in step; other databases
+use icontains throughout
+"""
+
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+# FTS5 tables created by migration 0010, keyed on the artwork id since 0013
+SEARCH_TABLE = 'gallery_artwork_search'
+TRIGRAM_TABLE = 'gallery_artwork_search_trigram'
+
+# A save writing any of these (re)indexes the artwork
+SEARCH_FIELDS = frozenset(('name', 'conversion_method', 'batch_upload', 'batch_upload_id'))
+
+# bm25 weights of the name, batch name and style columns
+RANK_WEIGHTS = (10.0, 5.0, 2.0)
+
+# The trigram tokenizer cannot match anything shorter
+TRIGRAM_MIN_LENGTH = 3
+
+
+def prefix_expression(query):
+    """FTS5 query matching every word of query as a word prefix"""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', query))
+
+
+def phrase_expression(query):
+    """FTS5 query matching query as one phrase (a substring, on the trigram table)"""
+    return '"' + query.strip().replace('"', '""') + '"'
+
+
+class SearchBackend:
+    """Finds artworks by name, batch name and style"""
+
+    def index(self, artworks):
+        """Add artworks to the index, replacing what it held for them"""
+
+    def remove(self, artwork_ids):
+        """Drop artworks from the index"""
+
+    def index_batch(self, batch_id):
+        """Index every artwork of a batch - they are bulk created unindexed"""
+
+    def rename_batch(self, batch, name):
+        """Re-index the batch name of every artwork in a batch"""
+
+    def filter(self, queryset, query):
+        """queryset narrowed to the artworks matching query"""
+        raise NotImplementedError
+
+    def ranked_ids(self, queryset, query, limit):
+        """Primary keys of the best limit matches among queryset, best first"""
+        raise NotImplementedError
+
+
+class DatabaseSearchBackend(SearchBackend):
+    """icontains over the tables themselves - unindexed, for databases without FTS5"""
+
+    def filter(self, queryset, query):
+        return queryset.filter(Q(name__icontains=query) | Q(batch_upload__name__icontains=query))
+
+    def ranked_ids(self, queryset, query, limit):
+        return list(self.filter(queryset, query).values_list('pk', flat=True)[:limit])
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    FTS5 prefix search ranked with bm25, falling back to the trigram table
+
+    Index rows hold their artwork's id in an UNINDEXED artwork_id column,
+    so matches join back to gallery_ghibliartwork on its primary key - the
+    implicit rowid of a table with a UUID key is not stable.
+    """
+
+    def _artwork_table(self):
+        from .models import GhibliArtwork
+        return GhibliArtwork._meta.db_table
+
+    def _db_id(self, pk):
+        from .models import GhibliArtwork
+        return GhibliArtwork._meta.pk.get_db_prep_value(pk, connection)
+
+    def index(self, artworks):
+        from .models import CONVERSION_METHODS
+
+        labels = dict(CONVERSION_METHODS)
+        rows = []
+        for artwork in artworks:
+            # Batch artworks are built with their batch object already attached
+            batch = artwork.batch_upload
+            style = artwork.conversion_method
+            rows.append((
+                artwork.name,
+                batch.name if batch else '',
+                f"{style} {labels.get(style, '')}",
+                self._db_id(artwork.pk),
+            ))
+
+        if not rows:
+            return
+
+        # FTS5 has no unique key to REPLACE on: drop what the index held first
+        self.remove([artwork.pk for artwork in artworks])
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (name, batch_name, style, artwork_id) VALUES (%s, %s, %s, %s)",
+                rows
+            )
+            cursor.executemany(
+                f"INSERT INTO {TRIGRAM_TABLE} (name, batch_name, artwork_id) VALUES (%s, %s, %s)",
+                [(name, batch_name, pk) for name, batch_name, style, pk in rows]
+            )
+
+    def index_batch(self, batch_id):
+        from .models import CONVERSION_METHODS, BatchUpload
+
+        # Styles are indexed with their label, as index() does
+        style_cases = ' '.join('WHEN %s THEN %s' for _ in CONVERSION_METHODS)
+        style_params = [value for style, label in CONVERSION_METHODS for value in (style, f"{style} {label}")]
+        artwork_table = self._artwork_table()
+        source = (
+            f"FROM {artwork_table} JOIN {BatchUpload._meta.db_table} batch "
+            f"ON batch.id = {artwork_table}.batch_upload_id "
+            f"WHERE {artwork_table}.batch_upload_id = %s"
+        )
+        batch_id = BatchUpload._meta.pk.get_db_prep_value(batch_id, connection)
+        with connection.cursor() as cursor:
+            for table in (SEARCH_TABLE, TRIGRAM_TABLE):
+                cursor.execute(
+                    f"DELETE FROM {table} WHERE artwork_id IN "
+                    f"(SELECT id FROM {artwork_table} WHERE batch_upload_id = %s)",
+                    [batch_id]
+                )
+            cursor.execute(
+                f"INSERT INTO {SEARCH_TABLE} (name, batch_name, style, artwork_id) "
+                f"SELECT {artwork_table}.name, batch.name, "
+                f"CASE {artwork_table}.conversion_method {style_cases} "
+                f"ELSE {artwork_table}.conversion_method END, {artwork_table}.id {source}",
+                [*style_params, batch_id]
+            )
+            cursor.execute(
+                f"INSERT INTO {TRIGRAM_TABLE} (name, batch_name, artwork_id) "
+                f"SELECT {artwork_table}.name, batch.name, {artwork_table}.id {source}",
+                [batch_id]
+            )
+
+    def remove(self, artwork_ids):
+        ids = [self._db_id(pk) for pk in artwork_ids]
+        if not ids:
+            return
+        placeholders = ', '.join(['%s'] * len(ids))
+        with connection.cursor() as cursor:
+            for table in (SEARCH_TABLE, TRIGRAM_TABLE):
+                cursor.execute(f"DELETE FROM {table} WHERE artwork_id IN ({placeholders})", ids)
+
+    def rename_batch(self, batch, name):
+        artwork_ids = f"SELECT id FROM {self._artwork_table()} WHERE batch_upload_id = %s"
+        with connection.cursor() as cursor:
+            for table in (SEARCH_TABLE, TRIGRAM_TABLE):
+                cursor.execute(
+                    f"UPDATE {table} SET batch_name = %s WHERE artwork_id IN ({artwork_ids})",
+                    [name, self._db_id(batch.pk)]
+                )
+
+    def _matches(self, table, queryset):
+        """SQL for the ids of queryset's artworks that match an expression on table, and its params"""
+        artwork_table = self._artwork_table()
+        candidates, params = queryset.order_by().values('pk').query.sql_with_params()
+        return (
+            f"SELECT {artwork_table}.id FROM {table} "
+            f"JOIN {artwork_table} ON {artwork_table}.id = {table}.artwork_id "
+            f"WHERE {table} MATCH %s AND {artwork_table}.id IN ({candidates})"
+        ), params
+
+    def _match(self, queryset, query):
+        """
+        The table and MATCH expression to search queryset with, or None for icontains
+
+        Word prefixes come first; only when none of queryset's artworks
+        has one is query looked up as a substring in the trigram table, or
+        with icontains when it is too short for trigrams.
+        """
+        expression = prefix_expression(query)
+        if expression:
+            sql, params = self._matches(SEARCH_TABLE, queryset)
+            with connection.cursor() as cursor:
+                cursor.execute(f"{sql} LIMIT 1", [expression, *params])
+                if cursor.fetchone():
+                    return SEARCH_TABLE, expression
+        if len(query.strip()) >= TRIGRAM_MIN_LENGTH:
+            return TRIGRAM_TABLE, phrase_expression(query)
+        return None
+
+    def filter(self, queryset, query):
+        match = self._match(queryset, query)
+        if match is None:
+            return DatabaseSearchBackend().filter(queryset, query)
+        table, expression = match
+        sql, params = self._matches(table, queryset)
+        return queryset.filter(pk__in=RawSQL(sql, [expression, *params]))
+
+    def ranked_ids(self, queryset, query, limit):
+        match = self._match(queryset, query)
+        if match is None:
+            return DatabaseSearchBackend().ranked_ids(queryset, query, limit)
+        table, expression = match
+        weights = RANK_WEIGHTS if table == SEARCH_TABLE else RANK_WEIGHTS[:2]
+        sql, params = self._matches(table, queryset)
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"{sql} ORDER BY bm25({table}, {', '.join(map(str, weights))}) LIMIT %s",
+                [expression, *params, limit]
+            )
+            pk_field = queryset.model._meta.pk
+            return [pk_field.to_python(row[0]) for row in cursor.fetchall()]
+
+
+_backend = None
+
+
+def get_search_backend():
+    """The configured backend (SEARCH_BACKEND), or the best one for the database"""
+    global _backend
+    if _backend is None:
+        path = getattr(settings, 'SEARCH_BACKEND', '')
+        if not path:
+            path = (
+                'gallery.search.SQLiteSearchBackend' if connection.vendor == 'sqlite'
+                else 'gallery.search.DatabaseSearchBackend'
+            )
+        _backend = import_string(path)()
+    return _backend
+
+
+def index_artworks(artworks):
+    """Index newly created artworks - bulk_create sends no post_save"""
+    get_search_backend().index(artworks)
+
+
+def index_batch(batch_id):
+    """Index the artworks a batch created, in one pass once it is done"""
+    get_search_backend().index_batch(batch_id)
+
+
+@receiver(post_save, sender='gallery.GhibliArtwork')
+def index_saved_artwork(sender, instance, created, update_fields, **kwargs):
+    if created or update_fields is None or SEARCH_FIELDS & update_fields:
+        get_search_backend().index([instance])
+
+
+@receiver(pre_delete, sender='gallery.GhibliArtwork')
+def unindex_deleted_artwork(sender, instance, **kwargs):
+    get_search_backend().remove([instance.pk])
+
+
+@receiver(post_save, sender='gallery.BatchUpload')
+def index_renamed_batch(sender, instance, created, update_fields, **kwargs):
+    if not created and (update_fields is None or 'name' in update_fields):
+        get_search_backend().rename_batch(instance, instance.name)
+
+
+@receiver(pre_delete, sender='gallery.BatchUpload')
+def unindex_deleted_batch(sender, instance, **kwargs):
+    # Its artworks stay, detached from the batch
+    get_search_backend().rename_batch(instance, '')
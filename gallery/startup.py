@@ -0,0 +1,124 @@
+"""
+Startup import benchmark
+Measures what a cold web or worker process pays to import its entry point
+on top of django.setup() (and, for a worker, the Celery app the celery
+command loads first), using the interpreter's own -X importtime report
+
+Run it with: python -m gallery.startup [module ...]
+"""
+
+import os
+import subprocess
+import sys
+
+from django.conf import settings
+
+# Entry points a web pod and a Celery worker import before serving anything
+WEB_ENTRY_POINT = 'ghibli_gallery.urls'
+WORKER_ENTRY_POINT = 'gallery.tasks'
+
+# Loaded before an entry point by the process itself, so not counted for it
+PRELOADED = {WORKER_ENTRY_POINT: 'ghibli_gallery.celery'}
+
+# Conversion backends that must only load on first use
+HEAVY_MODULES = ('replicate', 'httpx', 'numpy', 'requests')
+
+# Written to stderr after django.setup() and any preload, so interpreter
+# startup and Django's own app loading are left out of the measurement
+MARKER = '-- startup benchmark --'
+
+SCRIPT = (
+    "import sys, django\n"
+    "django.setup()\n"
+    "{preload}\n"
+    f"sys.stderr.write({MARKER!r} + '\\n')\n"
+    "import {module}\n"
+)
+
+
+class StartupReport:
+    """Cumulative import times, in milliseconds, of one cold import"""
+
+    def __init__(self, module, imports):
+        self.module = module
+        # Module name -> (cumulative ms, nesting level)
+        self.imports = imports
+
+    @property
+    def total_ms(self):
+        return sum(ms for ms, level in self.imports.values() if level == 0)
+
+    def loaded(self, name):
+        """Whether a module (or any of its submodules) was imported"""
+        return any(module == name or module.startswith(name + '.') for module in self.imports)
+
+    def heavy_modules(self):
+        return [name for name in HEAVY_MODULES if self.loaded(name)]
+
+    def slowest(self, count=10):
+        """The slowest top-level imports, slowest first"""
+        top_level = [(ms, name) for name, (ms, level) in self.imports.items() if level == 0]
+        return sorted(top_level, reverse=True)[:count]
+
+
+def parse_importtime(output):
+    """
+    Read -X importtime lines after the marker
+
+    Each line is "import time: <self us> | <cumulative us> | <indented name>",
+    two spaces of indent per nesting level.
+    """
+    lines = output.splitlines()
+    if MARKER in lines:
+        lines = lines[lines.index(MARKER) + 1:]
+
+    imports = {}
+    for line in lines:
+        if not line.startswith('import time:'):
+            continue
+        try:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            cumulative_ms = int(cumulative) / 1000
+        except ValueError:
+            # The column header
+            continue
+        level = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        imports[name.strip()] = (cumulative_ms, level)
+    return imports
+
+
+def measure_startup(module=WEB_ENTRY_POINT):
+    """Import module in a fresh interpreter and report what it cost"""
+    preload = f"import {PRELOADED[module]}" if module in PRELOADED else ''
+    env = dict(os.environ)
+    env.setdefault('DJANGO_SETTINGS_MODULE', 'ghibli_gallery.settings')
+    # Bytecode compilation would otherwise be counted on the first run
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(settings.BASE_DIR), env.get('PYTHONPATH')]))
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', SCRIPT.format(module=module, preload=preload)],
+        cwd=settings.BASE_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return StartupReport(module, parse_importtime(result.stderr))
+
+
+if __name__ == '__main__':
+    import django
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ghibli_gallery.settings')
+    django.setup()
+
+    budget = getattr(settings, 'STARTUP_IMPORT_BUDGET_MS', 100)
+    for entry_point in sys.argv[1:] or [WEB_ENTRY_POINT, WORKER_ENTRY_POINT]:
+        report = measure_startup(entry_point)
+        status = '✅' if report.total_ms <= budget and not report.heavy_modules() else '❌'
+        print(f"{status} {entry_point}: {report.total_ms:.1f} ms (budget {budget} ms)")
+        for ms, name in report.slowest():
+            print(f"   {ms:8.1f} ms  {name}")
+        if report.heavy_modules():
+            print(f"   ⚠️ Loaded at startup: {', '.join(report.heavy_modules())}")
@@ -0,0 +1,128 @@
+"""
+Artwork statistics
+Artwork counts per (status, conversion method), kept in the ArtworkCount
+table so the home page and the stats API read a few rows instead of
+grouping the artworks table. Status transitions adjust the counts with F()
+increments in the same transaction as the change itself, so every web
+process and worker sees the same numbers; the periodic reconciliation
+recounts the table, which repairs any drift from writes made behind the
+model's back
+"""
+
+from django.db import transaction
+from django.db.models import Case, Count, F, Q, Value, When
+
+# Writes that touch one of these fields move an artwork between counters
+TRACKED_FIELDS = frozenset(('status', 'conversion_method'))
+
+
+def group_counts(queryset):
+    """{(status, method): count} of a queryset, in one GROUP BY"""
+    rows = queryset.order_by().values_list('status', 'conversion_method').annotate(count=Count('pk'))
+    return {(status, method): count for status, method, count in rows}
+
+
+def record_transitions(transitions):
+    """
+    Move counts between counters, in the caller's transaction
+
+    transitions is an iterable of (old key, new key, count), where a key is
+    a (status, method) pair, or None for an artwork created or deleted.
+    """
+    deltas = {}
+    for old, new, count in transitions:
+        if old == new:
+            continue
+        if old is not None:
+            deltas[old] = deltas.get(old, 0) - count
+        if new is not None:
+            deltas[new] = deltas.get(new, 0) + count
+    deltas = {key: delta for key, delta in deltas.items() if delta}
+    if deltas:
+        _apply(deltas)
+
+
+def _apply(deltas):
+    """Add deltas to their counters - one UPDATE, plus an insert for pairs with no row yet"""
+    from .models import ArtworkCount
+
+    matches = Q()
+    for status, method in deltas:
+        matches |= Q(status=status, conversion_method=method)
+    change = Case(
+        *(When(status=status, conversion_method=method, then=Value(delta)) for (status, method), delta in deltas.items()),
+        default=Value(0),
+    )
+    if ArtworkCount.objects.filter(matches).update(count=F('count') + change) == len(deltas):
+        return
+
+    # Rows are created empty, so a pair another transaction just added
+    # is still counted once, then the deltas it missed are applied
+    missing = set(deltas) - set(ArtworkCount.objects.filter(matches).values_list('status', 'conversion_method'))
+    ArtworkCount.objects.bulk_create(
+        [ArtworkCount(status=status, conversion_method=method) for status, method in missing],
+        ignore_conflicts=True,
+    )
+    _apply({key: deltas[key] for key in missing})
+
+
+def count_artworks():
+    """{(status, method): count} of the whole table, with a 0 for every pair it lacks"""
+    from .models import CONVERSION_METHODS, STATUS_CHOICES, GhibliArtwork
+
+    counts = {
+        (status, method): 0
+        for status, _ in STATUS_CHOICES
+        for method, _ in CONVERSION_METHODS
+    }
+    counts.update(group_counts(GhibliArtwork.objects.all()))
+    return counts
+
+
+def reconcile():
+    """Recount the artworks table and replace every counter; returns the counts"""
+    from .models import ArtworkCount
+
+    with transaction.atomic():
+        # Transitions wait for the recount instead of landing in between
+        rows = {(row.status, row.conversion_method): row for row in ArtworkCount.objects.select_for_update()}
+        counts = count_artworks()
+        for key, row in rows.items():
+            row.count = counts.get(key, 0)
+        ArtworkCount.objects.bulk_update(rows.values(), ['count'])
+        ArtworkCount.objects.bulk_create([
+            ArtworkCount(status=status, conversion_method=method, count=count)
+            for (status, method), count in counts.items()
+            if (status, method) not in rows
+        ])
+    return counts
+
+
+def artwork_counts():
+    """{(status, method): count} from the counters - one query of a few rows"""
+    from .models import ArtworkCount
+
+    rows = ArtworkCount.objects.values_list('status', 'conversion_method', 'count')
+    # A counter can dip below zero while drifting until the next reconciliation
+    return {(status, method): max(count, 0) for status, method, count in rows}
+
+
+def artwork_stats():
+    """
+    Totals for the home page and the stats API
+
+    {'total': n, 'status': {status: n}, 'completed_by_method': {method: n}}
+    """
+    from .models import CONVERSION_METHODS, STATUS_CHOICES
+
+    by_status = {status: 0 for status, _ in STATUS_CHOICES}
+    completed_by_method = {method: 0 for method, _ in CONVERSION_METHODS}
+    for (status, method), count in artwork_counts().items():
+        by_status[status] = by_status.get(status, 0) + count
+        if status == 'completed':
+            completed_by_method[method] = completed_by_method.get(method, 0) + count
+    return {
+        'total': sum(by_status.values()),
+        'status': by_status,
+        'completed_by_method': completed_by_method,
+    }
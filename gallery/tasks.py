@@ -3,13 +3,26 @@ Celery tasks for background image processing
 Handles Ghibli art conversion using Hugging Face API
 """
 
-from celery import shared_task
-from django.utils import timezone
+from celery import shared_task, uuid
+from django.conf import settings
 from django.core.files.base import ContentFile
-from .models import GhibliArtwork
-from .huggingface_processor import processor
+from django.db import connection, transaction
+from django.db.models import Count, F, Min, Subquery
+from django.db.models.functions import Greatest
+from django.utils import timezone
+from ghibli_gallery.celery import app  # noqa: F401 - tasks are sent through the configured app
+from .events import publish_batch
+from .models import BatchUpload, GhibliArtwork
+from .batch_processor import (
+    BatchProgress, complete_batch, convert_batch_artworks, fail_batch, start_batch, stream_batch_artworks
+)
+from .huggingface_processor import get_processor
+from .image_io import converted_content
+from .predictions import start_prediction, webhooks_enabled
+from .stats import reconcile
+import threading
 import time
-from io import BytesIO
+from functools import partial
 
 @shared_task
 def convert_to_ghibli(artwork_id):
@@ -29,28 +42,30 @@ def convert_to_ghibli(artwork_id):
         # Update status to processing
         artwork.status = 'processing'
         artwork.processing_started = timezone.now()
-        artwork.save()
+        artwork.save(update_fields=['status', 'processing_started'])
         
         print(f"🎨 Starting conversion for: {artwork.name}")
         start_time = time.time()
         
-        # Choose conversion method
-        if artwork.conversion_method == 'huggingface':
-            result_image = convert_with_huggingface(artwork)
-        elif artwork.conversion_method == 'openai':
-            result_image = convert_with_openai(artwork)
-        elif artwork.conversion_method == 'stability':
-            result_image = convert_with_stability(artwork)
-        elif artwork.conversion_method == 'replicate':
-            result_image = convert_with_replicate(artwork)
-        else:
-            raise ValueError(f"Unknown conversion method: {artwork.conversion_method}")
+        # FLUX without waiting: the Replicate webhook finishes the artwork
+        if webhooks_enabled():
+            if start_flux_prediction(artwork):
+                return f"Prediction {artwork.prediction_id} started for artwork: {artwork.name}"
+            return f"Converted artwork from cache: {artwork.name}"
+        
+        # Interactive upload: FLUX gets the style's deadline, then the filters answer
+        replace_late = getattr(settings, 'FLUX_REPLACE_LATE_RESULTS', True)
+        result_image = get_processor().convert_to_ghibli(
+            image_path=artwork.original_image.path,
+            prompt=f"Convert this image of {artwork.name} into Studio Ghibli anime art style",
+            model_name=artwork.conversion_method,
+            hedge=True,
+            on_late_result=partial(replace_late_result, artwork.id) if replace_late else None
+        )
         
         if result_image:
-            # Convert PIL Image to bytes
-            output_buffer = BytesIO()
-            result_image.save(output_buffer, format='JPEG', quality=95)
-            image_content = ContentFile(output_buffer.getvalue())
+            # JPEG results from the provider are stored as they are
+            image_content = converted_content(result_image)
             
             # Save the converted image
             filename = f"{artwork.id}_ghibli.jpg"
@@ -60,7 +75,10 @@ def convert_to_ghibli(artwork_id):
             artwork.status = 'completed'
             artwork.processing_completed = timezone.now()
             artwork.processing_time = time.time() - start_time
-            artwork.save()
+            artwork.deadline_fallback = getattr(result_image, 'deadline_fallback', False)
+            artwork.save(update_fields=[
+                'converted_image', 'status', 'processing_completed', 'processing_time', 'deadline_fallback'
+            ])
             
             print(f"✅ Successfully converted: {artwork.name} in {artwork.processing_time:.1f}s")
             return f"Successfully converted artwork: {artwork.name}"
@@ -75,7 +93,7 @@ def convert_to_ghibli(artwork_id):
             artwork.status = 'failed'
             artwork.error_message = str(e)
             artwork.retry_count += 1
-            artwork.save()
+            artwork.save(update_fields=['status', 'error_message', 'retry_count'])
             
             print(f"❌ Conversion failed for {artwork.name}: {e}")
             
@@ -89,6 +107,271 @@ def convert_to_ghibli(artwork_id):
         
         raise e
 
+def replace_late_result(artwork_id, result_image):
+    """
+    Swap the filter result served at the deadline for the FLUX result
+    
+    Runs on the thread that saw the late prediction finish, after the task
+    has returned.
+    """
+    from .batch_processor import save_batch_result
+    
+    try:
+        artwork = GhibliArtwork.objects.get(id=artwork_id, deadline_fallback=True)
+        artwork.deadline_fallback = False
+        save_batch_result(artwork, artwork.name, result_image, None, ['deadline_fallback'])
+    except GhibliArtwork.DoesNotExist:
+        pass
+    finally:
+        if threading.current_thread() is not threading.main_thread():
+            connection.close()
+
+def start_flux_prediction(artwork, img=None):
+    """Start an artwork's FLUX prediction for the webhook to finish, with its style's deadline enforced"""
+    if not start_prediction(artwork, img):
+        return False
+    deadline = get_processor().flux_deadline(artwork.conversion_method)
+    if deadline:
+        enforce_flux_deadline.apply_async(args=[str(artwork.id)], countdown=deadline)
+    return True
+
+@shared_task
+def enforce_flux_deadline(artwork_id):
+    """A started prediction's deadline has passed - serve the filters if it is still running"""
+    from .predictions import hedge_prediction
+    
+    artwork = GhibliArtwork.objects.get(id=artwork_id)
+    if hedge_prediction(artwork):
+        return f"Served the filter result for {artwork.name}"
+    return f"Prediction for {artwork.name} finished in time"
+
+def store_previews(artworks):
+    """
+    Give artworks of one original an instant preview, without saving them
+    
+    Rendered in the submitting request - a few milliseconds of filtering on
+    a reduced decode - so there is something to show before the worker even
+    starts. A preview that fails is skipped, never the upload.
+    """
+    max_side = getattr(settings, 'PREVIEW_MAX_SIDE', 256)
+    missing = [artwork for artwork in artworks if not artwork.preview_image]
+    if not (missing and max_side):
+        return
+    
+    try:
+        previews = get_processor().render_previews(
+            missing[0].original_image.path, [artwork.conversion_method for artwork in missing], max_side
+        )
+    except Exception as e:
+        print(f"⚠️ No preview for {missing[0].name}: {e}")
+        return
+    for artwork, preview in zip(missing, previews):
+        artwork.preview_image.save(f"{artwork.id}_preview.jpg", ContentFile(preview), save=False)
+
+@shared_task
+def convert_artwork_styles(artwork_id):
+    """
+    Convert an artwork and its style variants from one decode of the original
+    
+    Variants that are already completed are left alone, so a retry only
+    redoes the styles that failed. FLUX styles go the way convert_to_ghibli
+    sends one: through the webhook when it is set up, otherwise each with
+    its style's deadline.
+    """
+    from .batch_processor import save_batch_result
+    
+    artwork = GhibliArtwork.objects.get(id=artwork_id)
+    artworks = [artwork, *artwork.variants.exclude(status='completed')]
+    if artwork.status == 'completed':
+        artworks.pop(0)
+    
+    started = timezone.now()
+    GhibliArtwork.objects.filter(id__in=[a.id for a in artworks]).update(
+        status='processing', processing_started=started
+    )
+    for a in artworks:
+        a.status = 'processing'
+        a.processing_started = started
+    
+    styles = [a.conversion_method for a in artworks]
+    print(f"🎨 Converting {artwork.name} to {len(styles)} styles: {', '.join(styles)}")
+    processor = get_processor()
+    
+    if webhooks_enabled():
+        try:
+            img = processor.decode_input(artwork.original_image.path)
+        except Exception as e:
+            for a in artworks:
+                save_batch_result(a, a.name, None, e)
+            return f"Could not decode the original of {artwork.name}"
+        started = sum(start_flux_prediction(a, img) for a in artworks)
+        return f"Started {started} predictions for {len(artworks)} styles of {artwork.name}"
+    
+    late_ids = {a.conversion_method: a.id for a in artworks}
+    on_late_result = None
+    if getattr(settings, 'FLUX_REPLACE_LATE_RESULTS', True):
+        on_late_result = lambda style, result_image: replace_late_result(late_ids[style], result_image)
+    try:
+        results = processor.convert_styles(
+            artwork.original_image.path, styles, hedge=True, on_late_result=on_late_result
+        )
+    except Exception as e:
+        # The original itself could not be decoded
+        results = [(None, e)] * len(artworks)
+    
+    successful_count = 0
+    for a, (result_image, error) in zip(artworks, results):
+        a.deadline_fallback = getattr(result_image, 'deadline_fallback', False)
+        successful_count += save_batch_result(a, a.name, result_image, error, ['deadline_fallback'])
+    return f"Converted {successful_count}/{len(artworks)} styles of {artwork.name}"
+
+def enqueue_conversion(artwork, with_variants=False):
+    """
+    Queue the conversion of an artwork and return its task id straight away
+    
+    The task is sent once the current transaction commits, so the worker
+    never looks for a row it cannot see yet; the id is chosen up front so
+    it can be handed back as the job handle before that.
+    """
+    # with_variants converts the artwork's other styles in the same task
+    task = convert_artwork_styles if with_variants else convert_to_ghibli
+    variants = list(artwork.variants.exclude(status='completed')) if with_variants else []
+    store_previews([artwork, *variants])
+    
+    task_id = uuid()
+    for a in [artwork, *variants]:
+        a.status = 'pending'
+        a.error_message = ''
+        a.task_id = task_id
+    artwork.save()
+    for variant in variants:
+        variant.save(update_fields=['status', 'error_message', 'task_id', 'preview_image'])
+    
+    transaction.on_commit(
+        lambda: task.apply_async(args=[str(artwork.id)], task_id=task_id)
+    )
+    print(f"📬 Queued conversion {task_id} for: {artwork.name}")
+    return task_id
+
+def enqueue_batch(batch):
+    """Queue a batch for fan-out processing once the current transaction commits"""
+    transaction.on_commit(lambda: process_batch.delay(str(batch.id)))
+    print(f"📬 Queued batch: {batch.name}")
+
+@shared_task
+def process_batch(batch_id):
+    """
+    Extract a batch and fan its images out over the worker fleet
+    
+    Images are converted in tasks of a few at a time, queued as soon as
+    their chunk of artworks is inserted. The tasks run in lanes that
+    convert at most the batch's concurrency limit of images at once, so
+    one large batch cannot take every worker; the progress counters
+    finish the batch once every image has been counted.
+    """
+    try:
+        batch = BatchUpload.objects.get(id=batch_id)
+        if not start_batch(batch):
+            return f"❌ No valid images found in {batch.name}"
+        progress = BatchProgress(batch.id)
+        limit = batch.concurrency_limit
+        extracted = 0
+        for artworks in stream_batch_artworks(batch, progress):
+            extracted += len(artworks)
+            start_batch_lanes(batch_id, limit)
+        # Images that failed extraction; the conversions count themselves
+        progress.flush()
+    except Exception as e:
+        print(f"❌ Batch processing error: {e}")
+        fail_batch(batch_id, e)
+        raise
+    
+    BatchUpload.objects.filter(pk=batch_id, status='extracting').update(status='processing')
+    publish_batch(batch_id)
+    # Every image may already be counted - the lanes only finish a batch
+    # whose extraction is done
+    complete_batch(batch_id)
+    
+    print(f"📊 Fanned out {extracted} images in at most {limit} lanes")
+    return f"Fanned out {extracted} images for batch: {batch.name}"
+
+def batch_lanes(limit):
+    """(lanes, images per task) for a batch converting at most limit images at once"""
+    per_task = max(1, min(getattr(settings, 'BATCH_IMAGES_PER_TASK', 4), limit))
+    return max(1, limit // per_task), per_task
+
+def claim_batch_images(batch_id, count):
+    """
+    Claim up to count of the batch's images no task has been queued for - one UPDATE
+    
+    Copies of an image in the ZIP share its original and are claimed with
+    it, so they are converted once. The claim is the id of the task to
+    queue, written to the artworks' task_id; returns it with the number
+    of artworks claimed, or (None, 0) when every inserted image is taken.
+    The images' processing time starts here, not while they waited.
+    """
+    task_id = uuid()
+    waiting = GhibliArtwork.objects.filter(
+        batch_upload_id=batch_id, status='processing', task_id__isnull=True
+    )
+    originals = (
+        waiting.order_by().values('original_image').annotate(first=Min('created_at'))
+        .order_by('first').values('original_image')[:count]
+    )
+    claimed = waiting.filter(original_image__in=Subquery(originals)).update(
+        task_id=task_id, processing_started=timezone.now()
+    )
+    if claimed:
+        return task_id, claimed
+    return None, 0
+
+def continue_batch_lane(batch_id, limit):
+    """Queue the next waiting images on a lane the caller holds, or give the lane back"""
+    task_id, claimed = claim_batch_images(batch_id, batch_lanes(limit)[1])
+    if task_id is None:
+        release_batch_lanes(batch_id, 1)
+        return False
+    convert_batch_images.apply_async(args=[batch_id, limit, claimed], task_id=task_id)
+    return True
+
+def release_batch_lanes(batch_id, count):
+    # Never below zero: a retried batch starts again from no lanes
+    BatchUpload.objects.filter(pk=batch_id).update(active_lanes=Greatest(F('active_lanes') - count, 0))
+
+def start_batch_lanes(batch_id, limit):
+    """Start lanes while the batch has fewer than limit allows and images waiting"""
+    lanes = batch_lanes(limit)[0]
+    while BatchUpload.objects.filter(pk=batch_id, active_lanes__lt=lanes).update(active_lanes=F('active_lanes') + 1):
+        if not continue_batch_lane(batch_id, limit):
+            return
+
+@shared_task(bind=True)
+def convert_batch_images(self, batch_id, limit, claimed=1):
+    """
+    Convert the batch images claimed for this task, then queue the next ones
+    
+    Their FLUX predictions are in flight together, so one worker keeps
+    several going. Never raises - a failure only fails its own image.
+    With nothing left to claim the lane ends, and the last lane to end
+    completes the batch.
+    """
+    artworks = list(GhibliArtwork.objects.filter(
+        batch_upload_id=batch_id, task_id=self.request.id, status='processing'
+    ).order_by('created_at'))
+    results = convert_batch_artworks(artworks, artworks[0].conversion_method) if artworks else []
+    progress = BatchProgress(batch_id)
+    for succeeded in results:
+        progress.record(succeeded)
+    # Deleted or given up on meanwhile - still counted, or the batch never finishes
+    progress.failed += max(0, claimed - len(artworks))
+    progress.flush()
+    
+    if not continue_batch_lane(batch_id, limit):
+        # Images inserted while this lane was given back would otherwise wait forever
+        start_batch_lanes(batch_id, limit)
+        complete_batch(batch_id)
+    return sum(results)
+
 def convert_with_huggingface(artwork):
     """Convert using Hugging Face API"""
     try:
@@ -98,7 +381,7 @@ def convert_with_huggingface(artwork):
         prompt = f"Convert this image of {artwork.name} into Studio Ghibli anime art style"
         
         # Use the processor
-        result_image = processor.convert_to_ghibli(
+        result_image = get_processor().convert_to_ghibli(
             image_path=artwork.original_image.path,
             prompt=prompt,
             model_name='ghibli_diffusion'
@@ -135,20 +418,35 @@ def cleanup_failed_artworks():
     
     print("🧹 Running cleanup task...")
     
-    # Find artworks stuck in processing state for more than 1 hour
+    # Find artworks stuck in processing state for more than 1 hour - batch
+    # images still waiting for a lane have not started, so are not stuck
     cutoff_time = timezone.now() - timedelta(hours=1)
     stuck_artworks = GhibliArtwork.objects.filter(
         status='processing',
         processing_started__lt=cutoff_time
     )
     
-    count = 0
-    for artwork in stuck_artworks:
-        artwork.status = 'failed'
-        artwork.error_message = "Processing timeout - artwork was stuck in processing state"
-        artwork.save()
-        count += 1
-        print(f"🔧 Cleaned up stuck artwork: {artwork.name}")
+    for artwork in stuck_artworks.only('name'):
+        print(f"🔧 Cleaning up stuck artwork: {artwork.name}")
+    stuck_batches = dict(
+        stuck_artworks.filter(batch_upload__isnull=False).order_by()
+        .values_list('batch_upload_id').annotate(count=Count('pk'))
+    )
+    count = stuck_artworks.update(
+        status='failed',
+        error_message="Processing timeout - artwork was stuck in processing state"
+    )
+    
+    # The lane converting a stuck batch image died with its task: count the
+    # image, give the lane back and let the batch's waiting images go on
+    for batch in BatchUpload.objects.filter(pk__in=list(stuck_batches), status__in=['extracting', 'processing']):
+        stuck = stuck_batches[batch.pk]
+        progress = BatchProgress(batch.pk)
+        progress.failed = stuck
+        progress.flush()
+        release_batch_lanes(batch.pk, stuck)
+        start_batch_lanes(str(batch.pk), batch.concurrency_limit)
+        complete_batch(batch.pk)
     
     if count > 0:
         print(f"✅ Cleaned up {count} stuck artworks")
@@ -157,11 +455,17 @@ def cleanup_failed_artworks():
     
     return f"Cleaned up {count} stuck artworks"
 
+@shared_task
+def reconcile_artwork_stats():
+    """Periodic recount of the artwork statistics counters"""
+    counts = reconcile()
+    return f"Reconciled statistics for {sum(counts.values())} artworks"
+
 @shared_task
 def test_huggingface_connection():
     """Test task to verify Hugging Face API connection"""
     try:
-        success = processor.test_connection()
+        success = get_processor().test_connection()
         if success:
             return "✅ Hugging Face API connection successful"
         else:
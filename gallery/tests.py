@@ -1,3 +1,1867 @@
-from django.test import TestCase
+"""
+Tests for the gallery app
+"""
 
-# Create your tests here.
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from io import BytesIO
+from unittest import mock
+
+import numpy as np
+import replicate
+import requests
+from PIL import Image
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import LiveServerTestCase, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from gallery import filter_engine, result_cache
+from gallery.circuit_breaker import CircuitBreaker
+from gallery.events import QUEUE_CHANNEL, MemoryBroker, get_broker, stream_events
+from gallery.flux_client import AsyncFluxClient
+from gallery import huggingface_processor
+from gallery.huggingface_processor import HuggingFaceProcessor, get_processor
+from gallery.image_io import encode_result, open_encoded, open_for_size, prepare_upload
+from gallery.models import BatchUpload, GhibliArtwork
+from gallery.predictions import hedge_prediction, start_prediction, webhook_url, webhooks_enabled
+from gallery.result_cache import ResultCache
+from gallery.zip_manifest import build_manifest, valid_entries
+from gallery.batch_processor import BATCH_CREATE_CHUNK, BatchProgress, complete_batch, prefetch, record_batch_progress
+from gallery.tasks import (
+    cleanup_failed_artworks, convert_artwork_styles, convert_batch_images, convert_to_ghibli,
+    enforce_flux_deadline, process_batch
+)
+from gallery.startup import WEB_ENTRY_POINT, WORKER_ENTRY_POINT, measure_startup
+from gallery.pagination import CursorPaginator
+from gallery.search import get_search_backend
+from gallery.stats import artwork_counts, artwork_stats, group_counts
+from gallery.tasks import reconcile_artwork_stats
+
+
+def make_test_image(width=320, height=240, seed=0):
+    """Deterministic photo-like RGB image: smooth gradients plus sensor noise"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    pixels = np.stack([
+        255 * x / width,
+        255 * y / height,
+        128 + 100 * np.sin(x / 17.0) * np.cos(y / 23.0),
+    ], axis=2)
+    pixels += rng.normal(0, 12, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+class FilterEngineTests(SimpleTestCase):
+    """The compiled filters must stay pixel-equivalent to the reference ones"""
+
+    def setUp(self):
+        self.processor = HuggingFaceProcessor()
+        self.image = make_test_image()
+
+    def test_styles_match_reference_filters(self):
+        for style in filter_engine.STYLE_OPERATIONS:
+            with self.subTest(style=style):
+                reference = getattr(self.processor, f'_{style}_filter')(self.image)
+                compiled = filter_engine.apply_style(self.image, style)
+
+                self.assertEqual(compiled.mode, 'RGB')
+                self.assertEqual(compiled.size, self.image.size)
+
+                diff = np.abs(np.asarray(reference, dtype=np.int16) - np.asarray(compiled, dtype=np.int16))
+                # The blur rounds once instead of six times, which can flip a
+                # posterize level here and there; everything else is exact
+                self.assertLess(diff.mean(), 1.0)
+                self.assertLessEqual(diff.max(), 8)
+
+    def test_unknown_style_falls_back_to_ghibli(self):
+        fallback = filter_engine.apply_style(self.image, 'watercolour')
+        ghibli = filter_engine.apply_style(self.image, 'ghibli')
+        self.assertEqual(fallback.tobytes(), ghibli.tobytes())
+
+    def test_non_rgb_input_is_converted(self):
+        result = filter_engine.apply_style(self.image.convert('RGBA'), 'anime')
+        self.assertEqual(result.mode, 'RGB')
+
+    def test_tiled_matches_whole_image(self):
+        for style in filter_engine.STYLE_OPERATIONS:
+            with self.subTest(style=style):
+                whole = filter_engine.apply_style(self.image, style)
+                # Tiny strips so every stage halo crosses several strip edges
+                tiled = filter_engine.apply_style_tiled(self.image.copy(), style, tile_rows=16)
+                self.assertEqual(tiled.tobytes(), whole.tobytes())
+
+    def test_tiled_rejects_non_rgb_input(self):
+        with self.assertRaises(ValueError):
+            filter_engine.apply_style_tiled(self.image.convert('L'), 'ghibli')
+
+
+def make_zip(images):
+    """ZIP archive bytes holding the given {filename: bytes} entries"""
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for filename, data in images.items():
+            archive.writestr(filename, data)
+    return buffer.getvalue()
+
+
+def png_bytes(img):
+    buffer = BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def jpeg_bytes(img):
+    buffer = BytesIO()
+    img.save(buffer, format='JPEG', quality=95)
+    return buffer.getvalue()
+
+
+class FakeReplicate:
+    """Stand-in for replicate.Client: every prediction takes `delay` seconds"""
+
+    def __init__(self, output, delay=0.05):
+        self.output = output
+        self.delay = delay
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    async def async_run(self, ref, input=None, **params):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            return FakeFileOutput(self.output)
+        finally:
+            self.in_flight -= 1
+
+
+class FailingReplicate:
+    """Stand-in for replicate.Client whose predictions fail after `delay` seconds"""
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+
+    async def async_run(self, ref, input=None, **params):
+        await asyncio.sleep(self.delay)
+        raise RuntimeError('model crashed')
+
+
+class FakeFileOutput:
+    def __init__(self, data):
+        self.data = data
+
+    async def aread(self):
+        return self.data
+
+
+class AsyncFluxClientTests(SimpleTestCase):
+    """Predictions overlap up to the in-flight window and time out on their own"""
+
+    def make_client(self, max_in_flight, timeout=5, delay=0.05):
+        client = AsyncFluxClient('token', 'model', max_in_flight=max_in_flight, timeout=timeout)
+        client.client = FakeReplicate(jpeg_bytes(make_test_image(64, 48)), delay=delay)
+        return client
+
+    def test_predictions_run_concurrently_within_the_window(self):
+        client = self.make_client(max_in_flight=4)
+        futures = [client.submit(client.convert(BytesIO(jpeg_bytes(make_test_image())), 'prompt')) for _ in range(10)]
+
+        images = [future.result() for future in futures]
+
+        self.assertEqual([image.size for image in images], [(64, 48)] * 10)
+        self.assertEqual(client.client.peak_in_flight, 4)
+
+    def test_slow_prediction_times_out(self):
+        client = self.make_client(max_in_flight=2, timeout=0.01, delay=1)
+        future = client.submit(client.convert(BytesIO(jpeg_bytes(make_test_image())), 'prompt'))
+        with self.assertRaises(asyncio.TimeoutError):
+            future.result()
+
+    def test_output_urls_are_streamed_to_a_spool(self):
+        client = self.make_client(max_in_flight=1)
+        output = client.client.output
+        spool = tempfile.SpooledTemporaryFile()
+        spool.write(output)
+        spool.seek(0)
+        file_output = FakeFileOutput(b'')
+        file_output.url = 'https://cdn.example.com/out.jpg'
+
+        async def run(ref, input=None, **params):
+            return [file_output]
+
+        client.client.async_run = run
+        with mock.patch('gallery.flux_client.download', return_value=spool) as download:
+            image = client.submit(client.convert(BytesIO(jpeg_bytes(make_test_image())), 'prompt')).result()
+
+        download.assert_called_once_with('https://cdn.example.com/out.jpg', client.timeout)
+        self.assertEqual(encode_result(image), output)
+
+
+class ImageIOTests(SimpleTestCase):
+    """JPEG results pass through, everything else is encoded once"""
+
+    def test_jpeg_bytes_pass_through(self):
+        data = jpeg_bytes(make_test_image())
+        self.assertEqual(encode_result(open_encoded(data)), data)
+
+    def test_other_formats_are_encoded_as_jpeg(self):
+        encoded = encode_result(open_encoded(png_bytes(make_test_image())))
+        with Image.open(BytesIO(encoded)) as img:
+            self.assertEqual(img.format, 'JPEG')
+
+    def test_modified_images_are_re_encoded(self):
+        data = jpeg_bytes(make_test_image())
+        rotated = open_encoded(data).rotate(90)
+        self.assertNotEqual(encode_result(rotated), data)
+
+    def test_images_changed_in_place_are_re_encoded(self):
+        data = jpeg_bytes(make_test_image())
+        image = open_encoded(data)
+        image.paste((0, 0, 0), (0, 0, 32, 32))
+
+        with Image.open(BytesIO(encode_result(image))) as saved:
+            self.assertLessEqual(max(saved.getpixel((8, 8))), 8)
+
+
+    def test_jpeg_is_decoded_no_larger_than_needed(self):
+        photo = jpeg_bytes(make_test_image(2048, 1536))
+
+        self.assertEqual(open_for_size(BytesIO(photo), size=(512, 512)).size, (1024, 768))
+        self.assertEqual(open_for_size(BytesIO(photo), max_side=256).size, (256, 192))
+        # The larger of the two requirements wins
+        self.assertEqual(open_for_size(BytesIO(photo), size=(200, 200), max_side=1024).size, (1024, 768))
+        self.assertEqual(open_for_size(BytesIO(photo)).size, (2048, 1536))
+
+    def test_other_formats_are_decoded_at_full_size(self):
+        img = open_for_size(BytesIO(png_bytes(make_test_image(2048, 1536).convert('L'))), size=(512, 512))
+        self.assertEqual((img.mode, img.size), ('RGB', (2048, 1536)))
+
+    def test_processor_decodes_for_its_backend(self):
+        photo = jpeg_bytes(make_test_image(2048, 1536))
+        with override_settings(REPLICATE_API_TOKEN=''):
+            processor = HuggingFaceProcessor()
+        self.assertEqual(processor.decode_input(photo).size, (1024, 768))
+        with override_settings(FILTER_FULL_RESOLUTION=True):
+            self.assertEqual(processor.decode_input(photo).size, (2048, 1536))
+
+    def test_full_resolution_filtering_leaves_the_input_image_alone(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        with override_settings(REPLICATE_API_TOKEN='', RESULT_CACHE_DIR=cache_dir, FILTER_FULL_RESOLUTION=True):
+            processor = HuggingFaceProcessor()
+            img = make_test_image()
+            pixels = img.tobytes()
+
+            processor.convert_to_ghibli(img, prompt=None, model_name='anime')
+            processor.convert_styles(img, ['ghibli', 'sketch'])
+        self.assertEqual(img.tobytes(), pixels)
+
+
+class FluxInputTests(SimpleTestCase):
+    """FLUX uploads are decoded once, downscaled and re-encoded compactly"""
+
+    def test_large_input_is_downscaled(self):
+        upload = prepare_upload(make_test_image(1600, 1200), max_side=1024, quality=90, max_bytes=10 ** 7)
+        with Image.open(upload) as img:
+            self.assertEqual((img.format, img.size), ('JPEG', (1024, 768)))
+
+    def test_small_input_keeps_its_size(self):
+        upload = prepare_upload(make_test_image(), max_side=1024, quality=90, max_bytes=10 ** 7)
+        with Image.open(upload) as img:
+            self.assertEqual(img.size, (320, 240))
+
+    def test_quality_steps_down_to_fit_the_byte_budget(self):
+        img = make_test_image(800, 600)
+        generous = prepare_upload(img, max_side=1024, quality=95, max_bytes=10 ** 7)
+        budget = generous.getbuffer().nbytes // 2
+        tight = prepare_upload(img, max_side=1024, quality=95, max_bytes=budget)
+        self.assertLessEqual(tight.getbuffer().nbytes, budget)
+
+    def test_exif_orientation_is_applied(self):
+        img = make_test_image(400, 200)
+        exif = img.getexif()
+        exif[0x0112] = 6  # rotate 90 degrees clockwise
+        buffer = BytesIO()
+        img.save(buffer, format='JPEG', exif=exif)
+        buffer.seek(0)
+        with Image.open(buffer) as photo:
+            upload = prepare_upload(photo, max_side=300, quality=90, max_bytes=10 ** 7)
+        with Image.open(upload) as uploaded:
+            self.assertEqual(uploaded.size, (150, 300))
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    """Closed -> open after repeated failures -> half-open trial -> closed or open"""
+
+    def setUp(self):
+        cache.clear()
+        self.now = 1000.0
+        patcher = mock.patch('gallery.circuit_breaker.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=60)
+
+    def trip(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_success_resets_the_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_one_trial_after_the_reset_timeout(self):
+        self.trip()
+        self.now += 61
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(self.breaker.state, 'half_open')
+        # Other workers keep using the fallback while the trial runs
+        self.assertFalse(self.breaker.allow_request())
+
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow_request())
+
+    def test_failed_trial_reopens(self):
+        self.trip()
+        self.now += 61
+        self.breaker.allow_request()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_probe_results(self):
+        self.breaker.record_probe(False)
+        self.assertEqual(self.breaker.state, 'open')
+        self.breaker.record_probe(True)
+        self.assertTrue(self.breaker.allow_request())
+
+    @override_settings(REPLICATE_API_TOKEN='stand-in', FLUX_BREAKER_FAILURES=2)
+    def test_open_circuit_skips_flux(self):
+        processor = HuggingFaceProcessor()
+        img = make_test_image()
+        flux = mock.patch.object(processor, '_convert_with_flux', side_effect=TimeoutError('degraded'))
+        filters = mock.patch.object(processor, 'convert_with_filters', return_value=img)
+        with flux as convert_with_flux, filters, mock.patch.object(processor, 'cache_result'):
+            for _ in range(5):
+                self.assertIs(processor.convert_uncached('photo.jpg', 'prompt', 'ghibli', img, 'key'), img)
+
+        self.assertEqual(convert_with_flux.call_count, 2)
+
+
+class ConvertManyTests(SimpleTestCase):
+    """Several images of one style convert at once inside a single task"""
+
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        overrides = override_settings(RESULT_CACHE_DIR=cache_dir)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.processor = HuggingFaceProcessor()
+        self.photos = [jpeg_bytes(make_test_image(seed=i)) for i in range(4)]
+
+    @override_settings(FILTER_THREADS=4)
+    def test_filter_conversions_run_in_parallel_threads(self):
+        apply_filters = self.processor.apply_filters
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow_filters(img, style):
+            with lock:
+                running.append(style)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(style)
+            return apply_filters(img, style)
+
+        with mock.patch.object(self.processor, 'apply_filters', side_effect=slow_filters):
+            results = self.processor.convert_many(self.photos, 'sketch')
+
+        self.assertEqual([error for image, error in results], [None] * 4)
+        self.assertEqual(max(peak), 4)
+
+    def test_a_failing_image_only_fails_itself(self):
+        results = self.processor.convert_many([self.photos[0], b'not an image'], 'sketch')
+
+        self.assertEqual(results[0][0].size, (512, 512))
+        self.assertIsNone(results[0][1])
+        self.assertIsNone(results[1][0])
+        self.assertIsNotNone(results[1][1])
+
+    def test_works_inside_a_daemonic_worker_process(self):
+        # Celery's prefork pool runs tasks in daemonic processes, which may
+        # not start process pools of their own
+        context = multiprocessing.get_context('fork')
+        sizes = context.Queue()
+
+        def convert():
+            sizes.put([image.size for image, error in self.processor.convert_many(self.photos, 'sketch')])
+
+        worker = context.Process(target=convert, daemon=True)
+        worker.start()
+        worker.join(30)
+
+        self.assertEqual(sizes.get(timeout=1), [(512, 512)] * 4)
+
+
+@override_settings(REPLICATE_API_TOKEN='stand-in', FLUX_DEADLINE=0.2, FLUX_STYLE_DEADLINES={'sketch': 5})
+class FluxDeadlineTests(SimpleTestCase):
+    """Hedged conversions serve the filters when FLUX misses its deadline"""
+
+    def setUp(self):
+        cache.clear()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir, ignore_errors=True)
+        overrides = override_settings(RESULT_CACHE_DIR=cache_dir)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.processor = HuggingFaceProcessor()
+        self.photo = jpeg_bytes(make_test_image())
+
+    def stand_in_flux(self, delay):
+        self.processor.flux_client.client = FakeReplicate(jpeg_bytes(make_test_image(64, 48)), delay=delay)
+
+    def test_deadlines_are_per_style(self):
+        self.assertEqual(self.processor.flux_deadline('sketch'), 5)
+        self.assertEqual(self.processor.flux_deadline('anime'), 0.2)
+        with override_settings(FLUX_DEADLINE=0):
+            self.assertIsNone(self.processor.flux_deadline('anime'))
+
+    def test_slow_flux_is_hedged_with_the_filters_and_replaced_when_it_arrives(self):
+        self.stand_in_flux(delay=1)
+        late_results = []
+        arrived = threading.Event()
+
+        def on_late_result(image):
+            late_results.append(image)
+            arrived.set()
+
+        start = time.monotonic()
+        result = self.processor.convert_to_ghibli(self.photo, 'prompt', 'anime', hedge=True, on_late_result=on_late_result)
+
+        self.assertLess(time.monotonic() - start, 0.9)
+        self.assertTrue(result.deadline_fallback)
+        self.assertEqual(result.size, (512, 512))
+
+        self.assertTrue(arrived.wait(5))
+        self.assertEqual(late_results[0].size, (64, 48))
+        # The late result was cached, so the next request gets FLUX straight away
+        self.assertEqual(self.processor.convert_to_ghibli(self.photo, 'prompt', 'anime').size, (64, 48))
+
+    def test_flux_within_the_deadline_wins(self):
+        self.stand_in_flux(delay=0.01)
+        result = self.processor.convert_to_ghibli(self.photo, 'prompt', 'sketch', hedge=True)
+
+        self.assertEqual(result.size, (64, 48))
+        self.assertFalse(getattr(result, 'deadline_fallback', False))
+
+    @override_settings(FILTER_FULL_RESOLUTION=True)
+    def test_flux_failing_before_the_deadline_falls_back_to_one_filter_pass(self):
+        self.processor.flux_client.client = FailingReplicate(delay=0.05)
+        img = make_test_image()
+
+        result = self.processor.convert_to_ghibli(img, 'prompt', 'anime', hedge=True)
+
+        # One filter pass, as cached by the hedge
+        expected = open_encoded(encode_result(self.processor.apply_filters(img.copy(), 'anime')))
+        self.assertEqual(result.tobytes(), expected.tobytes())
+        self.assertFalse(getattr(result, 'deadline_fallback', False))
+
+    def test_several_styles_each_get_their_own_deadline(self):
+        self.stand_in_flux(delay=0.5)
+        late_results = []
+        arrived = threading.Event()
+
+        def on_late_result(style, image):
+            late_results.append((style, image.size))
+            arrived.set()
+
+        anime, sketch = self.processor.convert_styles(
+            self.photo, ['anime', 'sketch'], hedge=True, on_late_result=on_late_result
+        )
+
+        self.assertTrue(anime[0].deadline_fallback)
+        self.assertEqual(sketch[0].size, (64, 48))
+        self.assertFalse(getattr(sketch[0], 'deadline_fallback', False))
+        self.assertTrue(arrived.wait(5))
+        self.assertEqual(late_results, [('anime', (64, 48))])
+
+    def test_unhedged_conversions_wait_for_flux(self):
+        self.stand_in_flux(delay=0.4)
+        self.assertEqual(self.processor.convert_to_ghibli(self.photo, 'prompt', 'anime').size, (64, 48))
+
+
+class ResultCacheTests(SimpleTestCase):
+    """Hot tier, disk tier and LRU eviction of the result cache"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def test_key_depends_on_pixels_not_encoding(self):
+        img = make_test_image()
+        png = Image.open(BytesIO(png_bytes(img)))
+        png.load()
+        self.assertEqual(result_cache.image_digest(img), result_cache.image_digest(png))
+        self.assertNotEqual(
+            result_cache.result_key('abc', 'ghibli', 'prompt', 'flux'),
+            result_cache.result_key('abc', 'anime', 'prompt', 'flux'),
+        )
+
+    def test_disk_tier_survives_a_new_process(self):
+        ResultCache(self.directory, max_bytes=1000).put('a' * 64, b'result')
+
+        cache = ResultCache(self.directory, max_bytes=1000)
+        self.assertEqual(cache.get('a' * 64), b'result')
+        self.assertEqual(cache.get('a' * 64), b'result')
+        self.assertIsNone(cache.get('b' * 64))
+
+        stats = cache.stats()
+        self.assertEqual((stats['disk_hits'], stats['memory_hits'], stats['misses']), (1, 1, 1))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = ResultCache(self.directory, max_bytes=250, hot_entries=0)
+        for name in 'abc':
+            cache.put(name * 64, b'x' * 100)
+            # mtime is the LRU clock - keep the order unambiguous
+            time.sleep(0.01)
+            if name == 'b':
+                cache.get('a' * 64)
+
+        self.assertIsNotNone(cache.get('a' * 64))
+        self.assertIsNone(cache.get('b' * 64))
+        self.assertIsNotNone(cache.get('c' * 64))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_eviction_goes_down_to_the_low_water_mark(self):
+        cache = ResultCache(self.directory, max_bytes=1000, hot_entries=0, low_water=0.5)
+        for name in 'abcdefghij':
+            cache.put(name * 64, b'x' * 100)
+            time.sleep(0.01)
+
+        with mock.patch.object(cache, '_entries', wraps=cache._entries) as entries:
+            cache.put('k' * 64, b'x' * 100)
+            # The next writes fit under the budget again without walking the store
+            for name in 'lmn':
+                cache.put(name * 64, b'x' * 100)
+
+        self.assertEqual(entries.call_count, 1)
+        self.assertEqual(cache.stats()['evictions'], 6)
+        self.assertEqual(cache.disk_bytes, 800)
+
+    def test_counters_are_added_to_the_shared_store(self):
+        cache.clear()
+        writer = ResultCache(self.directory, max_bytes=1000, shared=cache)
+        writer.put('a' * 64, b'result')
+        ResultCache(self.directory, max_bytes=1000, shared=cache).get('a' * 64)
+        writer.get('b' * 64)
+
+        stats = result_cache.shared_stats(cache)
+        self.assertEqual((stats['stores'], stats['disk_hits'], stats['misses']), (1, 1, 1))
+        self.assertEqual(stats['hit_rate'], 0.5)
+
+
+class StartupTests(SimpleTestCase):
+    """Cold web and worker processes stay cheap: backends load on first use"""
+
+    def test_web_startup_stays_within_budget(self):
+        report = measure_startup(WEB_ENTRY_POINT)
+
+        self.assertEqual(report.heavy_modules(), [])
+        self.assertFalse(report.loaded('gallery.huggingface_processor'))
+        self.assertLessEqual(report.total_ms, settings.STARTUP_IMPORT_BUDGET_MS)
+
+    def test_worker_startup_skips_conversion_backends(self):
+        report = measure_startup(WORKER_ENTRY_POINT)
+
+        self.assertEqual(report.heavy_modules(), [])
+        self.assertLessEqual(report.total_ms, settings.STARTUP_IMPORT_BUDGET_MS)
+
+    def test_processor_is_built_once_on_first_use(self):
+        with mock.patch.object(huggingface_processor, '_processor', None):
+            with mock.patch.object(huggingface_processor, 'HuggingFaceProcessor') as factory:
+                self.assertIs(get_processor(), factory.return_value)
+                self.assertIs(huggingface_processor.processor, factory.return_value)
+                factory.assert_called_once_with()
+
+
+class ConversionSandbox:
+    """Media and the result cache in a temporary directory, converted by a fresh shared processor"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        overrides = override_settings(
+            MEDIA_ROOT=self.media_root, RESULT_CACHE_DIR=self.media_root + '/cache', **self.sandbox_settings()
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.processor = HuggingFaceProcessor()
+        patcher = mock.patch('gallery.huggingface_processor._processor', self.processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def sandbox_settings(self):
+        """Further settings the processor is built with"""
+        return {}
+
+
+# Tasks run in the test process; the broker stays in memory
+eager_celery = override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    CELERY_BROKER_URL='memory://',
+)
+
+
+@eager_celery
+@override_settings(REPLICATE_API_TOKEN='')
+class BatchProcessingTests(ConversionSandbox, TestCase):
+    """End to end: a ZIP goes in, one artwork per valid image comes out"""
+
+    def test_filter_batch_converts_every_valid_image(self):
+        images = {f'photo_{i}.jpg': jpeg_bytes(make_test_image(seed=i)) for i in range(4)}
+        batch = BatchUpload(name='Holiday', conversion_method='cartoon')
+        batch.zip_file.save('holiday.zip', ContentFile(make_zip(images)))
+
+        process_batch.apply(args=[str(batch.id)])
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'completed')
+        self.assertEqual(batch.total_images, 4)
+        self.assertEqual(batch.processed_images, 4)
+        self.assertEqual(batch.successful_images, 4)
+        self.assertEqual(batch.failed_images, 0)
+        for artwork in batch.artworks.all():
+            self.assertEqual(artwork.status, 'completed')
+            with Image.open(artwork.converted_image.path) as converted:
+                self.assertEqual(converted.size, (512, 512))
+
+    def test_duplicate_images_in_a_zip_share_one_conversion(self):
+        photo = jpeg_bytes(make_test_image())
+        images = {'a.jpg': photo, 'copy_of_a.jpg': photo, 'b.jpg': jpeg_bytes(make_test_image(seed=1))}
+        batch = BatchUpload(name='Dupes', conversion_method='ghibli')
+        batch.zip_file.save('dupes.zip', ContentFile(make_zip(images)))
+
+        process_batch.apply(args=[str(batch.id)])
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.successful_images, 3)
+        self.assertEqual(self.processor.cache.stats()['stores'], 2)
+
+    def test_small_jpegs_are_only_decoded_to_convert_them(self):
+        truncated = jpeg_bytes(make_test_image(seed=3))
+        images = {
+            'day1/photo.jpg': jpeg_bytes(make_test_image(seed=1)),
+            'day2/photo.jpg': jpeg_bytes(make_test_image(seed=2)),
+            'truncated.jpg': truncated[:len(truncated) // 2],
+            'broken.png': b'not an image',
+            '__MACOSX/._photo.jpg': b'resource fork',
+        }
+        zip_data = make_zip(images)
+        batch = BatchUpload(name='Trip', conversion_method='anime', manifest=build_manifest(BytesIO(zip_data)))
+        batch.zip_file.save('trip.zip', ContentFile(zip_data))
+
+        with mock.patch('PIL.Image.open', wraps=Image.open) as image_open:
+            process_batch.apply(args=[str(batch.id)])
+
+        batch.refresh_from_db()
+        self.assertEqual((batch.total_images, batch.processed_images), (3, 3))
+        self.assertEqual((batch.successful_images, batch.failed_images), (2, 1))
+        # Stored as extracted: the truncated JPEG only fails once it is converted
+        self.assertEqual(image_open.call_count, 3)
+        self.assertEqual(len({artwork.original_image.name for artwork in batch.artworks.all()}), 3)
+        self.assertEqual(batch.artworks.get(status='failed').name, 'Trip - truncated.jpg')
+
+    def test_large_images_are_scaled_down_when_extracted(self):
+        buffer = BytesIO()
+        make_test_image().save(buffer, 'PNG')
+        images = {'large.jpg': jpeg_bytes(make_test_image(2048, 1024)), 'small.png': buffer.getvalue()}
+        batch = BatchUpload(name='Sizes', conversion_method='sketch')
+        batch.zip_file.save('sizes.zip', ContentFile(make_zip(images)))
+
+        process_batch.apply(args=[str(batch.id)])
+
+        for artwork in batch.artworks.all():
+            with Image.open(artwork.original_image.path) as original:
+                self.assertEqual(original.format, 'JPEG')
+                self.assertLessEqual(max(original.size), 1024)
+
+    def test_failure_while_extracting_fails_the_batch(self):
+        batch = BatchUpload(name='Broken', conversion_method='ghibli')
+        batch.zip_file.save('broken.zip', ContentFile(make_zip({'a.jpg': jpeg_bytes(make_test_image())})))
+
+        with mock.patch('gallery.batch_processor.insert_batch_artworks', side_effect=RuntimeError('disk full')):
+            process_batch.apply(args=[str(batch.id)])
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'failed')
+        self.assertEqual(batch.error_message, 'disk full')
+
+    def count_extraction_queries(self, count):
+        images = {f'photo_{i}.jpg': jpeg_bytes(make_test_image(seed=i)) for i in range(count)}
+        batch = BatchUpload(name='Queries', conversion_method='sketch', max_concurrency=2)
+        batch.zip_file.save('queries.zip', ContentFile(make_zip(images)))
+
+        # Only the extraction: the conversions are counted by BatchFanOutTests
+        with mock.patch.object(convert_batch_images, 'apply_async'), CaptureQueriesContext(connection) as queries:
+            process_batch.apply(args=[str(batch.id)])
+
+        self.assertEqual(batch.artworks.count(), count)
+        return [query['sql'].split()[0] for query in queries.captured_queries]
+
+    def test_extracted_images_share_their_inserts(self):
+        small = self.count_extraction_queries(4)
+        large = self.count_extraction_queries(20)
+
+        # Artworks are inserted in chunks, each moving the counters once and
+        # trying once for a free lane
+        self.assertEqual(large.count('INSERT') - small.count('INSERT'), 2)
+        self.assertEqual(len(large) - len(small), 2 * 3)
+
+    def test_images_are_converted_from_memory(self):
+        img = make_test_image()
+        encoded = jpeg_bytes(img)
+
+        from_bytes = self.processor.convert_image(encoded, 'anime')
+        self.assertEqual(self.processor.convert_image(memoryview(encoded), 'anime'), from_bytes)
+        self.assertEqual(self.processor.convert_image(Image.open(BytesIO(encoded)), 'anime'), from_bytes)
+        with Image.open(BytesIO(from_bytes)) as result:
+            self.assertEqual((result.format, result.size), ('JPEG', (512, 512)))
+
+        # The same pixels decoded elsewhere hit the cached result
+        self.assertEqual(self.processor.cache.stats()['stores'], 1)
+
+
+class ZipManifestTests(SimpleTestCase):
+    """One pass over the central directory and the image headers"""
+
+    def test_entries_describe_each_image_member(self):
+        photo = jpeg_bytes(make_test_image(300, 200))
+        archive = make_zip({
+            'trip/photo.jpg': photo,
+            'disguised.jpg': png_bytes(make_test_image(64, 48)),
+            'notes.jpg': b'not an image',
+            '__MACOSX/trip/._photo.jpg': b'resource fork',
+            'readme.txt': b'hello',
+        })
+
+        manifest = build_manifest(BytesIO(archive))
+
+        self.assertEqual([entry['name'] for entry in manifest], ['trip/photo.jpg', 'disguised.jpg', 'notes.jpg'])
+        photo_entry = manifest[0]
+        self.assertEqual(photo_entry['size'], len(photo))
+        self.assertEqual(photo_entry['crc'], zipfile.crc32(photo))
+        self.assertEqual(photo_entry['offset'], 0)
+        self.assertEqual((photo_entry['type'], photo_entry['width'], photo_entry['height']), ('JPEG', 300, 200))
+        # The type is sniffed from the header, not taken from the extension
+        self.assertEqual(manifest[1]['type'], 'PNG')
+        self.assertIsNone(manifest[2]['type'])
+        self.assertEqual(len(valid_entries(manifest)), 2)
+
+
+class PrefetchTests(SimpleTestCase):
+    """The bounded queue between ZIP decoding and conversion"""
+
+    def test_items_arrive_in_order_while_the_producer_stays_bounded(self):
+        produced = []
+
+        def source():
+            for i in range(20):
+                produced.append(i)
+                yield i
+
+        items = prefetch(source(), 2)
+        self.assertEqual(next(items), 0)
+        time.sleep(0.2)
+        # One handed over, two queued, one waiting to be put
+        self.assertLessEqual(len(produced), 4)
+        self.assertEqual(list(items), list(range(1, 20)))
+
+    def test_closing_early_stops_the_producer_and_closes_the_source(self):
+        closed = threading.Event()
+
+        def source():
+            try:
+                for i in range(1000):
+                    yield i
+            finally:
+                closed.set()
+
+        items = prefetch(source(), 2)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertTrue(closed.is_set())
+
+    def test_producer_errors_reach_the_consumer(self):
+        def source():
+            yield 1
+            raise ValueError('truncated archive')
+
+        with self.assertRaisesMessage(ValueError, 'truncated archive'):
+            list(prefetch(source(), 2))
+
+
+@eager_celery
+@override_settings(REPLICATE_API_TOKEN='')
+class ConversionQueueTests(ConversionSandbox, TestCase):
+    """Uploads are handed to the Celery task instead of converted in the request"""
+
+    def upload(self, extra_styles=(), **headers):
+        photo = SimpleUploadedFile('photo.jpg', jpeg_bytes(make_test_image()), content_type='image/jpeg')
+        data = {'name': 'Meadow', 'original_image': photo, 'conversion_method': 'ghibli', 'extra_styles': list(extra_styles)}
+        return self.client.post(reverse('upload'), data, headers=headers)
+
+    def test_upload_queues_the_task_and_redirects(self):
+        with mock.patch.object(convert_to_ghibli, 'apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.upload()
+
+        artwork = GhibliArtwork.objects.get()
+        self.assertRedirects(response, reverse('artwork_detail', kwargs={'pk': artwork.pk}), fetch_redirect_response=False)
+        self.assertEqual(artwork.status, 'pending')
+        self.assertIsNone(artwork.converted_image.name or None)
+        apply_async.assert_called_once_with(args=[str(artwork.pk)], task_id=artwork.task_id)
+
+    def test_ajax_upload_returns_a_job_handle(self):
+        with mock.patch.object(convert_to_ghibli, 'apply_async'):
+            response = self.upload(x_requested_with='XMLHttpRequest')
+
+        artwork = GhibliArtwork.objects.get()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()['task_id'], artwork.task_id)
+        self.assertEqual(self.client.get(response.json()['status_url']).json()['status'], 'pending')
+
+    def test_upload_shows_an_instant_preview_until_the_result_is_ready(self):
+        with mock.patch.object(convert_to_ghibli, 'apply_async'):
+            response = self.upload(x_requested_with='XMLHttpRequest')
+        artwork = GhibliArtwork.objects.get()
+
+        with Image.open(artwork.preview_image.path) as preview:
+            self.assertLessEqual(max(preview.size), settings.PREVIEW_MAX_SIDE)
+        status = self.client.get(response.json()['status_url']).json()
+        self.assertEqual(status['preview_image_url'], artwork.preview_image.url)
+
+        convert_to_ghibli.apply(args=[str(artwork.pk)])
+        status = self.client.get(response.json()['status_url']).json()
+        self.assertNotIn('preview_image_url', status)
+        self.assertIn('converted_image_url', status)
+
+    @override_settings(PREVIEW_MAX_SIDE=0)
+    def test_previews_can_be_turned_off(self):
+        with mock.patch.object(convert_to_ghibli, 'apply_async'):
+            self.upload()
+
+        self.assertFalse(GhibliArtwork.objects.get().preview_image)
+
+    def test_late_flux_result_replaces_the_deadline_fallback(self):
+        with mock.patch.object(convert_to_ghibli, 'apply_async'):
+            self.upload()
+        artwork = GhibliArtwork.objects.get()
+        hedge = make_test_image(512, 512)
+        hedge.deadline_fallback = True
+        with mock.patch.object(self.processor, 'convert_to_ghibli', return_value=hedge) as convert:
+            convert_to_ghibli.apply(args=[str(artwork.pk)])
+
+        artwork.refresh_from_db()
+        self.assertTrue(artwork.deadline_fallback)
+        on_late_result = convert.call_args.kwargs['on_late_result']
+        fallback_path = artwork.converted_image.path
+
+        on_late_result(make_test_image(64, 48))
+
+        artwork.refresh_from_db()
+        self.assertFalse(artwork.deadline_fallback)
+        with Image.open(artwork.converted_image.path) as converted:
+            self.assertEqual(converted.size, (64, 48))
+        self.assertFalse(os.path.exists(fallback_path))
+
+    def test_unreachable_broker_fails_the_upload(self):
+        # Outside a test transaction on_commit runs the callback straight away
+        with mock.patch('gallery.tasks.transaction.on_commit', side_effect=lambda callback: callback()):
+            with mock.patch.object(convert_to_ghibli, 'apply_async', side_effect=OSError('connection refused')):
+                self.upload()
+
+        artwork = GhibliArtwork.objects.get()
+        self.assertEqual(artwork.status, 'failed')
+        self.assertIn('connection refused', artwork.error_message)
+
+    def test_queued_task_converts_the_artwork(self):
+        with mock.patch.object(convert_to_ghibli, 'apply_async'):
+            self.upload()
+        artwork = GhibliArtwork.objects.get()
+
+        convert_to_ghibli.apply(args=[str(artwork.pk)])
+
+        artwork.refresh_from_db()
+        self.assertEqual(artwork.status, 'completed')
+        self.assertTrue(artwork.converted_image)
+
+
+    def test_extra_styles_are_converted_from_one_decode_of_one_original(self):
+        with mock.patch.object(self.processor, 'decode_input', wraps=self.processor.decode_input) as decode_input:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.upload(extra_styles=['anime', 'sketch', 'ghibli'])
+
+        artwork = GhibliArtwork.objects.get(variant_of__isnull=True)
+        variants = sorted(artwork.variants.all(), key=lambda v: v.conversion_method)
+        self.assertEqual([v.conversion_method for v in variants], ['anime', 'sketch'])
+        decode_input.assert_called_once()
+
+        converted = set()
+        for a in [artwork, *variants]:
+            self.assertEqual(a.status, 'completed')
+            self.assertEqual(a.original_image.name, artwork.original_image.name)
+            self.assertTrue(a.preview_image)
+            with Image.open(a.converted_image.path) as result:
+                converted.add(result.tobytes())
+        self.assertEqual(len(converted), 3)
+        self.assertEqual(len(os.listdir(os.path.join(self.media_root, 'originals'))), 1)
+
+        self.client.force_login(get_user_model().objects.create_user('viewer', password='x'))
+        response = self.client.get(reverse('artwork_detail', kwargs={'pk': variants[0].pk}))
+        self.assertEqual(response.context['style_variants'], [artwork, *variants])
+
+    def test_retrying_styles_only_redoes_the_failed_ones(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.upload(extra_styles=['anime', 'sketch'])
+        artwork = GhibliArtwork.objects.get(variant_of__isnull=True)
+        artwork.variants.filter(conversion_method='sketch').update(status='failed')
+
+        with mock.patch.object(self.processor, 'convert_styles', wraps=self.processor.convert_styles) as convert_styles:
+            convert_artwork_styles.apply(args=[str(artwork.pk)])
+
+        self.assertEqual(convert_styles.call_args.args[1], ['sketch'])
+        self.assertFalse(GhibliArtwork.objects.exclude(status='completed').exists())
+
+
+@eager_celery
+@override_settings(REPLICATE_API_TOKEN='', BATCH_MAX_CONCURRENCY=4)
+class BatchFanOutTests(ConversionSandbox, TestCase):
+    """Batches are converted one Celery task per image, finished by the progress counters"""
+
+    def upload_batch(self, count, **fields):
+        images = {f'photo_{i}.jpg': jpeg_bytes(make_test_image(seed=i)) for i in range(count)}
+        zip_file = SimpleUploadedFile('photos.zip', make_zip(images), content_type='application/zip')
+        data = {'name': 'Holiday', 'zip_file': zip_file, 'conversion_method': 'sketch', **fields}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('batch_upload'), data)
+        batch = BatchUpload.objects.get()
+        self.assertRedirects(response, reverse('batch_detail', kwargs={'pk': batch.pk}), fetch_redirect_response=False)
+        batch.refresh_from_db()
+        return batch
+
+    def test_every_image_is_converted_and_the_counters_complete_the_batch(self):
+        batch = self.upload_batch(5)
+
+        self.assertEqual(batch.status, 'completed')
+        self.assertIsNotNone(batch.processing_completed)
+        self.assertEqual((batch.total_images, batch.processed_images), (5, 5))
+        self.assertEqual((batch.successful_images, batch.failed_images), (5, 0))
+        self.assertEqual(batch.artworks.filter(status='completed').count(), 5)
+        self.assertEqual(batch.active_lanes, 0)
+
+    @override_settings(BATCH_IMAGES_PER_TASK=2)
+    def test_images_run_in_at_most_the_batch_concurrency_limit_of_lanes(self):
+        with mock.patch.object(convert_batch_images, 'apply_async') as apply_async:
+            batch = self.upload_batch(5, max_concurrency=4)
+
+        # Two lanes of two images each
+        self.assertEqual([queued.kwargs['args'][2] for queued in apply_async.call_args_list], [2, 2])
+        self.assertEqual((batch.status, batch.active_lanes, batch.processed_images), ('processing', 2, 0))
+
+        # Each lane queues the next waiting images as it finishes
+        for queued in apply_async.call_args_list:
+            convert_batch_images.apply(**queued.kwargs)
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.active_lanes), ('completed', 0))
+        self.assertEqual((batch.processed_images, batch.successful_images), (5, 5))
+        self.assertEqual(batch.artworks.filter(status='completed').count(), 5)
+
+    def test_images_are_queued_as_soon_as_their_chunk_is_inserted(self):
+        images = {f'photo_{i}.jpg': jpeg_bytes(make_test_image(seed=i)) for i in range(BATCH_CREATE_CHUNK + 1)}
+        batch = BatchUpload(name='Early', conversion_method='sketch')
+        batch.zip_file.save('early.zip', ContentFile(make_zip(images)))
+        chunks = []
+
+        def convert(task_id, **kwargs):
+            # The extraction is still going when the first conversion starts
+            chunks.append(GhibliArtwork.objects.filter(batch_upload=batch).count())
+            with mock.patch('gallery.tasks.continue_batch_lane', return_value=True):
+                convert_batch_images.apply(task_id=task_id, **kwargs)
+
+        with mock.patch.object(convert_batch_images, 'apply_async', side_effect=convert):
+            process_batch.apply(args=[str(batch.pk)])
+
+        self.assertEqual(chunks[0], BATCH_CREATE_CHUNK)
+
+    def test_upload_keeps_the_manifest_and_processing_never_rescans(self):
+        with mock.patch('gallery.zip_manifest.build_manifest') as build_manifest:
+            batch = self.upload_batch(3)
+
+        build_manifest.assert_not_called()
+        self.assertEqual([entry['name'] for entry in batch.manifest], [f'photo_{i}.jpg' for i in range(3)])
+        self.assertEqual(batch.successful_images, 3)
+
+    def test_zip_without_decodable_images_is_rejected(self):
+        zip_file = SimpleUploadedFile('photos.zip', make_zip({'a.jpg': b'not an image'}))
+        data = {'name': 'Holiday', 'zip_file': zip_file, 'conversion_method': 'sketch'}
+        response = self.client.post(reverse('batch_upload'), data)
+
+        self.assertContains(response, 'No valid image files found in ZIP')
+        self.assertFalse(BatchUpload.objects.exists())
+
+    def test_concurrency_above_the_configured_limit_is_rejected(self):
+        zip_file = SimpleUploadedFile('photos.zip', make_zip({'a.jpg': jpeg_bytes(make_test_image())}))
+        data = {'name': 'Holiday', 'zip_file': zip_file, 'conversion_method': 'sketch', 'max_concurrency': 5}
+        response = self.client.post(reverse('batch_upload'), data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(BatchUpload.objects.exists())
+
+    def test_progress_updates_are_atomic_increments(self):
+        batch = BatchUpload.objects.create(name='Counters', total_images=3)
+        stale = BatchUpload.objects.get(pk=batch.pk)
+
+        record_batch_progress(batch.pk, True)
+        record_batch_progress(batch.pk, False)
+        # A worker holding an old copy of the row adds to, not overwrites, the counts
+        with self.assertNumQueries(1):
+            record_batch_progress(stale.pk, True)
+
+        batch.refresh_from_db()
+        self.assertEqual((batch.processed_images, batch.successful_images, batch.failed_images), (3, 2, 1))
+
+
+    @override_settings(BATCH_IMAGES_PER_TASK=2)
+    def test_fanned_out_task_costs_three_queries_plus_two_per_image(self):
+        batch = BatchUpload.objects.create(name='Trio', conversion_method='sketch', total_images=3, active_lanes=1)
+        for name, task_id in (('Forest', 'lane-task'), ('Lake', 'lane-task'), ('River', None)):
+            artwork = GhibliArtwork(
+                name=name, conversion_method='sketch', batch_upload=batch, status='processing', task_id=task_id
+            )
+            artwork.original_image.save(f'{name}.jpg', ContentFile(jpeg_bytes(make_test_image())))
+
+        # Load the artworks, write each result and move its counter, count them
+        # into the batch, claim the next images
+        with mock.patch.object(convert_batch_images, 'apply_async') as apply_async, self.assertNumQueries(7):
+            self.assertEqual(convert_batch_images.apply(args=[str(batch.pk), 2, 2], task_id='lane-task').get(), 2)
+
+        self.assertEqual(apply_async.call_args.kwargs['args'], [str(batch.pk), 2, 1])
+        next_task_id = apply_async.call_args.kwargs['task_id']
+        self.assertEqual(GhibliArtwork.objects.get(task_id=next_task_id).name, 'River')
+
+    @override_settings(BATCH_IMAGES_PER_TASK=4)
+    def test_one_task_keeps_the_flux_predictions_of_its_images_in_flight_together(self):
+        self.processor.use_ai = True
+        self.processor.flux_client.client = FakeReplicate(jpeg_bytes(make_test_image(64, 48)))
+
+        batch = self.upload_batch(4, max_concurrency=4)
+
+        self.assertEqual((batch.status, batch.successful_images), ('completed', 4))
+        self.assertEqual(self.processor.flux_client.client.peak_in_flight, 4)
+
+    @override_settings(BATCH_IMAGES_PER_TASK=1)
+    def test_copies_in_a_zip_share_one_original_and_one_lane(self):
+        cache.clear()
+        photo = jpeg_bytes(make_test_image())
+        images = {'a.jpg': photo, 'b.jpg': jpeg_bytes(make_test_image(seed=1)), 'copy_of_a.jpg': photo}
+        zip_file = SimpleUploadedFile('dupes.zip', make_zip(images), content_type='application/zip')
+        data = {'name': 'Dupes', 'zip_file': zip_file, 'conversion_method': 'sketch', 'max_concurrency': 2}
+        with mock.patch.object(convert_batch_images, 'apply_async') as apply_async:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('batch_upload'), data)
+        batch = BatchUpload.objects.get()
+
+        # Both lanes run at once, yet the copies are one lane's work
+        self.assertEqual([queued.kwargs['args'][2] for queued in apply_async.call_args_list], [2, 1])
+        copy, original = (batch.artworks.get(name=f'Dupes - {name}') for name in ('copy_of_a.jpg', 'a.jpg'))
+        self.assertEqual(copy.original_image.name, original.original_image.name)
+        self.assertEqual(copy.task_id, original.task_id)
+
+        for queued in apply_async.call_args_list:
+            convert_batch_images.apply(**queued.kwargs)
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.successful_images), ('completed', 3))
+        # The stats API reads the counters the conversions left in the shared cache
+        self.assertEqual(self.client.get(reverse('gallery_stats_api')).json()['result_cache']['stores'], 2)
+
+    def test_a_claimed_image_deleted_meanwhile_is_still_counted(self):
+        batch = BatchUpload.objects.create(
+            name='Gone', conversion_method='sketch', status='processing', total_images=1, active_lanes=1
+        )
+
+        convert_batch_images.apply(args=[str(batch.pk), 1, 1], task_id='lane-task')
+
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.failed_images, batch.active_lanes), ('completed', 1, 0))
+
+    def test_waiting_images_have_not_started_and_survive_the_cleanup(self):
+        with mock.patch.object(convert_batch_images, 'apply_async'):
+            batch = self.upload_batch(3, max_concurrency=1)
+        waiting = batch.artworks.filter(task_id__isnull=True)
+        self.assertEqual(waiting.count(), 2)
+        self.assertFalse(waiting.filter(processing_started__isnull=False).exists())
+        waiting_ids = list(waiting.values_list('pk', flat=True))
+
+        with mock.patch.object(convert_batch_images, 'apply_async'), \
+                mock.patch('gallery.tasks.timezone.now', return_value=timezone.now() + timedelta(hours=2)):
+            cleanup_failed_artworks()
+
+        self.assertEqual(GhibliArtwork.objects.filter(pk__in=waiting_ids, status='processing').count(), 2)
+
+    def test_cleanup_counts_a_dead_lane_image_and_the_batch_goes_on(self):
+        with mock.patch.object(convert_batch_images, 'apply_async') as apply_async:
+            batch = self.upload_batch(2, max_concurrency=1)
+        self.assertEqual((apply_async.call_count, batch.active_lanes), (1, 1))
+
+        # The worker converting the claimed image was killed: its task never ran
+        with mock.patch('gallery.tasks.timezone.now', return_value=timezone.now() + timedelta(hours=2)):
+            cleanup_failed_artworks()
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.status, 'completed')
+        self.assertEqual((batch.processed_images, batch.successful_images, batch.failed_images), (2, 1, 1))
+        self.assertEqual(batch.active_lanes, 0)
+
+    @override_settings(BATCH_IMAGES_PER_TASK=1)
+    def test_retry_starts_again_from_no_lanes(self):
+        with mock.patch.object(convert_batch_images, 'apply_async'):
+            batch = self.upload_batch(2, max_concurrency=2)
+        # Both lanes died with their workers, holding their slots
+        self.assertEqual(batch.active_lanes, 2)
+
+        process_batch.apply(args=[str(batch.pk)])
+
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.active_lanes), ('completed', 0))
+        self.assertEqual((batch.processed_images, batch.successful_images), (2, 2))
+
+    def test_progress_is_coalesced_into_periodic_updates(self):
+        batch = BatchUpload.objects.create(name='Counters', total_images=7)
+        progress = BatchProgress(batch.pk, flush_items=3, flush_seconds=60)
+
+        with self.assertNumQueries(2):
+            for succeeded in (True, True, False, True, True, True, False):
+                progress.record(succeeded)
+        with self.assertNumQueries(1):
+            progress.flush()
+        with self.assertNumQueries(0):
+            progress.flush()
+
+        batch.refresh_from_db()
+        self.assertEqual((batch.processed_images, batch.successful_images, batch.failed_images), (7, 5, 2))
+
+    def test_progress_is_flushed_when_the_interval_elapses(self):
+        batch = BatchUpload.objects.create(name='Counters', total_images=2)
+        progress = BatchProgress(batch.pk, flush_items=100, flush_seconds=60)
+
+        progress.record(True)
+        with mock.patch('gallery.batch_processor.time.monotonic', return_value=time.monotonic() + 61):
+            progress.record(True)
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.processed_images, 2)
+
+
+@eager_celery
+@override_settings(REPLICATE_API_TOKEN='')
+class ArtworkStatsTests(ConversionSandbox, TestCase):
+    """Statistics are counters kept in step with status transitions"""
+
+    def artwork(self, status='pending', method='ghibli'):
+        return GhibliArtwork.objects.create(
+            name='Meadow', original_image='originals/meadow.jpg', original_file_size=1,
+            status=status, conversion_method=method,
+        )
+
+    def assertCountsMatchTable(self):
+        recount = {key: count for key, count in group_counts(GhibliArtwork.objects.all()).items()}
+        counted = {key: count for key, count in artwork_counts().items() if count}
+        self.assertEqual(counted, recount)
+
+    def test_stats_endpoints_do_not_query_the_table(self):
+        self.artwork('completed', 'sketch')
+        self.artwork('failed')
+
+        # Only the counters
+        with self.assertNumQueries(1):
+            data = self.client.get(reverse('gallery_stats_api')).json()
+        self.assertEqual(data['stats']['total'], 2)
+        self.assertEqual(data['stats']['failed'], 1)
+        self.assertEqual(data['methods']['sketch']['count'], 1)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('home'))
+        self.assertEqual(response.context['stats']['total_artworks'], 2)
+        self.assertEqual(len(queries), 2)  # the recent artworks and the counters
+
+    def test_transitions_keep_the_counters_in_step(self):
+        artwork_stats()
+        with self.captureOnCommitCallbacks(execute=True):
+            artwork = self.artwork()
+            artwork.create_variants(['anime', 'sketch'])
+            artwork.status = 'processing'
+            artwork.save(update_fields=['status'])
+            GhibliArtwork.objects.filter(variant_of=artwork).update(status='processing')
+            done = GhibliArtwork.objects.get(conversion_method='anime')
+            done.status = 'completed'
+            done.save()
+            self.artwork(method='huggingface')
+            self.artwork('failed').delete()
+        self.assertCountsMatchTable()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            artwork.delete()
+        self.assertEqual(artwork_stats()['total'], 1)
+        self.assertCountsMatchTable()
+
+    def test_reconciliation_repairs_drift(self):
+        self.artwork()
+        artwork_stats()
+        # A write that skips the model entirely
+        with connection.cursor() as cursor:
+            cursor.execute("UPDATE gallery_ghibliartwork SET status = 'completed'")
+        self.assertEqual(artwork_stats()['status']['pending'], 1)
+
+        reconcile_artwork_stats.apply()
+        self.assertEqual(artwork_stats()['status'], {'pending': 0, 'processing': 0, 'completed': 1, 'failed': 0})
+
+    def test_counters_move_in_the_same_transaction_as_the_artwork(self):
+        artwork = self.artwork()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            artwork.status = 'completed'
+            artwork.save(update_fields=['status'])
+            GhibliArtwork.objects.filter(pk=artwork.pk).update(status='failed')
+            raise RuntimeError('rolled back')
+
+        self.assertEqual(artwork_stats()['status'], {'pending': 1, 'processing': 0, 'completed': 0, 'failed': 0})
+
+
+class CursorPaginationTests(TestCase):
+    """Listings seek past the last row shown instead of counting and offsetting"""
+
+    def setUp(self):
+        GhibliArtwork.objects.bulk_create([
+            GhibliArtwork(
+                name=f'Artwork {i:02}', original_image='originals/a.jpg', original_file_size=1,
+                status='completed', processing_time=None if i % 3 else float(i % 4),
+            )
+            for i in range(25)
+        ])
+        # Ties on the sort field are broken by id
+        GhibliArtwork.objects.filter(name__lt='Artwork 10').update(created_at=timezone.now())
+
+    def walk(self, order_by, per_page=10):
+        paginator = CursorPaginator(GhibliArtwork.objects.all(), per_page, order_by)
+        pages = [paginator.get_page()]
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(after=pages[-1].next_cursor))
+        return paginator, pages
+
+    def test_pages_cover_every_row_once_in_order(self):
+        for order_by in ('-created_at', 'name', '-processing_time', 'processing_time'):
+            with self.subTest(order_by=order_by):
+                paginator, pages = self.walk(order_by)
+                seen = [artwork.pk for page in pages for artwork in page]
+                expected = list(GhibliArtwork.objects.order_by(*paginator._ordering()).values_list('pk', flat=True))
+                self.assertEqual(seen, expected)
+                self.assertEqual([len(page) for page in pages], [10, 10, 5])
+
+                # And back again from the last page
+                previous = paginator.get_page(before=pages[-1].previous_cursor)
+                self.assertEqual(list(previous), list(pages[-2]))
+                self.assertEqual(list(paginator.get_page(before=previous.previous_cursor)), list(pages[0]))
+                self.assertFalse(paginator.get_page(before=previous.previous_cursor).has_previous())
+
+    def test_queue_and_batch_listings_link_to_the_next_page(self):
+        batch = BatchUpload.objects.create(name='Batch', total_images=25)
+        GhibliArtwork.objects.update(status='pending', batch_upload=batch)
+        self.client.force_login(get_user_model().objects.create_user('viewer', password='pw'))
+
+        for url in (reverse('processing'), batch.get_absolute_url()):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.context['total_count'], 25)
+                self.assertContains(response, f'?after={response.context["page_obj"].next_cursor}')
+
+    def test_a_bad_cursor_falls_back_to_the_first_page(self):
+        paginator, pages = self.walk('-created_at')
+        self.assertEqual(list(paginator.get_page(after='not-a-cursor')), list(pages[0]))
+
+    def test_every_gallery_sort_is_read_in_index_order(self):
+        for order_by in ('-created_at', 'created_at', 'name', '-name', '-processing_time', 'processing_time'):
+            for style_filter in ({}, {'conversion_method': 'anime'}):
+                with self.subTest(order_by=order_by, **style_filter):
+                    artworks = GhibliArtwork.objects.filter(status='completed', **style_filter)
+                    ordering = CursorPaginator(artworks, 12, order_by)._ordering()
+                    plan = artworks.order_by(*ordering)[:13].explain()
+                    self.assertIn('USING INDEX artwork_status_', plan)
+                    self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_deep_pages_cost_the_same_as_the_first(self):
+        paginator, pages = self.walk('-created_at', per_page=5)
+        self.client.force_login(get_user_model().objects.create_user('viewer', password='pw'))
+        artwork_stats()
+        costs = []
+        for page in (None, pages[-1].previous_cursor):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('gallery'), {'after': page} if page else {})
+            self.assertEqual(response.status_code, 200)
+            sql = ' '.join(query['sql'] for query in queries).upper()
+            self.assertNotIn('OFFSET', sql)
+            self.assertNotIn('COUNT(', sql)
+            costs.append(len(queries))
+        self.assertEqual(costs[0], costs[1])
+
+
+class ArtworkSearchTests(TestCase):
+    """Gallery search goes through the FTS5 index the model signals maintain"""
+
+    def setUp(self):
+        self.backend = get_search_backend()
+        self.batch = BatchUpload.objects.create(name='Harbour trip')
+        self.spirit = self.artwork('Forest spirit')
+        self.away = self.artwork('Spirited away', batch_upload=self.batch)
+        self.harbour = self.artwork('Foggy morning', batch_upload=self.batch, conversion_method='sketch')
+
+    def artwork(self, name, **fields):
+        return GhibliArtwork.objects.create(
+            name=name, original_image='originals/a.jpg', original_file_size=1, status='completed', **fields
+        )
+
+    def search(self, query):
+        return self.backend.ranked_ids(GhibliArtwork.objects.all(), query, 10)
+
+    def test_word_prefixes_match_names_batches_and_styles(self):
+        self.assertCountEqual(self.search('spiri'), [self.spirit.pk, self.away.pk])
+        self.assertCountEqual(self.search('harb'), [self.away.pk, self.harbour.pk])
+        self.assertEqual(self.search('pencil'), [self.harbour.pk])
+        self.assertEqual(self.search('forest spi'), [self.spirit.pk])
+
+    def test_name_matches_rank_above_batch_matches(self):
+        named = self.artwork('Harbour lights')
+        self.assertEqual(self.search('harbour')[0], named.pk)
+
+    def test_substrings_fall_back_to_the_trigram_index(self):
+        self.assertEqual(self.search('oggy'), [self.harbour.pk])
+        self.assertEqual(self.search('zz'), [])
+
+    def test_terms_too_short_for_trigrams_still_match_substrings(self):
+        self.assertEqual(self.search('gg'), [self.harbour.pk])
+        self.assertEqual(list(self.backend.filter(GhibliArtwork.objects.all(), 'ay')), [self.away])
+        self.assertEqual(self.search('q'), [])
+
+    def test_prefixes_are_only_looked_for_among_the_searched_artworks(self):
+        self.artwork('Ornament')
+        in_batch = GhibliArtwork.objects.filter(batch_upload=self.batch)
+
+        # 'Ornament' is outside the batch, so 'orn' is a substring of 'morning'
+        self.assertEqual(self.backend.ranked_ids(in_batch, 'orn', 10), [self.harbour.pk])
+        self.assertEqual(list(self.backend.filter(in_batch, 'orn')), [self.harbour])
+
+    def test_index_follows_saves_deletes_and_bulk_creates(self):
+        self.spirit.name = 'Castle in the sky'
+        self.spirit.save(update_fields=['name'])
+        self.assertEqual(self.search('castle'), [self.spirit.pk])
+        self.assertEqual(self.search('forest'), [])
+
+        variants = self.spirit.create_variants(['anime'])
+        self.assertCountEqual(self.search('castle'), [self.spirit.pk, variants[0].pk])
+
+        self.batch.name = 'Seaside trip'
+        self.batch.save()
+        self.assertCountEqual(self.search('seaside'), [self.away.pk, self.harbour.pk])
+
+        self.away.delete()
+        self.batch.delete()
+        self.assertEqual(self.search('seaside'), [])
+        self.assertEqual(self.search('spirited'), [])
+
+    def test_batch_artworks_are_indexed_when_the_batch_completes(self):
+        batch = BatchUpload.objects.create(name='Mountain hike', status='processing', total_images=3, processed_images=3)
+        artworks = GhibliArtwork.objects.bulk_create([
+            GhibliArtwork(
+                name=f'Peak {i}', original_image='originals/a.jpg', original_file_size=1,
+                batch_upload=batch, conversion_method='vibrant',
+            )
+            for i in range(3)
+        ])
+        self.assertEqual(self.search('mountain'), [])
+
+        complete_batch(batch.pk)
+        self.assertCountEqual(self.search('mountain vibrant'), [artwork.pk for artwork in artworks])
+        self.assertEqual(len(self.search('colors')), 3)
+
+    def test_gallery_search_uses_the_index(self):
+        self.client.force_login(get_user_model().objects.create_user('viewer', password='pw'))
+        for sort in ('relevance', '-created_at'):
+            with self.subTest(sort=sort):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(reverse('gallery'), {'search': 'spiri', 'sort': sort})
+                self.assertCountEqual([a.pk for a in response.context['page_obj']], [self.spirit.pk, self.away.pk])
+                self.assertEqual(response.context['total_count'], 2)
+                self.assertNotIn(' LIKE ', ' '.join(query['sql'] for query in queries).upper())
+
+
+class ViewCostTests(TestCase):
+    """Listing pages run a fixed number of queries and load only the rows and columns they render"""
+
+    def setUp(self):
+        self.client.force_login(get_user_model().objects.create_user('viewer', password='pw'))
+        self.batch = BatchUpload.objects.create(name='Batch', total_images=30)
+        GhibliArtwork.objects.bulk_create([
+            GhibliArtwork(
+                name=f'Artwork {i}', original_image='originals/a.jpg', converted_image='converted/a.jpg',
+                original_file_size=1, status='completed' if i % 3 else 'processing',
+                error_message='x' * 1000, batch_upload=self.batch,
+            )
+            for i in range(30)
+        ])
+        self.artwork = GhibliArtwork.objects.filter(status='completed').first()
+        self.artwork.create_variants(['anime', 'sketch'])
+        artwork_stats()
+
+    def page_cost(self, url, params=None):
+        """(queries, artwork rows, artwork columns loaded) of one page view"""
+        from_db = GhibliArtwork.from_db.__func__
+        loaded = []
+
+        def counting_from_db(cls, db, field_names, values):
+            loaded.append(field_names)
+            return from_db(cls, db, field_names, values)
+
+        with mock.patch.object(GhibliArtwork, 'from_db', classmethod(counting_from_db)):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return len(queries), len(loaded), set().union(*loaded)
+
+    def assertPageCost(self, url, max_queries, max_rows, params=None, full_rows=0):
+        queries, rows, columns = self.page_cost(url, params)
+        self.assertLessEqual(queries, max_queries)
+        self.assertLessEqual(rows, max_rows)
+        if not full_rows:
+            self.assertNotIn('error_message', columns)
+
+    # Keyset pages fetch one row more than they show, to know whether there is a next page
+
+    def test_gallery(self):
+        self.assertPageCost(reverse('gallery'), 4, 12 + 1)
+        self.assertPageCost(reverse('gallery'), 5, 12, {'search': 'artwork'})
+        self.assertPageCost(reverse('gallery'), 6, 12 + 1, {'search': 'artwork', 'sort': 'name'})
+
+    def test_processing(self):
+        self.assertPageCost(reverse('processing'), 4, 10 + 1)
+
+    def test_batch_detail(self):
+        self.assertPageCost(self.batch.get_absolute_url(), 4, 12 + 1)
+
+    def test_home(self):
+        self.assertPageCost(reverse('home'), 4, 6)
+
+    def test_artwork_detail(self):
+        # The artwork itself is the one full row
+        self.assertPageCost(self.artwork.get_absolute_url(), 5, 1 + 4 + 2, full_rows=1)
+
+
+class ServerEventsTests(TestCase):
+    """Pages follow progress over Server-Sent Events fed by the published state changes"""
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.artwork = GhibliArtwork.objects.create(
+            name='Meadow', original_image='originals/meadow.jpg', original_file_size=1,
+        )
+
+    def events(self, response):
+        """The stream as decoded chunks, read one at a time"""
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        return (chunk.decode() for chunk in response.streaming_content)
+
+    def data(self, chunk):
+        self.assertTrue(chunk.startswith('data: '), chunk)
+        return json.loads(chunk[len('data: '):])
+
+    def test_memory_broker_delivers_across_threads(self):
+        broker = MemoryBroker()
+
+        async def listen():
+            async with broker.subscribe('artwork:1') as subscription:
+                threading.Thread(target=broker.publish, args=('artwork:1', {'n': 1})).start()
+                threading.Thread(target=broker.publish, args=('artwork:2', {'n': 2})).start()
+                first = await subscription.next(timeout=2)
+                second = await subscription.next(timeout=0.1)
+            return first, second
+
+        self.assertEqual(asyncio.run(listen()), ({'n': 1}, None))
+        self.assertEqual(broker.subscriptions, {})
+
+    def test_async_stream_sends_state_on_each_burst_of_changes(self):
+        states = iter([('pending', False), ('processing', False), ('completed', True)])
+        broker = MemoryBroker()
+
+        async def collect():
+            chunks = []
+            async for chunk in stream_events('artwork:1', lambda: next(states), keepalive=5, max_age=5):
+                chunks.append(chunk)
+                if len(chunks) < 3:
+                    # Two notices in a row are answered by one read
+                    broker.publish('artwork:1', {})
+                    broker.publish('artwork:1', {})
+            return chunks
+
+        with mock.patch('gallery.events._broker', broker):
+            chunks = asyncio.run(collect())
+        self.assertEqual([self.data(chunk) for chunk in chunks], ['pending', 'processing', 'completed'])
+
+    @override_settings(CELERY_TASK_ALWAYS_EAGER=False, EVENTS_POLL_INTERVAL=0.05)
+    def test_async_stream_polls_when_worker_notices_cannot_reach_it(self):
+        # In-process channels, tasks in other processes: no notice ever comes
+        states = iter([('pending', False), ('pending', False), ('completed', True)])
+
+        async def collect():
+            return [chunk async for chunk in stream_events('artwork:1', lambda: next(states), keepalive=5, max_age=5)]
+
+        with mock.patch('gallery.events._broker', MemoryBroker()):
+            chunks = asyncio.run(collect())
+        self.assertEqual(chunks[1], ': keepalive\n\n')
+        self.assertEqual([self.data(chunk) for chunk in (chunks[0], chunks[2])], ['pending', 'completed'])
+
+    def test_wsgi_sends_one_snapshot_and_lets_the_browser_reconnect(self):
+        with override_settings(EVENTS_POLL_INTERVAL=3):
+            response = self.client.get(reverse('artwork_events', args=[self.artwork.pk]))
+
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertFalse(response.streaming)
+        retry, data = response.content.decode().split('\n', 1)
+        self.assertEqual(retry, 'retry: 3000')
+        self.assertEqual(self.data(data)['status'], 'pending')
+
+    def test_processing_snapshot_has_the_queue_counts(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.artwork.create_variants(['anime'])
+        response = self.client.get(reverse('processing_events'))
+
+        body = response.content.decode()
+        self.assertEqual(self.data(body[body.index('data: '):]), {'pending': 2, 'processing': 0})
+
+    def test_finished_batch_sends_one_event(self):
+        batch = BatchUpload.objects.create(name='Done', status='completed', total_images=2, processed_images=2)
+        body = self.client.get(reverse('batch_events', args=[batch.pk])).content.decode()
+        self.assertEqual(body.count('data: '), 1)
+        self.assertEqual(self.data(body[body.index('data: '):])['progress_percentage'], 100)
+
+    def read_in_background(self, response):
+        """Queue of the decoded chunks, read by a task - cancelling it is the browser going away"""
+        chunks = asyncio.Queue()
+
+        async def read():
+            async for chunk in response.streaming_content:
+                await chunks.put(chunk.decode())
+
+        return chunks, asyncio.create_task(read())
+
+    async def disconnect(self, reader):
+        reader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await reader
+        self.assertEqual(get_broker().subscriptions, {})
+
+    async def test_asgi_stream_runs_on_the_event_loop(self):
+        response = await self.async_client.get(reverse('artwork_events', args=[self.artwork.pk]))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(response.is_async)
+
+        chunks, reader = self.read_in_background(response)
+        self.assertEqual(self.data(await chunks.get())['status'], 'pending')
+        await self.disconnect(reader)
+
+    @override_settings(EVENTS_KEEPALIVE=0.05)
+    async def test_asgi_processing_stream_follows_the_queue(self):
+        response = await self.async_client.get(reverse('processing_events'))
+        chunks, reader = self.read_in_background(response)
+        self.assertEqual(self.data(await chunks.get()), {'pending': 1, 'processing': 0})
+        self.assertEqual(await chunks.get(), ': keepalive\n\n')
+
+        get_broker().publish(QUEUE_CHANNEL, {})
+        self.assertEqual(self.data(await chunks.get()), {'pending': 1, 'processing': 0})
+        await self.disconnect(reader)
+
+
+class StandInReplicate:
+    """
+    Local stand-in for the Replicate API
+
+    Accepts file uploads and prediction requests, serves prediction output,
+    and fires signed webhooks when a prediction is completed
+    """
+
+    def __init__(self, output, secret):
+        self.output = output
+        self.secret = secret
+        self.predictions = {}
+        # Output downloads that answer 503 before one succeeds
+        self.failures_left = 0
+        provider = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path == '/v1/files':
+                    self.reply(201, provider.file_json())
+                elif self.path.endswith('/predictions'):
+                    self.reply(201, provider.create(json.loads(body)))
+                else:
+                    self.reply(404, {})
+
+            def do_GET(self):
+                if self.path.startswith('/output/') and provider.failures_left:
+                    provider.failures_left -= 1
+                    self.reply(503, {})
+                elif self.path.startswith('/output/'):
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'image/jpeg')
+                    self.send_header('Content-Length', str(len(provider.output)))
+                    self.end_headers()
+                    self.wfile.write(provider.output)
+                else:
+                    self.reply(404, {})
+
+            def reply(self, status, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def file_json(self):
+        return {
+            'id': uuid.uuid4().hex, 'name': 'input.jpg', 'content_type': 'image/jpeg',
+            'size': 0, 'etag': '', 'checksums': {}, 'metadata': {},
+            'created_at': '2026-01-01T00:00:00Z', 'expires_at': None,
+            'urls': {'get': f"{self.url}/files/input.jpg"},
+        }
+
+    def create(self, body):
+        prediction = {
+            'id': uuid.uuid4().hex, 'model': 'black-forest-labs/flux-kontext-pro', 'version': '',
+            'status': 'starting', 'input': body.get('input'), 'output': None, 'logs': '',
+            'error': None, 'metrics': {}, 'created_at': '2026-01-01T00:00:00Z', 'urls': {},
+        }
+        self.predictions[prediction['id']] = (prediction, body['webhook'])
+        return prediction
+
+    def complete(self, prediction_id, status='succeeded'):
+        """Finish a prediction and deliver its webhook; returns the webhook response"""
+        prediction, webhook = self.predictions[prediction_id]
+        prediction = dict(prediction, status=status)
+        if status == 'succeeded':
+            prediction['output'] = f"{self.url}/output/{prediction_id}.jpg"
+        else:
+            prediction['error'] = 'model crashed'
+        return self.deliver(webhook, json.dumps(prediction).encode())
+
+    def deliver(self, webhook, body, secret=None):
+        webhook_id = f"msg_{uuid.uuid4().hex}"
+        timestamp = str(int(time.time()))
+        key = base64.b64decode((secret or self.secret).split('_', 1)[1])
+        digest = hmac.new(key, f"{webhook_id}.{timestamp}.".encode() + body, hashlib.sha256).digest()
+        headers = {
+            'Content-Type': 'application/json',
+            'webhook-id': webhook_id,
+            'webhook-timestamp': timestamp,
+            'webhook-signature': f"v1,{base64.b64encode(digest).decode()}",
+        }
+        return requests.post(webhook, data=body, headers=headers, timeout=30)
+
+
+class PredictionWebhookTests(ConversionSandbox, LiveServerTestCase):
+    """FLUX predictions are started without waiting and finished by the webhook"""
+
+    secret = 'whsec_' + base64.b64encode(b'stand-in webhook key').decode()
+
+    def sandbox_settings(self):
+        return {
+            'REPLICATE_API_TOKEN': 'stand-in',
+            'REPLICATE_WEBHOOK_HOST': self.live_server_url,
+            'REPLICATE_WEBHOOK_SECRET': self.secret,
+        }
+
+    def setUp(self):
+        super().setUp()
+        self.output = make_test_image(96, 64, seed=7)
+        self.provider = StandInReplicate(jpeg_bytes(self.output), self.secret)
+        self.addCleanup(self.provider.stop)
+        self.processor.flux_client.client = replicate.Client(api_token='stand-in', base_url=self.provider.url)
+
+        self.artwork = GhibliArtwork(
+            name='Forest', conversion_method='ghibli', status='processing', processing_started=timezone.now()
+        )
+        self.artwork.original_image.save('forest.jpg', ContentFile(jpeg_bytes(make_test_image())), save=False)
+        self.artwork.save()
+
+    def test_webhook_completes_the_artwork(self):
+        self.assertTrue(start_prediction(self.artwork))
+        self.artwork.refresh_from_db()
+        self.assertEqual(self.artwork.status, 'processing')
+        self.assertEqual(self.artwork.prediction_status, 'starting')
+
+        # The download retries past a transient CDN error
+        self.provider.failures_left = 1
+        response = self.provider.complete(self.artwork.prediction_id)
+
+        self.assertEqual(response.status_code, 200)
+        self.artwork.refresh_from_db()
+        self.assertEqual(self.artwork.status, 'completed')
+        self.assertEqual(self.artwork.prediction_status, 'succeeded')
+        # The provider's JPEG is stored byte for byte, never re-encoded
+        with open(self.artwork.converted_image.path, 'rb') as converted:
+            self.assertEqual(converted.read(), self.provider.output)
+
+        # A redelivered webhook leaves the finished artwork alone
+        self.assertEqual(self.provider.complete(self.artwork.prediction_id).status_code, 200)
+
+    def test_failed_prediction_falls_back_to_filters(self):
+        start_prediction(self.artwork)
+
+        self.provider.complete(self.artwork.prediction_id, status='failed')
+
+        self.artwork.refresh_from_db()
+        self.assertEqual(self.artwork.status, 'completed')
+        self.assertEqual(self.artwork.prediction_status, 'failed')
+        with Image.open(self.artwork.converted_image.path) as converted:
+            self.assertEqual(converted.size, (512, 512))
+
+    def test_late_prediction_replaces_the_filter_result_served_at_the_deadline(self):
+        start_prediction(self.artwork)
+        self.assertTrue(hedge_prediction(self.artwork))
+
+        self.artwork.refresh_from_db()
+        self.assertEqual(self.artwork.status, 'completed')
+        self.assertTrue(self.artwork.deadline_fallback)
+        fallback_path = self.artwork.converted_image.path
+
+        self.provider.complete(self.artwork.prediction_id)
+
+        self.artwork.refresh_from_db()
+        self.assertFalse(self.artwork.deadline_fallback)
+        with open(self.artwork.converted_image.path, 'rb') as converted:
+            self.assertEqual(converted.read(), self.provider.output)
+        self.assertFalse(os.path.exists(fallback_path))
+
+    @override_settings(FLUX_REPLACE_LATE_RESULTS=False)
+    def test_late_prediction_can_be_left_out(self):
+        start_prediction(self.artwork)
+        hedge_prediction(self.artwork)
+
+        self.provider.complete(self.artwork.prediction_id)
+
+        self.artwork.refresh_from_db()
+        self.assertTrue(self.artwork.deadline_fallback)
+        self.assertEqual(self.artwork.prediction_status, 'succeeded')
+        with Image.open(self.artwork.converted_image.path) as converted:
+            self.assertEqual(converted.size, (512, 512))
+
+    def test_unsigned_webhook_is_rejected(self):
+        start_prediction(self.artwork)
+        body = json.dumps({'id': self.artwork.prediction_id, 'status': 'succeeded'}).encode()
+
+        forged = 'whsec_' + base64.b64encode(b'someone else').decode()
+        response = self.provider.deliver(webhook_url(self.artwork), body, secret=forged)
+
+        self.assertEqual(response.status_code, 403)
+        self.artwork.refresh_from_db()
+        self.assertEqual(self.artwork.status, 'processing')
+
+    def test_webhook_only_finishes_its_own_prediction(self):
+        start_prediction(self.artwork)
+        body = json.dumps({'id': self.artwork.prediction_id, 'status': 'succeeded'}).encode()
+        other_prediction = json.dumps({'id': 'another-prediction', 'status': 'succeeded'}).encode()
+        wrong_token = self.live_server_url + reverse(
+            'replicate_webhook', kwargs={'pk': self.artwork.pk, 'token': 'guessed'}
+        )
+
+        self.assertEqual(self.provider.deliver(wrong_token, body).status_code, 404)
+        self.assertEqual(self.provider.deliver(webhook_url(self.artwork), other_prediction).status_code, 404)
+        self.artwork.refresh_from_db()
+        self.assertEqual(self.artwork.status, 'processing')
+
+    def test_styles_of_one_upload_are_started_as_predictions(self):
+        variant, = self.artwork.create_variants(['anime'])
+
+        with mock.patch.object(enforce_flux_deadline, 'apply_async') as enforce:
+            convert_artwork_styles.apply(args=[str(self.artwork.pk)])
+
+        artworks = [self.artwork, variant]
+        for artwork in artworks:
+            artwork.refresh_from_db()
+            self.assertEqual(artwork.status, 'processing')
+            self.assertEqual(artwork.prediction_status, 'starting')
+        self.assertCountEqual(
+            [c.kwargs['args'] for c in enforce.call_args_list], [[str(a.pk)] for a in artworks]
+        )
+
+        for artwork in artworks:
+            self.provider.complete(artwork.prediction_id)
+            artwork.refresh_from_db()
+            self.assertEqual(artwork.status, 'completed')
+
+    def test_webhooks_need_a_secret(self):
+        start_prediction(self.artwork)
+        body = json.dumps({'id': self.artwork.prediction_id, 'status': 'succeeded'}).encode()
+
+        with override_settings(REPLICATE_WEBHOOK_SECRET=''):
+            self.assertFalse(webhooks_enabled())
+            response = requests.post(webhook_url(self.artwork), data=body, timeout=30)
+
+        self.assertEqual(response.status_code, 403)
+        self.artwork.refresh_from_db()
+        self.assertEqual(self.artwork.status, 'processing')
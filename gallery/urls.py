@@ -30,6 +30,12 @@ urlpatterns = [
     path('api/gallery/stats/', views.gallery_stats_api, name='gallery_stats_api'),
     path('api/upload/progress/', views.upload_progress_api, name='upload_progress_api'),
     path('api/batch/<uuid:pk>/progress/', views.batch_progress_api, name='batch_progress_api'),
+
+    # Server-Sent Events streams, replacing the polling of the APIs above
+    path('api/artwork/<uuid:pk>/events/', views.artwork_events, name='artwork_events'),
+    path('api/batch/<uuid:pk>/events/', views.batch_events, name='batch_events'),
+    path('api/processing/events/', views.processing_events, name='processing_events'),
+    path('api/replicate/webhook/<uuid:pk>/<str:token>/', views.replicate_webhook_view, name='replicate_webhook'),
     path('register-admin/', views.admin_register_view, name='admin_register'),
     path('register-client/', views.client_register_view, name='client_register'),
     path('login/', views.login_view, name='login'),
@@ -2,34 +2,53 @@
 Views for the Ghibli Gallery app
 Handles web pages and user interactions
 """
+import json
 from django.contrib.auth import authenticate, login, logout
 from django.contrib import messages
+from django.conf import settings
 from django.urls import reverse
 from django.contrib.auth.decorators import login_required, user_passes_test
+from django.core.cache import cache
+from django.core.handlers.asgi import ASGIRequest
 from .forms import AdminRegisterForm, ClientRegisterForm
 
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib import messages
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse, HttpResponseBadRequest, HttpResponseForbidden, HttpResponseNotFound, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.core.paginator import Paginator
-from django.db.models import Q
 from .models import GhibliArtwork
 from .forms import ArtworkUploadForm, QuickUploadForm
 from .models import BatchUpload
 from .forms import BatchUploadForm
-from .batch_processor import process_batch_upload
+from .events import QUEUE_CHANNEL, artwork_channel, batch_channel, snapshot_event, stream_events
+from .pagination import COUNT_CAP, CursorPaginator, RankedPaginator, capped_count
+from .result_cache import shared_stats
+from .search import get_search_backend
+from .stats import artwork_stats
+
+# Columns each listing renders, so error messages and prediction details stay
+# in the table; status and conversion_method are always loaded as the
+# statistics follow them on save
+CARD_FIELDS = ('id', 'name', 'original_image', 'converted_image', 'conversion_method', 'status')
+GALLERY_FIELDS = (*CARD_FIELDS, 'created_at', 'processing_time')
+PROCESSING_FIELDS = ('id', 'name', 'original_image', 'conversion_method', 'status', 'created_at', 'processing_started')
+# batch_upload too: the related manager reads it to attach the batch to each row
+BATCH_ARTWORK_FIELDS = (*CARD_FIELDS, 'batch_upload', 'created_at', 'processing_time')
 
 def home_view(request):
     """Home page with upload form and recent artworks"""
     # Get recent completed artworks for display
-    recent_artworks = GhibliArtwork.objects.filter(status='completed')[:6]
+    recent_artworks = GhibliArtwork.objects.filter(status='completed').only(*CARD_FIELDS, 'created_at')[:6]
     
-    # Calculate statistics
+    # Statistics come from the counters, not the artworks table
+    counts = artwork_stats()
     stats = {
-        'total_artworks': GhibliArtwork.objects.count(),
-        'completed_artworks': GhibliArtwork.objects.filter(status='completed').count(),
-        'processing_artworks': GhibliArtwork.objects.filter(status='processing').count(),
-        'pending_artworks': GhibliArtwork.objects.filter(status='pending').count(),
+        'total_artworks': counts['total'],
+        'completed_artworks': counts['status']['completed'],
+        'processing_artworks': counts['status']['processing'],
+        'pending_artworks': counts['status']['pending'],
     }
     
     # Quick upload form for home page
@@ -42,81 +61,60 @@ def home_view(request):
     }
     return render(request, 'home.html', context)
 
+def cursor_page(request, queryset, per_page, order_by='-created_at', count=None):
+    """The page of a listing the after/before cursors of the request point at"""
+    paginator = CursorPaginator(queryset, per_page, order_by, count)
+    return paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
+
+def queue_conversion(request, artwork, success_message, with_variants=False):
+    """
+    Hand an artwork to the Celery worker and answer without waiting for it
+    
+    AJAX callers get the job handle as JSON; forms are redirected to the
+    detail page, which follows the conversion from there.
+    """
+    from .tasks import enqueue_conversion
+    
+    wants_json = request.headers.get('x-requested-with') == 'XMLHttpRequest'
+    try:
+        task_id = enqueue_conversion(artwork, with_variants=with_variants)
+    except Exception as e:
+        # Broker unreachable - nothing will pick the artwork up
+        artwork.status = 'failed'
+        artwork.error_message = f'Could not queue the conversion: {e}'
+        artwork.save()
+        if wants_json:
+            return JsonResponse(
+                {'id': str(artwork.pk), 'status': artwork.status, 'error': artwork.error_message},
+                status=503
+            )
+        messages.warning(request, f'Upload successful but the conversion could not be queued: {str(e)}')
+        return redirect('artwork_detail', pk=artwork.pk)
+    
+    if wants_json:
+        return JsonResponse({
+            'id': str(artwork.pk),
+            'task_id': task_id,
+            'status': artwork.status,
+            'status_url': reverse('artwork_status_api', kwargs={'pk': artwork.pk}),
+            'detail_url': artwork.get_absolute_url(),
+        }, status=202)
+    
+    messages.success(request, success_message)
+    return redirect('artwork_detail', pk=artwork.pk)
+
 def upload_view(request):
     """Handle artwork upload with full form"""
     if request.method == 'POST':
         form = ArtworkUploadForm(request.POST, request.FILES)
         if form.is_valid():
             artwork = form.save()
-            
-            # Process immediately instead of background
-            try:
-                from .huggingface_processor import processor
-                from django.utils import timezone
-                from django.core.files.base import ContentFile
-                from io import BytesIO
-                import time
-                
-                # Update status to processing
-                artwork.status = 'processing'
-                artwork.processing_started = timezone.now()
-                artwork.save()
-                
-                start_time = time.time()
-                
-                # Create conversion prompt
-                prompt = f"Convert this image of {artwork.name} into Studio Ghibli anime art style"
-                
-                # Use the Hugging Face processor
-                result_image = processor.convert_to_ghibli(
-                    image_path=artwork.original_image.path,
-                    prompt=prompt,
-                    model_name=artwork.conversion_method
-                )
-                
-                if result_image:
-                    # Convert PIL Image to bytes
-                    output_buffer = BytesIO()
-                    result_image.save(output_buffer, format='JPEG', quality=95)
-                    image_content = ContentFile(output_buffer.getvalue())
-                    
-                    # Save the converted image
-                    filename = f"{artwork.id}_ghibli.jpg"
-                    artwork.converted_image.save(filename, image_content, save=False)
-                    
-                    # Update artwork status
-                    artwork.status = 'completed'
-                    artwork.processing_completed = timezone.now()
-                    artwork.processing_time = time.time() - start_time
-                    artwork.save()
-                    
-                    messages.success(
-                        request, 
-                        f'🎉 Successfully converted "{artwork.name}" to Ghibli style in {artwork.processing_time:.1f} seconds!'
-                    )
-                else:
-                    # Conversion failed
-                    artwork.status = 'failed'
-                    artwork.error_message = 'Hugging Face API returned no image'
-                    artwork.save()
-                    
-                    messages.warning(
-                        request,
-                        f'Upload successful but conversion failed. The image might be processing on Hugging Face servers. Try again in a few minutes.'
-                    )
-                    
-            except Exception as e:
-                # Handle conversion errors
-                artwork.status = 'failed'
-                artwork.error_message = str(e)
-                artwork.save()
-                
-                messages.warning(
-                    request,
-                    f'Upload successful but conversion failed: {str(e)}'
-                )
-            
-            return redirect('artwork_detail', pk=artwork.pk)
+            variants = artwork.create_variants(form.cleaned_data['extra_styles'])
+            return queue_conversion(
+                request, artwork,
+                f'📬 "{artwork.name}" uploaded - converting to {len(variants) + 1} style(s) now.',
+                with_variants=bool(variants)
+            )
         else:
             messages.error(request, 'Please correct the errors below.')
     else:
@@ -140,72 +138,10 @@ def quick_upload_view(request):
                 conversion_method='huggingface'  # Default to Hugging Face
             )
             
-            # Process immediately
-            try:
-                from .huggingface_processor import processor
-                from django.utils import timezone
-                from django.core.files.base import ContentFile
-                from io import BytesIO
-                import time
-                
-                # Update status to processing
-                artwork.status = 'processing'
-                artwork.processing_started = timezone.now()
-                artwork.save()
-                
-                start_time = time.time()
-                
-                # Create conversion prompt
-                prompt = f"Convert this image of {artwork.name} into Studio Ghibli anime art style"
-                
-                # Use the Hugging Face processor
-                result_image = processor.convert_to_ghibli(
-                    image_path=artwork.original_image.path,
-                    prompt=prompt,
-                    model_name=artwork.conversion_method
-                )
-                
-                if result_image:
-                    # Convert PIL Image to bytes
-                    output_buffer = BytesIO()
-                    result_image.save(output_buffer, format='JPEG', quality=95)
-                    image_content = ContentFile(output_buffer.getvalue())
-                    
-                    # Save the converted image
-                    filename = f"{artwork.id}_ghibli.jpg"
-                    artwork.converted_image.save(filename, image_content, save=False)
-                    
-                    # Update artwork status
-                    artwork.status = 'completed'
-                    artwork.processing_completed = timezone.now()
-                    artwork.processing_time = time.time() - start_time
-                    artwork.save()
-                    
-                    messages.success(
-                        request,
-                        f'🎉 Quick upload success! "{artwork.name}" converted to Ghibli style in {artwork.processing_time:.1f} seconds!'
-                    )
-                else:
-                    artwork.status = 'failed'
-                    artwork.error_message = 'Conversion failed - no image returned'
-                    artwork.save()
-                    
-                    messages.warning(
-                        request,
-                        f'Upload successful but conversion failed. Try again in a few minutes.'
-                    )
-                    
-            except Exception as e:
-                artwork.status = 'failed'
-                artwork.error_message = str(e)
-                artwork.save()
-                
-                messages.warning(
-                    request,
-                    f'Upload successful but conversion failed: {str(e)}'
-                )
-            
-            return redirect('artwork_detail', pk=artwork.pk)
+            return queue_conversion(
+                request, artwork,
+                f'📬 Quick upload success! "{artwork.name}" is being converted to Ghibli style.'
+            )
         else:
             messages.error(request, 'Upload failed. Please check your image and try again.')
     
@@ -218,29 +154,39 @@ def gallery_view(request):
     # Filter options
     method_filter = request.GET.get('method')
     search_query = request.GET.get('search')
-    sort_by = request.GET.get('sort', '-created_at')
+    # Searches list the best matches first unless another order is asked for
+    sort_by = request.GET.get('sort', 'relevance' if search_query else '-created_at')
     
     # Base queryset - only completed artworks
-    artworks = GhibliArtwork.objects.filter(status='completed')
+    artworks = GhibliArtwork.objects.filter(status='completed').only(*GALLERY_FIELDS)
     
     # Apply filters
     if method_filter:
         artworks = artworks.filter(conversion_method=method_filter)
     
-    if search_query:
-        artworks = artworks.filter(
-            Q(name__icontains=search_query)
-        )
-    
     # Apply sorting
     valid_sorts = ['-created_at', 'created_at', 'name', '-name', '-processing_time', 'processing_time']
-    if sort_by in valid_sorts:
-        artworks = artworks.order_by(sort_by)
-    
-    # Pagination
-    paginator = Paginator(artworks, 12)  # Show 12 artworks per page
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    if search_query:
+        valid_sorts.append('relevance')
+    if sort_by not in valid_sorts:
+        sort_by = '-created_at'
+    
+    # Pagination - show 12 artworks per page. Searches go through the search
+    # index and are counted up to a cap; everything else comes from the stats counters
+    if search_query and sort_by == 'relevance':
+        ranked_ids = get_search_backend().ranked_ids(artworks, search_query, COUNT_CAP + 1)
+        paginator = RankedPaginator(artworks, ranked_ids, 12)
+        page_obj = paginator.get_page(after=request.GET.get('after'), before=request.GET.get('before'))
+        total_count = paginator.count
+    else:
+        if search_query:
+            artworks = get_search_backend().filter(artworks, search_query)
+            total_count = capped_count(artworks)
+        elif method_filter:
+            total_count = artwork_stats()['completed_by_method'].get(method_filter, 0)
+        else:
+            total_count = artwork_stats()['status']['completed']
+        page_obj = cursor_page(request, artworks, 12, sort_by, total_count)
     
     # Filter options for template
     conversion_methods = GhibliArtwork.CONVERSION_METHODS
@@ -251,7 +197,8 @@ def gallery_view(request):
         'current_method': method_filter,
         'search_query': search_query,
         'current_sort': sort_by,
-        'total_count': artworks.count(),
+        'total_count': min(total_count, COUNT_CAP),
+        'count_capped': total_count > COUNT_CAP,
     }
     return render(request, 'gallery.html', context)
 
@@ -264,11 +211,19 @@ def artwork_detail_view(request, pk):
     similar_artworks = GhibliArtwork.objects.filter(
         conversion_method=artwork.conversion_method,
         status='completed'
-    ).exclude(pk=artwork.pk)[:4]
+    ).exclude(pk=artwork.pk).only(*CARD_FIELDS)[:4]
+    
+    # Every style converted from the same original, this one included
+    original = artwork.variant_of or artwork
+    style_order = [code for code, name in GhibliArtwork.CONVERSION_METHODS]
+    style_variants = [original, *sorted(
+        original.variants.only(*CARD_FIELDS, 'variant_of'), key=lambda variant: style_order.index(variant.conversion_method)
+    )]
     
     context = {
         'artwork': artwork,
         'similar_artworks': similar_artworks,
+        'style_variants': style_variants if len(style_variants) > 1 else [],
     }
     return render(request, 'detail.html', context)
 
@@ -276,30 +231,29 @@ def processing_view(request):
     """View for artworks currently being processed"""
     processing_artworks = GhibliArtwork.objects.filter(
         status__in=['pending', 'processing']
-    ).order_by('-created_at')
+    ).only(*PROCESSING_FIELDS)
     
-    paginator = Paginator(processing_artworks, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    counts = artwork_stats()['status']
+    total_count = counts['pending'] + counts['processing']
+    page_obj = cursor_page(request, processing_artworks, 10, count=total_count)
     
     context = {
         'page_obj': page_obj,
-        'total_count': processing_artworks.count(),
+        'total_count': total_count,
         'page_title': 'Processing Queue'
     }
     return render(request, 'processing.html', context)
 
 def failed_view(request):
     """View for failed artworks"""
-    failed_artworks = GhibliArtwork.objects.filter(status='failed').order_by('-created_at')
+    failed_artworks = GhibliArtwork.objects.filter(status='failed')
     
-    paginator = Paginator(failed_artworks, 10)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    total_count = artwork_stats()['status']['failed']
+    page_obj = cursor_page(request, failed_artworks, 10, count=total_count)
     
     context = {
         'page_obj': page_obj,
-        'total_count': failed_artworks.count(),
+        'total_count': total_count,
         'page_title': 'Failed Conversions'
     }
     return render(request, 'failed.html', context)
@@ -310,70 +264,34 @@ def retry_artwork_view(request, pk):
         artwork = get_object_or_404(GhibliArtwork, pk=pk)
         
         if artwork.status == 'failed':
-            # Process immediately on retry
-            try:
-                from .huggingface_processor import processor
-                from django.utils import timezone
-                from django.core.files.base import ContentFile
-                from io import BytesIO
-                import time
-                
-                # Update status to processing
-                artwork.status = 'processing'
-                artwork.processing_started = timezone.now()
-                artwork.error_message = ''
-                artwork.save()
-                
-                start_time = time.time()
-                
-                # Create conversion prompt
-                prompt = f"Convert this image of {artwork.name} into Studio Ghibli anime art style"
-                
-                # Use the Hugging Face processor
-                result_image = processor.convert_to_ghibli(
-                    image_path=artwork.original_image.path,
-                    prompt=prompt,
-                    model_name='ghibli_diffusion'
-                )
-                
-                if result_image:
-                    # Convert PIL Image to bytes
-                    output_buffer = BytesIO()
-                    result_image.save(output_buffer, format='JPEG', quality=95)
-                    image_content = ContentFile(output_buffer.getvalue())
-                    
-                    # Save the converted image
-                    filename = f"{artwork.id}_ghibli.jpg"
-                    artwork.converted_image.save(filename, image_content, save=False)
-                    
-                    # Update artwork status
-                    artwork.status = 'completed'
-                    artwork.processing_completed = timezone.now()
-                    artwork.processing_time = time.time() - start_time
-                    artwork.save()
-                    
-                    messages.success(request, f'🎉 Successfully retried and converted "{artwork.name}" to Ghibli style!')
-                else:
-                    artwork.status = 'failed'
-                    artwork.error_message = 'Retry failed - no image returned'
-                    artwork.save()
-                    messages.warning(request, f'Retry failed for "{artwork.name}". Please try again later.')
-                    
-            except Exception as e:
-                artwork.status = 'failed'
-                artwork.error_message = str(e)
-                artwork.save()
-                messages.error(request, f'Retry failed: {str(e)}')
+            return queue_conversion(
+                request, artwork,
+                f'🔄 Retrying "{artwork.name}" - the conversion is queued.',
+                with_variants=artwork.variants.exclude(status='completed').exists()
+            )
         else:
             messages.error(request, 'Can only retry failed artworks')
     
     return redirect('artwork_detail', pk=pk)
 
-# API Views for AJAX requests
-def artwork_status_api(request, pk):
-    """API endpoint to check artwork status"""
-    artwork = get_object_or_404(GhibliArtwork, pk=pk)
+def event_stream(request, channel, snapshot):
+    """
+    Server-Sent Events response relaying snapshot() on every change published to channel
     
+    Under WSGI it is a single snapshot instead: the browser reconnects after
+    the retry interval, rather than a worker thread being held per page.
+    """
+    if isinstance(request, ASGIRequest):
+        response = StreamingHttpResponse(stream_events(channel, snapshot), content_type='text/event-stream')
+    else:
+        response = HttpResponse(snapshot_event(snapshot), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Keeps nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# API Views for AJAX requests
+def artwork_status_data(artwork):
     data = {
         'status': artwork.status,
         'status_display': artwork.get_status_display(),
@@ -382,37 +300,83 @@ def artwork_status_api(request, pk):
         'error_message': artwork.error_message,
         'processing_time': artwork.processing_time,
         'created_at': artwork.created_at.isoformat(),
+        'task_id': artwork.task_id,
+        'deadline_fallback': artwork.deadline_fallback,
     }
     
     if artwork.is_processed and artwork.converted_image:
         data['converted_image_url'] = artwork.converted_image.url
+    elif artwork.preview_image:
+        data['preview_image_url'] = artwork.preview_image.url
+    return data
+
+def artwork_status_api(request, pk):
+    """API endpoint to check artwork status"""
+    artwork = get_object_or_404(GhibliArtwork, pk=pk)
+    return JsonResponse(artwork_status_data(artwork))
+
+def artwork_events(request, pk):
+    """Event stream of an artwork's status, until its conversion is over"""
+    artwork = get_object_or_404(GhibliArtwork, pk=pk)
     
-    return JsonResponse(data)
+    def snapshot():
+        artwork.refresh_from_db()
+        data = artwork_status_data(artwork)
+        # A result served at the deadline may still be replaced by the late one
+        awaiting_late_result = artwork.deadline_fallback and getattr(settings, 'FLUX_REPLACE_LATE_RESULTS', True)
+        return data, artwork.has_error or (artwork.is_processed and not awaiting_late_result)
+    
+    return event_stream(request, artwork_channel(artwork.pk), snapshot)
+
+def processing_events(request):
+    """Event stream of the queue counts, changing whenever an artwork enters or leaves the queue"""
+    def snapshot():
+        counts = artwork_stats()['status']
+        return {'pending': counts['pending'], 'processing': counts['processing']}, False
+    
+    return event_stream(request, QUEUE_CHANNEL, snapshot)
+
+@csrf_exempt
+@require_POST
+def replicate_webhook_view(request, pk, token):
+    """Replicate calls this when a prediction started for the artwork completes"""
+    from .predictions import finish_prediction, verify_webhook
+    
+    if not verify_webhook(request.headers, request.body):
+        return HttpResponseForbidden('Invalid webhook signature')
+    
+    try:
+        prediction = json.loads(request.body)
+    except ValueError:
+        return HttpResponseBadRequest('Invalid JSON')
+    
+    # The token names the artwork's current prediction; the callback can
+    # beat start_prediction to saving the id, otherwise the ids must match
+    artwork = get_object_or_404(GhibliArtwork, pk=pk, webhook_token=token)
+    if artwork.prediction_id is not None and artwork.prediction_id != prediction.get('id'):
+        return HttpResponseNotFound('Unknown prediction')
+    finish_prediction(artwork, prediction)
+    
+    return JsonResponse({'status': artwork.status})
 
 def gallery_stats_api(request):
     """API endpoint for gallery statistics"""
-    stats = {
-        'total': GhibliArtwork.objects.count(),
-        'completed': GhibliArtwork.objects.filter(status='completed').count(),
-        'processing': GhibliArtwork.objects.filter(status='processing').count(),
-        'pending': GhibliArtwork.objects.filter(status='pending').count(),
-        'failed': GhibliArtwork.objects.filter(status='failed').count(),
-    }
+    counts = artwork_stats()
+    stats = {'total': counts['total'], **counts['status']}
     
     # Method breakdown
     method_stats = {}
     for method_code, method_name in GhibliArtwork.CONVERSION_METHODS:
         method_stats[method_code] = {
             'name': method_name,
-            'count': GhibliArtwork.objects.filter(
-                conversion_method=method_code,
-                status='completed'
-            ).count()
+            'count': counts['completed_by_method'][method_code]
         }
     
     return JsonResponse({
         'stats': stats,
-        'methods': method_stats
+        'methods': method_stats,
+        # Added up by the workers - this process converts nothing itself
+        'result_cache': shared_stats(cache)
     })
 
 def upload_progress_api(request):
@@ -444,11 +408,15 @@ def batch_upload_view(request):
         if form.is_valid():
             batch = form.save()
             
-            # Start batch processing immediately
+            # The workers extract and convert it; the detail page follows progress
             try:
-                result_message = process_batch_upload(str(batch.id))
-                messages.success(request, result_message)
+                from .tasks import enqueue_batch
+                enqueue_batch(batch)
+                messages.success(request, f'📬 Batch "{batch.name}" uploaded - its images are being converted.')
             except Exception as e:
+                batch.status = 'failed'
+                batch.error_message = f'Could not queue the batch: {e}'
+                batch.save()
                 messages.error(request, f'Batch processing failed: {str(e)}')
             
             return redirect('batch_detail', pk=batch.pk)
@@ -459,7 +427,8 @@ def batch_upload_view(request):
     
     context = {
         'form': form,
-        'page_title': 'Batch Upload'
+        'page_title': 'Batch Upload',
+        'max_images': settings.BATCH_MAX_IMAGES,
     }
     return render(request, 'batch_upload.html', context)
 
@@ -468,18 +437,16 @@ def batch_detail_view(request, pk):
     batch = get_object_or_404(BatchUpload, pk=pk)
     
     # Get all artworks in this batch
-    artworks = batch.artworks.all().order_by('-created_at')
+    artworks = batch.artworks.only(*BATCH_ARTWORK_FIELDS)
     
-    # Pagination for large batches
-    paginator = Paginator(artworks, 12)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    # Pagination for large batches - every image of the manifest becomes an
+    # artwork, so its total stands in for a count
+    page_obj = cursor_page(request, artworks, 12, count=batch.total_images)
     
     context = {
         'batch': batch,
         'page_obj': page_obj,
-        'artworks': artworks,
-        'total_count': artworks.count(),
+        'total_count': batch.total_images,
     }
     return render(request, 'batch_detail.html', context)
 
@@ -512,11 +479,14 @@ def batch_retry_view(request, pk):
                 batch.processed_images = 0
                 batch.successful_images = 0
                 batch.failed_images = 0
-                batch.save()
+                batch.save(update_fields=[
+                    'status', 'error_message', 'processed_images', 'successful_images', 'failed_images'
+                ])
                 
-                # Restart processing
-                result_message = process_batch_upload(str(batch.id))
-                messages.success(request, f'Batch retry completed: {result_message}')
+                # Restart processing on the workers
+                from .tasks import enqueue_batch
+                enqueue_batch(batch)
+                messages.success(request, f'🔄 Batch "{batch.name}" queued for another try.')
             except Exception as e:
                 messages.error(request, f'Batch retry failed: {str(e)}')
         else:
@@ -525,11 +495,8 @@ def batch_retry_view(request, pk):
     return redirect('batch_detail', pk=pk)
 
 # API view for batch progress
-def batch_progress_api(request, pk):
-    """API endpoint to check batch processing progress"""
-    batch = get_object_or_404(BatchUpload, pk=pk)
-    
-    data = {
+def batch_progress_data(batch):
+    return {
         'status': batch.status,
         'status_display': batch.get_status_display(),
         'progress_percentage': batch.progress_percentage,
@@ -541,8 +508,21 @@ def batch_progress_api(request, pk):
         'is_processing': batch.is_processing,
         'error_message': batch.error_message,
     }
+
+def batch_progress_api(request, pk):
+    """API endpoint to check batch processing progress"""
+    batch = get_object_or_404(BatchUpload, pk=pk)
+    return JsonResponse(batch_progress_data(batch))
+
+def batch_events(request, pk):
+    """Event stream of a batch's progress, until it completes or fails"""
+    batch = get_object_or_404(BatchUpload, pk=pk)
+    
+    def snapshot():
+        batch.refresh_from_db()
+        return batch_progress_data(batch), batch.status in ('completed', 'failed')
     
-    return JsonResponse(data)
+    return event_stream(request, batch_channel(batch.pk), snapshot)
 
 
 
@@ -631,8 +611,18 @@ def delete_artwork(request, artwork_id):
     artwork = get_object_or_404(GhibliArtwork, id=artwork_id)
     if request.method == 'POST':
         artwork_name = artwork.name
-        # Remove files (optional)
-        for img in [artwork.original_image, artwork.converted_image]:
+        # Remove files (optional) - variants share the original and go with it
+        images = [artwork.converted_image, artwork.preview_image]
+        if artwork.variant_of_id is None:
+            # Copies of one image in a batch ZIP share an original too
+            shared = GhibliArtwork.objects.filter(
+                original_image=artwork.original_image.name, variant_of__isnull=True
+            ).exclude(pk=artwork.pk)
+            if not shared.exists():
+                images.append(artwork.original_image)
+            for variant in artwork.variants.all():
+                images.extend([variant.converted_image, variant.preview_image])
+        for img in images:
             if img and img.name:
                 try:
                     if os.path.isfile(img.path):
@@ -0,0 +1,75 @@
+"""
+ZIP manifest for batch uploads
+One pass over the central directory and the image headers on upload;
+validation, extraction, progress totals and retries all read the manifest
+instead of rescanning the archive
+"""
+
+import os
+import zipfile
+
+from PIL import Image
+
+BATCH_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Formats a batch image may actually be, whatever its extension says
+BATCH_IMAGE_FORMATS = ('JPEG', 'PNG', 'WEBP')
+
+
+def is_batch_image(filename):
+    """Whether a ZIP member name looks like an image to convert"""
+    name = os.path.basename(filename)
+    # Skip directories, hidden files and macOS resource forks
+    if filename.endswith('/') or not name or name.startswith('.') or filename.startswith('__MACOSX'):
+        return False
+    return os.path.splitext(name)[1].lower() in BATCH_IMAGE_EXTENSIONS
+
+
+def build_manifest(zip_file):
+    """
+    Describe every image member of a ZIP archive
+
+    zip_file is a path or an open binary file. Each entry holds the member
+    name, sizes, local header offset and CRC from the central directory,
+    plus the format and dimensions sniffed from the image header - only
+    the first bytes of each member are decompressed. Members whose header
+    is not a supported image get type None. Raises zipfile.BadZipFile for
+    something that is not a ZIP archive.
+    """
+    manifest = []
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if not is_batch_image(info.filename):
+                continue
+
+            entry = {
+                'name': info.filename,
+                'size': info.file_size,
+                'compressed_size': info.compress_size,
+                'offset': info.header_offset,
+                'crc': info.CRC,
+                'type': None,
+                'width': None,
+                'height': None,
+            }
+            try:
+                with zip_ref.open(info) as member, Image.open(member, formats=BATCH_IMAGE_FORMATS) as img:
+                    entry['type'] = img.format
+                    entry['width'], entry['height'] = img.size
+            except Exception:
+                pass
+            manifest.append(entry)
+    return manifest
+
+
+def valid_entries(manifest):
+    """Entries whose header is a supported image"""
+    return [entry for entry in manifest if entry['type'] is not None]
+
+
+def batch_manifest(batch):
+    """The manifest of a batch, built from its stored ZIP once if it has none yet"""
+    if batch.manifest is None:
+        batch.manifest = build_manifest(batch.zip_file.path)
+        batch.save(update_fields=['manifest'])
+    return batch.manifest
@@ -3,6 +3,10 @@ ASGI config for ghibli_gallery project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it with an ASGI server (e.g. ``uvicorn ghibli_gallery.asgi:application``)
+so the live progress streams wait on the event loop instead of holding a
+worker thread each.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -26,7 +26,11 @@ app.conf.beat_schedule = {
     },
     'test-api-connection': {
         'task': 'gallery.tasks.test_huggingface_connection',
-        'schedule': 1800.0,  # Test connection every 30 minutes
+        'schedule': 300.0,  # Cheap probe every 5 minutes - feeds the FLUX circuit breaker
+    },
+    'reconcile-artwork-stats': {
+        'task': 'gallery.tasks.reconcile_artwork_stats',
+        'schedule': 3600.0,  # Repairs counter drift from writes that skip the model
     },
 }
 
@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -96,19 +96,122 @@ MEDIA_ROOT = BASE_DIR / 'media'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-# Celery Configuration
-# CELERY_BROKER_URL = 'redis://127.0.0.1:6379/0'
-# CELERY_RESULT_BACKEND = 'redis://127.0.0.1:6379/0'
-# CELERY_ACCEPT_CONTENT = ['json']
-# CELERY_TASK_SERIALIZER = 'json'
-# CELERY_RESULT_SERIALIZER = 'json'
-# CELERY_TIMEZONE = 'UTC'
+# Shared cache - holds the circuit breaker state and the artwork statistics
+# counters, so point it at Redis in production for every web and Celery worker
+# to see the same state; without it the statistics are counted on every read
+REDIS_CACHE_URL = config('REDIS_CACHE_URL', default='')
+if REDIS_CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+# Celery Configuration - uploads are converted by the worker, not in the request
+CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='redis://127.0.0.1:6379/0')
+# Task state lives on the artwork rows, so results are not stored
+CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default=None)
+CELERY_TASK_IGNORE_RESULT = True
+CELERY_ACCEPT_CONTENT = ['json']
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_TIMEZONE = 'UTC'
+# Run tasks inline in the web process - for development without a worker
+CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', default=False, cast=bool)
+# An unreachable broker fails the upload within about a second instead of hanging it
+CELERY_BROKER_CONNECTION_TIMEOUT = 1
+CELERY_TASK_PUBLISH_RETRY_POLICY = {'max_retries': 2, 'interval_start': 0, 'interval_step': 0.2, 'interval_max': 0.5}
 
 # Hugging Face API Configuration
 # HUGGINGFACE_TOKEN = config('HUGGINGFACE_TOKEN', default='')
 
 REPLICATE_API_TOKEN = config('REPLICATE_API_TOKEN', default='')
 
+# Filter fallback: keep the original resolution instead of resizing to 512x512.
+# Large images are filtered in strips of FILTER_TILE_ROWS rows to bound memory.
+FILTER_FULL_RESOLUTION = config('FILTER_FULL_RESOLUTION', default=False, cast=bool)
+FILTER_TILE_ROWS = config('FILTER_TILE_ROWS', default=256, cast=int)
+# Threads filtering the images or styles of one task at once (0 = one per core).
+# Threads, not processes: Celery's prefork workers cannot start process pools,
+# and PIL and NumPy release the GIL while they filter
+FILTER_THREADS = config('FILTER_THREADS', default=0, cast=int)
+
+# Instant previews: a filter rendering of at most PREVIEW_MAX_SIDE pixels is made
+# at submit time and shown until the full conversion replaces it (0 = off)
+PREVIEW_MAX_SIDE = config('PREVIEW_MAX_SIDE', default=256, cast=int)
+
+# Gallery search backend (dotted path); empty = FTS5 on SQLite, icontains elsewhere
+SEARCH_BACKEND = config('SEARCH_BACKEND', default='')
+
+# Live progress (Server-Sent Events): Redis pub/sub carries the events from the
+# Celery workers to the web processes; empty = in-process only (eager Celery, dev)
+EVENTS_REDIS_URL = config('EVENTS_REDIS_URL', default='')
+# A comment is sent on idle streams this often (seconds), and each stream is
+# ended after EVENTS_MAX_AGE for the browser to reconnect
+EVENTS_KEEPALIVE = config('EVENTS_KEEPALIVE', default=15, cast=int)
+EVENTS_MAX_AGE = config('EVENTS_MAX_AGE', default=300, cast=int)
+# Under WSGI no stream is held open: the state is sent once and the browser
+# reconnects after this many seconds. ASGI streams re-read the state this often
+# when worker notices cannot reach them (no EVENTS_REDIS_URL, tasks not eager)
+EVENTS_POLL_INTERVAL = config('EVENTS_POLL_INTERVAL', default=5, cast=int)
+
+# Batch uploads fan out into Celery tasks of up to BATCH_IMAGES_PER_TASK images,
+# whose FLUX predictions are in flight together: at most this many images of one
+# batch convert at once (overridable per batch), and at most this many per ZIP
+BATCH_MAX_CONCURRENCY = config('BATCH_MAX_CONCURRENCY', default=8, cast=int)
+BATCH_MAX_IMAGES = config('BATCH_MAX_IMAGES', default=1000, cast=int)
+BATCH_IMAGES_PER_TASK = config('BATCH_IMAGES_PER_TASK', default=4, cast=int)
+
+# FLUX predictions kept in flight per process, and the timeout for each one
+FLUX_MAX_IN_FLIGHT = config('FLUX_MAX_IN_FLIGHT', default=16, cast=int)
+FLUX_TIMEOUT = config('FLUX_TIMEOUT', default=120, cast=int)
+
+# Interactive uploads wait at most FLUX_DEADLINE seconds for FLUX (0 = no deadline),
+# overridable per style as "sketch=15,ghibli=40". After that the filter result made
+# meanwhile is served, and replaced by the FLUX result if it still arrives and
+# FLUX_REPLACE_LATE_RESULTS is set
+FLUX_DEADLINE = config('FLUX_DEADLINE', default=30, cast=float)
+FLUX_STYLE_DEADLINES = {
+    style.strip(): float(seconds)
+    for style, seconds in (item.split('=') for item in config('FLUX_STYLE_DEADLINES', default='', cast=Csv()))
+}
+FLUX_REPLACE_LATE_RESULTS = config('FLUX_REPLACE_LATE_RESULTS', default=True, cast=bool)
+
+# Circuit breaker: after this many consecutive FLUX failures, go straight to the
+# filters for FLUX_BREAKER_RESET_TIMEOUT seconds before trying FLUX again
+FLUX_BREAKER_FAILURES = config('FLUX_BREAKER_FAILURES', default=5, cast=int)
+FLUX_BREAKER_RESET_TIMEOUT = config('FLUX_BREAKER_RESET_TIMEOUT', default=60, cast=int)
+
+# FLUX inputs are downscaled to the model's working size and re-encoded before upload
+FLUX_INPUT_MAX_SIDE = config('FLUX_INPUT_MAX_SIDE', default=1024, cast=int)
+FLUX_INPUT_QUALITY = config('FLUX_INPUT_QUALITY', default=90, cast=int)
+FLUX_INPUT_MAX_BYTES = config('FLUX_INPUT_MAX_BYTES', default=1024 * 1024, cast=int)
+
+# Public base URL Replicate can reach (e.g. https://gallery.example.com) and the
+# webhook signing secret (whsec_...). When both are set, FLUX predictions run
+# without waiting and the signed webhook finishes them.
+REPLICATE_WEBHOOK_HOST = config('REPLICATE_WEBHOOK_HOST', default='')
+REPLICATE_WEBHOOK_SECRET = config('REPLICATE_WEBHOOK_SECRET', default='')
+
+# Conversion result cache, keyed on the decoded input, style, prompt and backend.
+# Past RESULT_CACHE_MAX_BYTES it is evicted down to RESULT_CACHE_LOW_WATER of it
+RESULT_CACHE_DIR = config('RESULT_CACHE_DIR', default=str(BASE_DIR / 'result_cache'))
+RESULT_CACHE_MAX_BYTES = config('RESULT_CACHE_MAX_BYTES', default=512 * 1024 * 1024, cast=int)
+RESULT_CACHE_HOT_ENTRIES = config('RESULT_CACHE_HOT_ENTRIES', default=32, cast=int)
+RESULT_CACHE_LOW_WATER = config('RESULT_CACHE_LOW_WATER', default=0.9, cast=float)
+
+# Cold-start budget for importing the URLconf or the Celery tasks on top of
+# django.setup() (python -m gallery.startup); each costs a few tens of ms, so
+# a new eager import shows up as a failure
+STARTUP_IMPORT_BUDGET_MS = config('STARTUP_IMPORT_BUDGET_MS', default=100, cast=int)
+
 # File Upload Settings
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024  # 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024   # 10MB
\ No newline at end of file